@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+'''
+Versioned artifact bundle: the files serving needs from one training run (the preprocessor and its feature
+layout, the model and its flat copy), tied together by a manifest.json in the artifacts folder that records:
+    - the bundle version (UTC time it was written plus a digest of the file checksums)
+    - the hash of the data schema it was trained with
+    - the feature layout (output columns of the pre-processing, which the model's features must match)
+    - the versions of python and the libraries that pickled the files (sklearn, feature-engine, ...)
+    - the size and sha256 checksum of every file
+Every file is written atomically (see utils.atomic_path) and the manifest last, so it marks a complete bundle;
+load_bundle only returns a bundle whose files all match its manifest, loading the preprocessor and the model
+in parallel threads. Artifacts saved without a manifest still load, unverified.
+Run from app/src to write the manifest of the saved artifacts, or to check them against it:
+    python artifact_bundle.py
+    python artifact_bundle.py --verify
+'''
+import os, sys, time, platform, json, warnings
+warnings.filterwarnings('ignore')
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, './../../')
+
+import app.src.preprocessing.pipeline as pipeline
+import app.src.model.regressor as regressor
+import app.src.utils as utils
+from app.src.preprocessing.compiled import compile_pipeline
+from app.src.preprocessing.feature_layout import feature_layout_fname, load_compiled_pipeline
+
+
+manifest_fname = "manifest.json"
+# bump when the manifest format changes; bundles with another version are not loaded
+MANIFEST_VERSION = 1
+# files of a bundle, relative to the artifacts folder (folders stand for all the files in them); the
+# first two are required. Artifacts derived later (e.g. model_tabulated) carry their own checksum of the model.
+bundle_paths = [pipeline.preprocessor_fname, regressor.model_fname, feature_layout_fname, regressor.flat_model_dirname]
+library_names = ["numpy", "pandas", "sklearn", "feature_engine", "joblib"]
+
+artifacts_path = "./../artifacts/"
+schema_path = "./../data/data_config/"
+
+
+
+class BundleError(Exception):
+    ''' Raised when the artifacts do not form a complete, consistent bundle. '''
+
+
+
+class ArtifactBundle():
+    ''' A loaded bundle: everything serving needs to score a request, replaced as a whole on a reload. '''
+    def __init__(self, inputs_pipeline, compiled_pipeline, model, manifest=None) -> None:
+        self.inputs_pipeline = inputs_pipeline
+        self.compiled_pipeline = compiled_pipeline
+        self.model = model
+        self.manifest = manifest
+        # lookup table of the model over all valid inputs, set by serve.py when enabled
+        self.tabulated_model = None
+        self.loaded_at = time.time()
+
+
+    @property
+    def version(self):
+        return self.manifest["bundle_version"] if self.manifest is not None else None
+
+
+    def info(self):
+        ''' Version, creation and load time, and library versions of the bundle, for /stats. '''
+        manifest = self.manifest or {}
+        return {
+            "bundle_version": self.version,
+            "created_at": manifest.get("created_at"),
+            "loaded_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.loaded_at)),
+            "n_features": (manifest.get("feature_layout") or {}).get("n_features"),
+            "library_versions": manifest.get("library_versions"),
+        }
+
+
+
+def get_library_versions():
+    versions = { "python": platform.python_version() }
+    for name in library_names:
+        versions[name] = getattr(sys.modules.get(name) or __import__(name), "__version__", None)
+    return versions
+
+
+
+def get_schema_hash(data_schema):
+    return utils.get_json_checksum(data_schema)
+
+
+
+def list_bundle_files(dir_path):
+    ''' Paths (relative to dir_path) of the bundle files present in dir_path. Raises a BundleError if a required one is missing. '''
+    files = []
+    for i, path in enumerate(bundle_paths):
+        full_path = os.path.join(dir_path, path)
+        if os.path.isdir(full_path):
+            files += [os.path.join(path, f) for f in sorted(os.listdir(full_path)) if os.path.isfile(os.path.join(full_path, f))]
+        elif os.path.isfile(full_path):
+            files.append(path)
+        elif i < 2:
+            raise BundleError(f"{path} is missing from {dir_path}.")
+    return files
+
+
+
+def write_manifest(dir_path, data_schema=None):
+    ''' Write the manifest of the bundle files saved in dir_path (call it after all of them are saved) and return it. '''
+    files = { path: { "size": os.path.getsize(os.path.join(dir_path, path)), "sha256": utils.get_file_checksum(os.path.join(dir_path, path)) }
+              for path in list_bundle_files(dir_path) }
+    created_at = time.gmtime()
+    digest = utils.get_json_checksum({ path: entry["sha256"] for path, entry in files.items() })
+    manifest = {
+        "manifest_version": MANIFEST_VERSION,
+        "bundle_version": time.strftime("%Y%m%dT%H%M%SZ", created_at) + "-" + digest[:12],
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", created_at),
+        "schema_hash": get_schema_hash(data_schema) if data_schema is not None else None,
+        "feature_layout": get_feature_layout_summary(dir_path),
+        "library_versions": get_library_versions(),
+        "files": files,
+    }
+    with utils.atomic_path(os.path.join(dir_path, manifest_fname)) as tmp_path, open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+
+def get_feature_layout_summary(dir_path):
+    ''' Output columns of the saved preprocessor: from its feature layout if saved, else by compiling the pipeline. '''
+    layout = pipeline.load_feature_layout(dir_path)
+    if layout is not None:
+        columns = layout["columns"]
+    else:
+        try:
+            columns = compile_pipeline(pipeline.load_preprocessor(dir_path)).columns
+        except ValueError:
+            return None
+    return { "n_features": len(columns), "columns": list(columns) }
+
+
+
+def read_manifest(dir_path):
+    ''' The manifest saved in dir_path, or None if there is none. Raises a BundleError if it cannot be used. '''
+    manifest_path = os.path.join(dir_path, manifest_fname)
+    if not os.path.exists(manifest_path):
+        return None
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except ValueError as e:
+        raise BundleError(f"Could not read {manifest_fname}: {e}")
+    if manifest.get("manifest_version") != MANIFEST_VERSION:
+        raise BundleError(f"{manifest_fname} has version {manifest.get('manifest_version')}, expected {MANIFEST_VERSION}.")
+    return manifest
+
+
+
+def verify_files(dir_path, manifest):
+    ''' Check every file listed in the manifest against its size and checksum; returns their (size, mtime)
+    signature. Raises a BundleError on the first file that is missing or differs (e.g. half written). '''
+    signature = {}
+    for path, entry in manifest["files"].items():
+        full_path = os.path.join(dir_path, path)
+        try:
+            stat = os.stat(full_path)
+        except FileNotFoundError:
+            raise BundleError(f"{path} is listed in {manifest_fname} but missing.")
+        if stat.st_size != entry["size"] or utils.get_file_checksum(full_path) != entry["sha256"]:
+            raise BundleError(f"{path} does not match {manifest_fname} (bundle {manifest['bundle_version']}).")
+        signature[path] = (stat.st_size, stat.st_mtime_ns)
+    return signature
+
+
+
+def get_signature(dir_path, paths):
+    return { path: (stat.st_size, stat.st_mtime_ns) for path, stat in
+             ((path, os.stat(os.path.join(dir_path, path))) for path in paths) }
+
+
+
+def load_bundle(dir_path, schema_hash=None, verify=True, compiled_preprocessing=True, mmap_model=False, flat_forest=False):
+    ''' Load the bundle saved in dir_path: the manifest's files are checked first (with verify), then the
+    preprocessor (with its compiled version, if compiled_preprocessing) and the model are loaded in two parallel
+    threads. Raises a BundleError if the files do not match the manifest or change while loading, if the bundle
+    was trained on another data schema than schema_hash (when given), or if the model's features differ from
+    the pre-processing's output. '''
+    manifest = read_manifest(dir_path)
+    if manifest is None:
+        print(f"No {manifest_fname} in {dir_path}; loading the artifacts unverified (see artifact_bundle.py).")
+    else:
+        if schema_hash is not None and manifest["schema_hash"] not in (None, schema_hash):
+            raise BundleError(f"Bundle {manifest['bundle_version']} was trained on another data schema.")
+        signature = verify_files(dir_path, manifest) if verify else get_signature(dir_path, manifest["files"])
+        mismatched = { name: version for name, version in manifest["library_versions"].items()
+                       if version != get_library_versions().get(name) }
+        if mismatched:
+            print(f"Bundle {manifest['bundle_version']} was saved with other library versions: {mismatched}")
+
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix="bundle_load") as executor:
+        preprocessing = executor.submit(load_preprocessing, dir_path, compiled_preprocessing)
+        model = executor.submit(load_model, dir_path, mmap_model, flat_forest)
+        (inputs_pipeline, compiled_pipeline), model = preprocessing.result(), model.result()
+
+    if manifest is not None:
+        # a file replaced after it was verified may have been loaded in its new version
+        if read_manifest(dir_path) != manifest or get_signature(dir_path, manifest["files"]) != signature:
+            raise BundleError(f"Bundle {manifest['bundle_version']} changed while it was loaded.")
+        n_features = (manifest["feature_layout"] or {}).get("n_features")
+        model_features = model.flat_forest.n_features if model.flat_forest is not None else getattr(model.model, "n_features_in_", None)
+        if n_features is not None and model_features is not None and n_features != model_features:
+            raise BundleError(f"The model has {model_features} features but the pre-processing outputs {n_features}.")
+    return ArtifactBundle(inputs_pipeline, compiled_pipeline, model, manifest)
+
+
+
+def load_preprocessing(dir_path, compiled_preprocessing=True):
+    ''' The fitted pipeline and, if compiled_preprocessing, its pandas-free version (or None if it cannot be
+    compiled): built from the saved feature layout if it matches the preprocessor, else from the pipeline itself. '''
+    inputs_pipeline = pipeline.load_preprocessor(dir_path)
+    compiled_pipeline = None
+    if compiled_preprocessing:
+        layout = pipeline.load_feature_layout(dir_path)
+        try:
+            compiled_pipeline = load_compiled_pipeline(layout) if layout is not None else compile_pipeline(inputs_pipeline)
+        except ValueError as e:
+            print(f"Using the pandas preprocessing pipeline: {e}")
+    return inputs_pipeline, compiled_pipeline
+
+
+
+def load_model(dir_path, mmap_model=False, flat_forest=False):
+    model = regressor.load_model(dir_path, mmap=mmap_model)
+    if flat_forest and model.flat_forest is None:
+        model.enable_flat_forest()
+    return model
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--verify", action="store_true", help="check the saved artifacts against their manifest instead of writing it")
+    args = parser.parse_args()
+
+    if args.verify:
+        manifest = read_manifest(artifacts_path)
+        if manifest is None:
+            sys.exit(f"No {manifest_fname} in {artifacts_path}.")
+        verify_files(artifacts_path, manifest)
+        print(f"Bundle {manifest['bundle_version']}: all {len(manifest['files'])} files match the manifest.")
+    else:
+        manifest = write_manifest(artifacts_path, utils.get_data_schema(schema_path))
+        print(f"Wrote the manifest of bundle {manifest['bundle_version']} ({len(manifest['files'])} files).")
@@ -0,0 +1,74 @@
+'''
+End-to-end train and evaluate time with csv versus parquet and feather inputs/outputs.
+The shipped train and test sets are replicated --scales times, written in each format to a temporary
+directory, and then read, pre-processed, fitted (train) or scored (evaluate), and the predictions written
+back in the same format. Read time is reported separately since that is where the formats differ.
+Run from app/src:
+    python -m benchmarks.bench_columnar_io --scales 10 100
+'''
+import argparse, os, tempfile, time, warnings
+warnings.filterwarnings('ignore')
+import pandas as pd
+
+from benchmarks.common import train_data_path, test_data_path, schema_path
+import app.src.utils as utils
+import app.src.train as train
+import app.src.model.regressor as regressor
+import app.src.preprocessing.pipeline as pipeline
+
+
+formats = { "csv": ".csv", "parquet": ".parquet", "feather": ".feather" }
+
+
+def write_scaled_data(data, scale, dir_path, file_format):
+    os.makedirs(dir_path, exist_ok=True)
+    scaled_data = pd.concat([data] * scale, ignore_index=True)
+    utils.save_dataframe(scaled_data, dir_path, "data" + formats[file_format])
+
+
+def run_train_and_evaluate(train_dir, test_dir, results_dir, file_format, data_schema, n_estimators):
+    timings = {}
+    start = time.perf_counter()
+    train_data = utils.get_data(train_dir, data_schema, file_format=file_format)
+    timings["train_read"] = time.perf_counter() - start
+    processed_inputs, processed_target, inputs_pipeline = train.preprocess_data(train_data, data_schema)
+    model = regressor.Regressor(n_estimators=n_estimators, **regressor.get_data_based_model_params(processed_inputs))
+    model.fit(processed_inputs, processed_target)
+    timings["train_total"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    test_data = utils.get_data(test_dir, data_schema, file_format=file_format)
+    timings["evaluate_read"] = time.perf_counter() - start
+    test_data["predictions"] = model.predict(pipeline.to_feature_matrix(inputs_pipeline.transform(test_data)))
+    utils.save_dataframe(test_data, results_dir, "predictions" + formats[file_format])
+    timings["evaluate_total"] = time.perf_counter() - start
+    return timings
+
+
+def run_benchmark(scales, n_estimators):
+    data_schema = utils.get_data_schema(schema_path)
+    train_data = utils.get_data(train_data_path, data_schema)
+    test_data = utils.get_data(test_data_path, data_schema)
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for scale in scales:
+            for file_format in formats:
+                base = os.path.join(tmp_dir, f"{scale}_{file_format}")
+                write_scaled_data(train_data, scale, os.path.join(base, "train"), file_format)
+                write_scaled_data(test_data, scale, os.path.join(base, "test"), file_format)
+                os.makedirs(os.path.join(base, "results"))
+                timings = run_train_and_evaluate(
+                    os.path.join(base, "train"), os.path.join(base, "test"), os.path.join(base, "results"),
+                    file_format, data_schema, n_estimators)
+                rows.append({ "scale": scale, "format": file_format, **timings })
+
+    print(pd.DataFrame(rows).round(3).to_string(index=False))
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", type=int, nargs="+", default=[10, 100])
+    parser.add_argument("--n-estimators", type=int, default=250, help="trees in the trained forest")
+    args = parser.parse_args()
+    run_benchmark(args.scales, args.n_estimators)
@@ -0,0 +1,75 @@
+'''
+Memory and time of getting --rows synthetic diamonds (resampled from diamond_test.csv, without the Id
+column) into the float32 feature matrix the trees fit and predict on:
+    - pipeline.transform: the inputs pipeline's DataFrame (one-hot columns as uint8, numeric as float64)
+    - sklearn conversion of that DataFrame: the float32 copy fit/predict make of a DataFrame input
+    - to_feature_matrix: the DataFrame written column by column into one C-contiguous float32 matrix,
+      which sklearn then takes as is (checked with np.shares_memory)
+    - compiled transform into a float64 matrix plus sklearn's float32 copy, versus straight into float32
+    - Regressor.predict on the first --predict-rows rows of the float64 and of the float32 matrix
+For each stage the wall time is measured first, then the peak and retained traced memory (tracemalloc,
+which covers numpy and pandas buffers) in a separate call, since tracing slows things down.
+Run from app/src (after training):
+    python -m benchmarks.bench_feature_matrix_memory --rows 10000000
+'''
+import argparse, gc, time, tracemalloc, warnings
+warnings.filterwarnings('ignore')
+import numpy as np
+from sklearn.utils import check_array
+
+from benchmarks.common import make_synthetic_data, artifacts_path
+import app.src.preprocessing.pipeline as pipeline
+import app.src.model.regressor as regressor
+from app.src.preprocessing.compiled import compile_pipeline
+
+
+def measure(name, fn):
+    ''' Time fn, then trace the memory of a second call; returns the second call's result. '''
+    start = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - start
+    gc.collect()
+    tracemalloc.start()
+    result = fn()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<44} {seconds:8.2f} s   peak {peak / 2**20:8.0f} MB   retained {retained / 2**20:8.0f} MB")
+    return result
+
+
+def run_benchmark(n_rows, predict_rows):
+    inputs_pipeline = pipeline.load_preprocessor(artifacts_path)
+    compiled_pipeline = compile_pipeline(inputs_pipeline)
+    model = regressor.load_model(artifacts_path)
+    data = make_synthetic_data(n_rows).drop(columns=["Id"])
+    print(f"{n_rows:,} rows, {compiled_pipeline.n_features} features; raw frame {data.memory_usage(deep=False).sum() / 2**20:.0f} MB "
+          f"(float32 matrix {n_rows * compiled_pipeline.n_features * 4 / 2**20:.0f} MB)")
+
+    processed = measure("pipeline.transform (DataFrame)", lambda: inputs_pipeline.transform(data))
+    print(f"    output dtypes: { { str(k): v for k, v in processed.dtypes.value_counts().items() } }, "
+          f"{processed.memory_usage(deep=False).sum() / 2**20:.0f} MB")
+    measure("sklearn float32 copy of the DataFrame", lambda: check_array(processed, dtype=np.float32))
+    X = measure("to_feature_matrix (float32)", lambda: pipeline.to_feature_matrix(processed))
+    print(f"    sklearn input shares the matrix's memory: {np.shares_memory(check_array(X, dtype=np.float32), X)}")
+    del processed, X
+    gc.collect()
+
+    X64 = measure("compiled transform (float64)", lambda: compiled_pipeline.transform(data, dtype=np.float64))
+    measure("sklearn float32 copy of the float64 matrix", lambda: check_array(X64, dtype=np.float32))
+    X32 = measure("compiled transform (float32)", lambda: compiled_pipeline.transform(data))
+    print(f"    same features: {np.array_equal(X64.astype(np.float32), X32)}")
+
+    predict_rows = min(predict_rows, n_rows)
+    X64_head, X32_head = X64[:predict_rows], X32[:predict_rows]
+    predictions_64 = measure(f"Regressor.predict, {predict_rows:,} float64 rows", lambda: model.predict(X64_head))
+    predictions_32 = measure(f"Regressor.predict, {predict_rows:,} float32 rows", lambda: model.predict(X32_head))
+    print(f"    same predictions: {np.array_equal(predictions_64, predictions_32)}")
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--predict-rows", type=int, default=100_000)
+    args = parser.parse_args()
+    run_benchmark(args.rows, args.predict_rows)
@@ -0,0 +1,71 @@
+'''
+Startup time and memory per worker for the compressed pickle (model.save) versus the memory-mapped
+flat forest (model_flat/). Starts --workers processes per format that all load the model at the same time,
+score a batch, and then report their load time (load_model only), startup time (including imports)
+and memory while all of them are still alive:
+    - rss: resident memory of the worker
+    - pss: proportional set size; pages shared between workers are split between them
+    - private: memory only this worker holds
+Run from app/src (after training):
+    python -m benchmarks.bench_model_loading --workers 4
+'''
+import argparse, json, subprocess, sys
+import numpy as np
+
+from benchmarks.common import artifacts_path
+
+
+worker_script = '''
+import sys, time, json
+start = time.perf_counter()
+sys.path.insert(0, './../../')
+import numpy as np
+import app.src.model.regressor as regressor
+load_start = time.perf_counter()
+model = regressor.load_model({artifacts_path!r}, mmap={mmap})
+load_seconds = time.perf_counter() - load_start
+startup_seconds = time.perf_counter() - start
+n_features = model.flat_forest.n_features if model.flat_forest is not None else model.model.n_features_in_
+model.predict(np.random.default_rng(0).normal(size=(1000, n_features)).astype(np.float32))
+print(json.dumps({{"load_seconds": load_seconds, "startup_seconds": startup_seconds}}), flush=True)
+sys.stdin.readline()
+mem = {{}}
+with open("/proc/self/smaps_rollup") as f:
+    for line in f:
+        key, _, rest = line.partition(":")
+        if key in ("Rss", "Pss", "Private_Clean", "Private_Dirty"):
+            mem[key] = int(rest.split()[0]) / 1024
+print(json.dumps({{"rss_mb": mem["Rss"], "pss_mb": mem["Pss"], "private_mb": mem["Private_Clean"] + mem["Private_Dirty"]}}), flush=True)
+'''
+
+
+def run_workers(n_workers, mmap):
+    script = worker_script.format(artifacts_path=artifacts_path, mmap=mmap)
+    workers = [
+        subprocess.Popen([sys.executable, "-W", "ignore", "-c", script], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        for _ in range(n_workers)
+    ]
+    results = [json.loads(worker.stdout.readline()) for worker in workers]
+    # all workers are loaded and alive now; ask each for its memory
+    for worker, result in zip(workers, results):
+        worker.stdin.write("\n")
+        worker.stdin.flush()
+        result.update(json.loads(worker.stdout.readline()))
+        worker.wait()
+    return results
+
+
+def run_benchmark(n_workers):
+    print(f"{'format':<20}{'load s':>10}{'startup s':>11}{'rss MB':>10}{'pss MB':>10}{'private MB':>12}")
+    for name, mmap in [("compressed pickle", False), ("mmap flat forest", True)]:
+        results = run_workers(n_workers, mmap)
+        means = { key: np.mean([r[key] for r in results]) for key in results[0] }
+        print(f"{name:<20}{means['load_seconds']:>10.3f}{means['startup_seconds']:>11.3f}{means['rss_mb']:>10.1f}{means['pss_mb']:>10.1f}{means['private_mb']:>12.1f}")
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+    run_benchmark(args.workers)
@@ -0,0 +1,98 @@
+'''
+Latency of POST /predict under overload, with and without the bounded inference executor:
+    - threadpool: inference on the default threadpool (unbounded queueing, joblib fan-out in each call)
+    - executor: inference_executor enabled in serve_config.json (bounded queue, 503 + Retry-After, deadlines)
+For each mode the service runs in a forked uvicorn process and --concurrency client threads send single
+records back to back for --seconds (waiting Retry-After seconds after a 503, as a well-behaved client
+would). Reports the count of each status code, p50/p95/p99/max latency of the
+successful (200) and of all responses, and the rate of successful responses.
+Run from app/src (after training):
+    python -m benchmarks.bench_overload --concurrency 64 --seconds 20
+'''
+import argparse, http.client, json, multiprocessing, threading, time, warnings
+warnings.filterwarnings('ignore')
+import numpy as np
+
+from benchmarks.common import make_synthetic_data
+
+
+def run_server(port, executor_cfg):
+    import uvicorn
+    import serve
+    serve.serve_cfg["inference_executor"].update(executor_cfg)
+    uvicorn.run(serve.app, host="127.0.0.1", port=port, log_level="error")
+
+
+def wait_until_ready(port, timeout=120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            connection.request("GET", "/ready")
+            if connection.getresponse().status == 200: return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("Service did not become ready.")
+
+
+def send_requests(port, bodies, end_time, results):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    i = 0
+    while time.monotonic() < end_time:
+        start = time.perf_counter()
+        try:
+            connection.request("POST", "/predict", body=bodies[i % len(bodies)], headers={ "content-type": "application/json" })
+            response = connection.getresponse()
+            response.read()
+            status = response.status
+            retry_after = float(response.getheader("Retry-After") or 0) if status == 503 else 0
+        except OSError:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+            status, retry_after = 0, 0
+        results.append((status, time.perf_counter() - start))
+        if retry_after: time.sleep(min(retry_after, max(0.0, end_time - time.monotonic())))
+        i += 1
+
+
+def run_mode(name, executor_cfg, port, bodies, concurrency, seconds):
+    server = multiprocessing.get_context("fork").Process(target=run_server, args=(port, executor_cfg), daemon=True)
+    server.start()
+    try:
+        wait_until_ready(port)
+        results = []
+        end_time = time.monotonic() + seconds
+        threads = [threading.Thread(target=send_requests, args=(port, bodies[k::concurrency], end_time, results)) for k in range(concurrency)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+    finally:
+        server.terminate()
+        server.join()
+
+    statuses = np.array([status for status, _ in results])
+    latencies = np.array([latency for _, latency in results]) * 1000
+    codes, counts = np.unique(statuses, return_counts=True)
+    print(f"{name}: " + ", ".join(f"{code}: {count}" for code, count in zip(codes, counts)) +
+          f"; {np.sum(statuses == 200) / seconds:.1f} successful responses/s")
+    for label, mask in [("200", statuses == 200), ("all", np.ones(len(statuses), dtype=bool))]:
+        if not mask.any(): continue
+        p50, p95, p99 = np.percentile(latencies[mask], [50, 95, 99])
+        print(f"    {label:>4} ms  p50 {p50:8.1f}  p95 {p95:8.1f}  p99 {p99:8.1f}  max {latencies[mask].max():8.1f}")
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--workers", type=int, default=None, help="executor workers (default: from serve_config.json)")
+    parser.add_argument("--max-queue", type=int, default=None, help="executor queue size (default: from serve_config.json)")
+    parser.add_argument("--timeout-ms", type=float, default=None, help="request deadline (default: from serve_config.json)")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    bodies = [json.dumps(record) for record in json.loads(make_synthetic_data(1000).to_json(orient="records"))]
+    executor_cfg = { key: value for key, value in [("workers", args.workers), ("max_queue", args.max_queue), ("timeout_ms", args.timeout_ms)]
+                     if value is not None }
+    run_mode("threadpool", { "enabled": False }, args.port, bodies, args.concurrency, args.seconds)
+    run_mode("executor", { **executor_cfg, "enabled": True }, args.port + 1, bodies, args.concurrency, args.seconds)
@@ -0,0 +1,39 @@
+'''
+Throughput (rows/sec) of the custom transformers in preprocessing/preprocessors.py and of the full inputs pipeline.
+Run from app/src:
+    python -m benchmarks.bench_preprocessors --rows 1000 100000 10000000
+'''
+import argparse, warnings
+warnings.filterwarnings('ignore')
+
+from benchmarks.common import make_synthetic_data, fit_inputs_pipeline, time_call
+
+
+benchmarked_steps = ["string_type_caster", "cat_one_hot_encoder", "float_type_caster", "value_clipper"]
+
+
+def run_benchmark(row_counts, repeats):
+    inputs_pipeline = fit_inputs_pipeline()
+    print(f"{'rows':>10}  {'step':<22}{'seconds':>10}{'rows/sec':>14}")
+    for n_rows in row_counts:
+        data = make_synthetic_data(n_rows)
+        # feed each benchmarked step the output of the steps before it
+        step_input = data
+        for name, step in inputs_pipeline.steps:
+            if name in benchmarked_steps:
+                seconds = time_call(lambda: step.transform(step_input), repeats)
+                print(f"{n_rows:>10}  {name:<22}{seconds:>10.4f}{n_rows / seconds:>14,.0f}")
+            step_input = step.transform(step_input)
+        del step_input
+
+        seconds = time_call(lambda: inputs_pipeline.transform(data), repeats)
+        print(f"{n_rows:>10}  {'full pipeline':<22}{seconds:>10.4f}{n_rows / seconds:>14,.0f}")
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[1_000, 100_000, 10_000_000])
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+    run_benchmark(args.rows, args.repeats)
@@ -0,0 +1,124 @@
+'''
+Latency and throughput of the serving path, at batch sizes from 1 to 100k rows resampled from diamond_test.csv:
+    - transform: inputs_pipeline.transform on a DataFrame
+    - compiled_transform: the compiled pipeline serve.py uses, on a list of records
+    - predict: Regressor.predict on the pre-processed rows (as a float32 feature matrix)
+    - end_to_end: POST /predict (1 row) or /predict/batch (json list) through an in-process ASGI client
+Each case reports p50/p95/p99 latency, rows/sec at the median and peak traced memory (measured in a
+separate call, since tracing slows things down). Results are saved as json; with --baseline, they are
+compared against an earlier run and the script exits with status 1 if any p50 is more than --threshold
+(relative) slower.
+Run from app/src (after training):
+    python -m benchmarks.bench_serve_path --output baseline.json
+    python -m benchmarks.bench_serve_path --baseline baseline.json --threshold 0.1
+'''
+import argparse, json, os, platform, sys, time, tracemalloc, warnings
+warnings.filterwarnings('ignore')
+import numpy as np, pandas as pd, sklearn
+
+from benchmarks.common import make_synthetic_data, results_path
+import app.src.preprocessing.pipeline as pipeline
+from fastapi.testclient import TestClient
+import serve
+
+
+stages = ["transform", "compiled_transform", "predict", "end_to_end"]
+
+
+def measure(fn, n_rows, min_repeats, max_seconds, max_repeats=1000):
+    ''' Time fn (after one warm-up call) at least min_repeats times and until max_seconds have passed,
+    then trace the peak memory of one more call. '''
+    fn()
+    latencies = []
+    start = time.perf_counter()
+    while len(latencies) < min_repeats or (time.perf_counter() - start < max_seconds and len(latencies) < max_repeats):
+        call_start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - call_start)
+
+    tracemalloc.start()
+    fn()
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return { "p50_ms": p50 * 1000, "p95_ms": p95 * 1000, "p99_ms": p99 * 1000,
+             "rows_per_sec": n_rows / p50, "peak_mb": peak_bytes / 2**20, "repeats": len(latencies) }
+
+
+def get_stage_fns(client, data):
+    records = json.loads(data.to_json(orient="records"))
+    bundle = serve.current_bundle
+    processed = pipeline.to_feature_matrix(bundle.inputs_pipeline.transform(data))
+    if len(records) == 1:
+        url, body, headers = "/predict", json.dumps(records[0]), {}
+    else:
+        url, body, headers = "/predict/batch", json.dumps(records), { "content-type": "application/json" }
+
+    def end_to_end():
+        response = client.post(url, data=body, headers=headers)
+        response.raise_for_status()
+
+    fns = {
+        "transform": lambda: bundle.inputs_pipeline.transform(data),
+        "compiled_transform": (lambda: bundle.compiled_pipeline.transform(records)) if bundle.compiled_pipeline is not None else None,
+        "predict": lambda: bundle.model.predict(processed),
+        "end_to_end": end_to_end,
+    }
+    return fns
+
+
+def run_benchmark(batch_sizes, min_repeats, max_seconds):
+    results = []
+    serve.load_artifacts()
+    with TestClient(serve.app) as client:
+        for batch_size in batch_sizes:
+            data = make_synthetic_data(batch_size)
+            for stage, fn in get_stage_fns(client, data).items():
+                if fn is None: continue
+                results.append({ "stage": stage, "batch_size": batch_size, **measure(fn, batch_size, min_repeats, max_seconds) })
+                print(f"{stage:<20}{batch_size:>8}  p50 {results[-1]['p50_ms']:>10.3f} ms  p99 {results[-1]['p99_ms']:>10.3f} ms  "
+                      f"{results[-1]['rows_per_sec']:>14,.0f} rows/s  peak {results[-1]['peak_mb']:>8.1f} MB")
+    meta = { "python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+             "sklearn": sklearn.__version__, "cpus": os.cpu_count(), "machine": platform.machine(),
+             "time": time.strftime("%Y-%m-%dT%H:%M:%S") }
+    return { "meta": meta, "results": results }
+
+
+def compare(results, baseline, threshold):
+    ''' Print the p50 ratio to the baseline of every case in both runs and return the regressed cases. '''
+    baseline_p50 = { (r["stage"], r["batch_size"]): r["p50_ms"] for r in baseline["results"] }
+    rows = []
+    for r in results["results"]:
+        key = (r["stage"], r["batch_size"])
+        if key not in baseline_p50: continue
+        ratio = r["p50_ms"] / baseline_p50[key]
+        rows.append({ "stage": r["stage"], "batch_size": r["batch_size"], "baseline_p50_ms": baseline_p50[key],
+                      "p50_ms": r["p50_ms"], "ratio": ratio, "regression": ratio > 1 + threshold })
+    comparison = pd.DataFrame(rows)
+    print(comparison.round(3).to_string(index=False))
+    return [row for row in rows if row["regression"]]
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 10, 100, 1_000, 10_000, 100_000])
+    parser.add_argument("--min-repeats", type=int, default=5, help="timed calls per case, at least")
+    parser.add_argument("--max-seconds", type=float, default=2.0, help="keep timing a case until this many seconds have passed")
+    parser.add_argument("--output", default=os.path.join(results_path, "bench_serve_path.json"), help="json file to save the results to")
+    parser.add_argument("--baseline", default=None, help="json results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative p50 slowdown that counts as a regression")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.batch_sizes, args.min_repeats, args.max_seconds)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to {args.output}")
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if len(regressions):
+            print(f"{len(regressions)} case(s) regressed by more than {args.threshold:.0%}")
+            sys.exit(1)
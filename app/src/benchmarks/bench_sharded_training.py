@@ -0,0 +1,55 @@
+'''
+Fit time of sharded training (trees split over worker processes and merged) versus a single process.
+The shipped training set is replicated --scale times and pre-processed once; then a single-core fit
+(Regressor with n_jobs=1) is compared with sharded fits using 1, 2, 4, ... workers in each shard mode.
+Reports speedup over the single-core fit and the combined out-of-bag RMSE, which should stay close
+to the single-process one. Speedup is bounded by the number of cpus of the machine.
+Run from app/src:
+    python -m benchmarks.bench_sharded_training --scale 10 --workers 1 2 4 8
+'''
+import argparse, time, warnings
+warnings.filterwarnings('ignore')
+import pandas as pd
+
+from benchmarks.common import train_data_path, schema_path
+import app.src.utils as utils
+import app.src.train as train
+import app.src.model.regressor as regressor
+import app.src.model.sharded_training as sharded_training
+from app.src.model.hyperparameter_tuning import get_oob_rmse
+
+
+def run_benchmark(scale, workers, n_estimators):
+    data_schema = utils.get_data_schema(schema_path)
+    train_data = utils.get_data(train_data_path, data_schema)
+    train_data = pd.concat([train_data] * scale, ignore_index=True)
+    train_X, train_y, _ = train.preprocess_data(train_data, data_schema)
+    hyperparameters = { "n_estimators": n_estimators }
+
+    start = time.perf_counter()
+    model = regressor.Regressor(**regressor.get_data_based_model_params(train_X), **hyperparameters, n_jobs=1)
+    model.fit(train_X, train_y)
+    base_seconds = time.perf_counter() - start
+    rows = [{ "mode": "single process", "workers": 1, "fit_seconds": base_seconds, "speedup": 1.0,
+              "oob_rmse": get_oob_rmse(model.model, train_y) }]
+
+    for shard_mode in sharded_training.shard_modes:
+        for n_workers in workers:
+            start = time.perf_counter()
+            model = sharded_training.fit_sharded(train_X, train_y, n_workers, shard_mode, hyperparameters)
+            seconds = time.perf_counter() - start
+            rows.append({ "mode": shard_mode, "workers": n_workers, "fit_seconds": seconds,
+                          "speedup": base_seconds / seconds, "oob_rmse": get_oob_rmse(model.model, train_y) })
+
+    print(f"{len(train_X)} rows, {n_estimators} trees")
+    print(pd.DataFrame(rows).round(3).to_string(index=False))
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", type=int, default=10, help="times the training set is replicated")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--n-estimators", type=int, default=250, help="trees in the trained forest")
+    args = parser.parse_args()
+    run_benchmark(args.scale, args.workers, args.n_estimators)
@@ -0,0 +1,50 @@
+'''
+Cost per record of request validation and pre-processing on the serving path:
+    - pydantic: DataModel.parse_obj(record).dict(by_alias=True) per record, then the compiled pipeline on the dicts
+    - fast path: RecordValidator.validate on the whole list, then the compiled pipeline on the category codes
+Records are resampled from diamond_test.csv and sent through json, as the service receives them.
+Run from app/src (after training):
+    python -m benchmarks.bench_validation --rows 1 100 10000
+'''
+import argparse, json, warnings
+warnings.filterwarnings('ignore')
+
+from benchmarks.common import make_synthetic_data, artifacts_path, time_call
+import app.src.preprocessing.pipeline as pipeline
+from app.src.preprocessing.compiled import compile_pipeline
+from app.src.serving.validation import RecordValidator
+from data_model import DataModel, CATEGORY_LISTS
+
+
+def run_benchmark(row_counts, repeats):
+    compiled_pipeline = compile_pipeline(pipeline.load_preprocessor(artifacts_path))
+    validator = RecordValidator.from_data_model(DataModel, CATEGORY_LISTS)
+
+    def validate_pydantic(records):
+        return [DataModel.parse_obj(record).dict(by_alias=True) for record in records]
+
+    print(f"{'rows':>8}  {'stage':<32}{'us/record':>12}")
+    for n_rows in row_counts:
+        data = make_synthetic_data(n_rows)
+        # the service only scores valid records
+        records = [record for record in json.loads(data.to_json(orient="records")) if None not in record.values()]
+        validated = validate_pydantic(records)
+        batch, _, _ = validator.validate(records)
+        timings = [
+            ("pydantic validate + dict", lambda: validate_pydantic(records)),
+            ("fast validate + encode", lambda: validator.validate(records)),
+            ("compiled transform (dicts)", lambda: compiled_pipeline.transform(validated)),
+            ("compiled transform (codes)", lambda: compiled_pipeline.transform_encoded(batch)),
+        ]
+        for name, fn in timings:
+            seconds = time_call(fn, repeats)
+            print(f"{len(records):>8}  {name:<32}{1e6 * seconds / len(records):>12.2f}")
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[1, 100, 10_000])
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+    run_benchmark(args.rows, args.repeats)
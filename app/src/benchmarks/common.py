@@ -0,0 +1,47 @@
+import sys, time
+import numpy as np, pandas as pd
+
+sys.path.insert(0, './../../')
+
+import app.src.preprocessing.pipeline as pipeline
+import app.src.preprocessing.preprocess_utils as pp_utils
+import app.src.utils as utils
+
+
+# paths are relative to app/src; run the benchmarks from there, e.g. python -m benchmarks.bench_preprocessors
+train_data_path = "./../data/processed_data/training/"
+test_data_path = "./../data/processed_data/testing/"
+schema_path = "./../data/data_config/"
+artifacts_path = "./../artifacts/"
+results_path = "./../results/"
+
+
+def make_synthetic_data(n_rows, seed=42):
+    ''' Build a frame of n_rows diamonds by resampling rows of the test set (with replacement). '''
+    test_data = utils.get_data(test_data_path)
+    rng = np.random.default_rng(seed)
+    idx = rng.integers(0, len(test_data), size=n_rows)
+    data = test_data.iloc[idx].reset_index(drop=True)
+    data["Id"] = np.arange(n_rows).astype(str)
+    return data
+
+
+def fit_inputs_pipeline():
+    ''' Fit a fresh inputs pipeline on the training data (the same way train.py does). '''
+    train_data = utils.get_data(train_data_path)
+    data_schema = utils.get_data_schema(schema_path)
+    model_cfg = utils.get_model_config()
+    pp_params = pp_utils.get_preprocess_params(train_data, data_schema, model_cfg)
+    inputs_pipeline = pipeline.get_inputs_pipeline(pp_params, model_cfg)
+    inputs_pipeline.fit_transform(train_data.drop(columns=[pp_params["target_attr_name"]]))
+    return inputs_pipeline
+
+
+def time_call(fn, repeats=3):
+    ''' Return the best wall time in seconds of repeats calls to fn. '''
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+'''
+Post-training compaction of the saved forest. Tries every combination of
+    - ensemble pruning: keeping the best trees, chosen by greedy forward selection on out-of-bag error,
+    - depth capping: cutting the trees at a maximum depth,
+    - quantization: node values on a 16-bit grid and float16 thresholds,
+scores each on out-of-bag predictions of the training data (with evaluate.get_scores), and writes out the
+smallest model whose score (rmse or nmae) is at most max_loss (relative) worse than the full forest's, as
+a complete artifact bundle in artifacts_compacted/ (next to artifacts/, which is left as is; to serve the
+compacted model, copy the bundle over). With --output-path set to the artifacts folder, the full forest is
+kept in its full_forest/ subfolder.
+Out-of-bag rows are recreated from the trees' seeds, so the model must come from one fit on the current
+training data (train.py without --shards, not grown by incremental training); a ValueError is raised otherwise.
+Size on disk, load time and prediction latency are reported before and after.
+Run from app/src (after training):
+    python compact.py --metric rmse --max-loss 0.01
+'''
+import os, warnings, sys, time
+warnings.filterwarnings('ignore')
+
+import argparse
+import numpy as np, pandas as pd
+
+sys.path.insert(0, './../../')
+
+import app.src.preprocessing.pipeline as pipeline
+import app.src.model.regressor as regressor
+import app.src.model.compaction as compaction
+import app.src.evaluate as evaluate
+import app.src.utils as utils
+import app.src.artifact_bundle as artifact_bundle
+
+
+train_data_path = "./../data/processed_data/training/"
+schema_path = "./../data/data_config/"
+artifacts_path = "./../artifacts/"
+compacted_path = "./../artifacts_compacted/"
+# subfolder of the output path the full forest is saved to when compaction replaces it in place
+full_model_dirname = "full_forest"
+
+compaction_report_fname = "compaction_report.json"
+candidates_fname = "compaction_candidates.csv"
+
+
+# get model configuration parameters
+model_cfg = utils.get_model_config()
+
+
+def run_compaction(metric=None, max_loss=None, output_path=None):
+    compaction_cfg = model_cfg["compaction"]
+    metric = metric or compaction_cfg["metric"]
+    max_loss = compaction_cfg["max_loss"] if max_loss is None else max_loss
+    output_path = output_path or compacted_path
+
+    data_schema = utils.get_data_schema(schema_path)
+    target_field = data_schema["inputDatasets"]["regressionBaseMainInput"]["targetField"]
+    train_data = utils.get_data(train_data_path, data_schema)
+    inputs_pipeline = pipeline.load_preprocessor(artifacts_path)
+    model = regressor.load_model(artifacts_path)
+    train_X = pipeline.to_feature_matrix(inputs_pipeline.transform(train_data.loc[:, train_data.columns != target_field]))
+    train_y = train_data[target_field]
+
+    print("Scoring compaction candidates ...")
+    score_fn = lambda y, predictions: evaluate.get_scores(pd.DataFrame({ target_field: y }), predictions, data_schema)
+    candidates, prune_order = compaction.get_compaction_candidates(
+        model, train_X, train_y, score_fn, compaction_cfg["tree_fractions"], compaction_cfg["depth_caps"],
+        max_rows=compaction_cfg["max_rows"])
+    baseline = next(c for c in candidates if c["n_trees"] == len(prune_order) and c["max_depth"] is None and not c["quantized"])
+    allowed = baseline[metric] * (1 + max_loss)
+    best = min([c for c in candidates if c[metric] <= allowed], key=lambda c: c["flat_bytes"])
+    print(f"Full forest: {metric} {baseline[metric]}, allowed {allowed:.4f}")
+    print(f"Chosen: {best['n_trees']} trees, max_depth {best['max_depth']}, quantized {best['quantized']}, {metric} {best[metric]}")
+
+    sample_X = train_X[:1000]
+    before = measure_model(artifacts_path, sample_X)
+    compacted = compaction.compact_model(model, prune_order, best["n_trees"], best["max_depth"], best["quantized"])
+    os.makedirs(output_path, exist_ok=True)
+    if os.path.abspath(output_path) == os.path.abspath(artifacts_path):
+        full_model_path = os.path.join(output_path, full_model_dirname)
+        os.makedirs(full_model_path, exist_ok=True)
+        regressor.save_model(model=model, model_path=full_model_path)
+        print(f"Saved the full forest to {full_model_path}")
+    else:
+        pipeline.save_preprocessor(inputs_pipeline, output_path)
+    regressor.save_model(model=compacted, model_path=output_path)
+    artifact_bundle.write_manifest(output_path, data_schema)
+    after = measure_model(output_path, sample_X)
+
+    report = pd.DataFrame({ "before": before, "after": after })
+    report["ratio"] = report["after"] / report["before"]
+    print(report.round(4).to_string())
+    utils.save_json(os.path.join(output_path, compaction_report_fname), {
+        "metric": metric, "max_loss": max_loss, "baseline": baseline, "chosen": best,
+        "before": before, "after": after })
+    utils.save_dataframe(pd.DataFrame(candidates), output_path, candidates_fname)
+
+
+
+def measure_model(model_path, sample_X, repeats=50):
+    ''' Size on disk, load time and prediction latency of the model saved in model_path, both as the
+    pickle (model.save) and as the memory-mapped flat forest (model_flat/). '''
+    flat_path = os.path.join(model_path, regressor.flat_model_dirname)
+    measures = {
+        "pickle_mb": os.path.getsize(os.path.join(model_path, regressor.model_fname)) / 2**20,
+        "flat_mb": sum(os.path.getsize(os.path.join(flat_path, f)) for f in os.listdir(flat_path)) / 2**20,
+    }
+    for name, mmap in [("pickle", False), ("flat", True)]:
+        start = time.perf_counter()
+        model = regressor.load_model(model_path, mmap=mmap)
+        measures[f"{name}_load_s"] = time.perf_counter() - start
+        latencies = []
+        for i in range(repeats):
+            start = time.perf_counter()
+            model.predict(sample_X[i:i + 1])
+            latencies.append(time.perf_counter() - start)
+        measures[f"{name}_p50_ms_1_row"] = float(np.median(latencies)) * 1000
+        start = time.perf_counter()
+        model.predict(sample_X)
+        measures[f"{name}_ms_{len(sample_X)}_rows"] = (time.perf_counter() - start) * 1000
+    return measures
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--metric", choices=["rmse", "nmae"], default=None, help="score the loss budget applies to (default: from model_config.json)")
+    parser.add_argument("--max-loss", type=float, default=None,
+                        help="allowed relative increase of the metric, e.g. 0.01 for 1%% (default: from model_config.json)")
+    parser.add_argument("--output-path", default=None, help="where to write the compacted bundle (default: ../artifacts_compacted/)")
+    args = parser.parse_args()
+
+    run_compaction(metric=args.metric, max_loss=args.max_loss, output_path=args.output_path)
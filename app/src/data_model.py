@@ -9,6 +9,16 @@ POLISH_LIST = [ 'EX', 'G', 'ID', 'VG',  ]
 SYMMETRY_LIST = [ 'EX', 'G', 'ID', 'VG',  ]
 REPORT_LIST = [ 'AGSL', 'GIA', ]
 
+# allowed values of each categorical field, by field alias (used by serving/validation.py)
+CATEGORY_LISTS = {
+    "Cut": CUT_LIST,
+    "Color": COLOR_LIST,
+    "Clarity": CLARITY_LIST,
+    "Polish": POLISH_LIST,
+    "Symmetry": SYMMETRY_LIST,
+    "Report": REPORT_LIST,
+}
+
 def validate_v_in_list(var, v, lst): 
     if v not in lst:            
         raise ValueError(f'Variable {var} must have one of these values:  {lst}')
@@ -2,6 +2,7 @@
 
 import os, warnings, sys
 import json
+import argparse
 import numpy as np
 from sklearn.metrics import mean_squared_error, mean_absolute_error
 from scipy.stats import linregress
@@ -13,6 +14,7 @@ sys.path.insert(0, './../../')
 import app.src.preprocessing.pipeline as pipeline
 import app.src.model.regressor as regressor
 import app.src.utils as utils
+import app.src.instrumentation as instrumentation
 
 
 test_data_path = "./../data/processed_data/testing/"
@@ -21,36 +23,47 @@ artifacts_path = "./../artifacts/"
 results_path = "./../results/"
 
 results_fname = "results.json"
+predictions_fname = "predictions"
 
 
-def run_evaluation(): 
+def run_evaluation(data_format=None, predictions_format="csv", intervals=False, quantiles=regressor.default_quantiles): 
         
-    # read train_data
-    test_data = utils.get_data(test_data_path)
-    # print(test_data.shape)
-    
     # get data schema
     data_schema = utils.get_data_schema(schema_path)
+    
+    # read test data
+    test_data = utils.get_data(test_data_path, data_schema, verbose=True, file_format=data_format)
+    # print(test_data.shape)
 
     # load preprocessors
     inputs_pipeline = pipeline.load_preprocessor(artifacts_path)
     
     # preprocess test inputs
-    processed_test_inputs = inputs_pipeline.transform(test_data)
+    processed_test_inputs = pipeline.to_feature_matrix(instrumentation.transform(inputs_pipeline, test_data))
     
     # load model 
     model = regressor.load_model(artifacts_path)
     
-    # make predictions
-    predictions = model.predict(processed_test_inputs)    
+    # make predictions, with the spread of the tree predictions if asked for 
+    if intervals: 
+        outputs = model.predict_with_uncertainty(processed_test_inputs, quantiles=quantiles)
+        predictions = outputs["prediction"]
+    else: 
+        predictions = model.predict(processed_test_inputs)    
     
     scores = get_scores(test_data, predictions, data_schema)
+    if intervals: 
+        scores.update(get_interval_scores(test_data, outputs, data_schema))
     print(scores)
     with open(os.path.join(results_path, results_fname), "w") as outfile:
         json.dump(scores, outfile, indent=2)
     
     test_data["predictions"] = predictions
-    test_data.to_csv(f"{results_path}predictions.csv", index=False)
+    if intervals: 
+        test_data["predictions_std"] = outputs["std"]
+        for q, values in outputs["quantiles"].items(): 
+            test_data[f"predictions_q{100 * q:g}"] = values
+    utils.save_dataframe(test_data, results_path, f"{predictions_fname}.{predictions_format}")
 
 
 
@@ -76,6 +89,37 @@ def get_scores(test_data, predictions, data_schema):
 
 
 
+def get_interval_scores(test_data, outputs, data_schema): 
+    '''Share of actuals within [lowest, highest] quantile of the tree predictions, and the mean width of that interval.'''
+    Y = test_data[data_schema["inputDatasets"]["regressionBaseMainInput"]["targetField"]].to_numpy()
+    quantiles = sorted(outputs["quantiles"])
+    if len(quantiles) < 2: 
+        return {}
+    lower, upper = outputs["quantiles"][quantiles[0]], outputs["quantiles"][quantiles[-1]]
+    return {
+        f"interval_coverage_q{100 * quantiles[0]:g}_q{100 * quantiles[-1]:g}": np.round(np.mean((Y >= lower) & (Y <= upper)), 4), 
+        "interval_mean_width": np.round(np.mean(upper - lower), 4), 
+    }
+
+
+
 if __name__ == "__main__": 
     
-    run_evaluation()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-format", choices=["csv", "parquet", "feather"], default=None, 
+                        help="only read test files of this format (default: all supported files)")
+    parser.add_argument("--predictions-format", choices=["csv", "parquet", "feather"], default="csv")
+    parser.add_argument("--intervals", action="store_true", 
+                        help="also save the std and quantiles of the tree predictions, and score the interval coverage")
+    parser.add_argument("--quantiles", type=float, nargs="+", default=regressor.default_quantiles)
+    parser.add_argument("--profile", action="store_true", 
+                        help="time each pre-processing step and the model (with allocations) and print a summary")
+    args = parser.parse_args()
+    
+    if args.profile: 
+        instrumentation.enable(allocations=True)
+    run_evaluation(data_format=args.data_format, predictions_format=args.predictions_format, 
+                   intervals=args.intervals, quantiles=args.quantiles)
+    if args.profile: 
+        print("Instrumentation summary:")
+        print(instrumentation.summary())
@@ -0,0 +1,183 @@
+'''
+Opt-in timing and allocation instrumentation of the pre-processing steps and of Regressor.predict.
+Nothing is recorded until enable() is called; when disabled, stage() returns a shared no-op context
+manager and transform()/fit_transform() call the pipeline directly, so the overhead is one function call.
+Each stage aggregates its wall times (and, with track_allocations, the peak bytes allocated during the
+stage, from tracemalloc) into histograms, exposed in Prometheus text format by to_prometheus() and as a
+table by summary().
+'''
+import threading
+import time
+import tracemalloc
+from contextlib import nullcontext
+
+
+# upper bounds of the histogram buckets; values above the last bound only count in +Inf
+SECONDS_BUCKETS = [1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0]
+BYTES_BUCKETS = [2**10, 2**12, 2**14, 2**16, 2**18, 2**20, 2**22, 2**24, 2**26, 2**28, 2**30]
+
+enabled = False
+track_allocations = False
+stages = {}
+lock = threading.Lock()
+no_op = nullcontext()
+
+
+
+class Histogram():
+    ''' Cumulative histogram with Prometheus semantics (bucket i counts the values <= bounds[i]). '''
+    def __init__(self, bounds) -> None:
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+
+    def observe(self, value):
+        for i, bound in enumerate(self.bounds):
+            if value <= bound: self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+
+
+class StageTimer():
+    ''' Context manager recording one call of a stage. With allocation tracking, the tracemalloc peak is
+    reset on entry, so calls running concurrently in other threads are counted in each other's peaks. '''
+    def __init__(self, name) -> None:
+        self.name = name
+
+
+    def __enter__(self):
+        if track_allocations:
+            tracemalloc.reset_peak()
+            self.start_bytes = tracemalloc.get_traced_memory()[0]
+        self.start = time.perf_counter()
+        return self
+
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        allocated = tracemalloc.get_traced_memory()[1] - self.start_bytes if track_allocations else None
+        with lock:
+            if self.name not in stages:
+                stages[self.name] = { "seconds": Histogram(SECONDS_BUCKETS), "allocated_bytes": Histogram(BYTES_BUCKETS) }
+            stages[self.name]["seconds"].observe(seconds)
+            if allocated is not None:
+                stages[self.name]["allocated_bytes"].observe(allocated)
+        return False
+
+
+
+def enable(allocations=False):
+    global enabled, track_allocations
+    enabled = True
+    track_allocations = allocations
+    if allocations and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    global enabled, track_allocations
+    if track_allocations and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    enabled = False
+    track_allocations = False
+
+
+def reset():
+    with lock:
+        stages.clear()
+
+
+def stage(name):
+    ''' Context manager timing the enclosed code as the given stage (a no-op when disabled). '''
+    return StageTimer(name) if enabled else no_op
+
+
+def observe(name, seconds):
+    ''' Record a duration measured elsewhere (e.g. a queue wait) as one call of the given stage. '''
+    if not enabled:
+        return
+    with lock:
+        if name not in stages:
+            stages[name] = { "seconds": Histogram(SECONDS_BUCKETS), "allocated_bytes": Histogram(BYTES_BUCKETS) }
+        stages[name]["seconds"].observe(seconds)
+
+
+def transform(inputs_pipeline, data):
+    ''' inputs_pipeline.transform(data), timing each step as stage "preprocess.<step name>" when enabled. '''
+    if not enabled:
+        return inputs_pipeline.transform(data)
+    for name, step in inputs_pipeline.steps:
+        with StageTimer(f"preprocess.{name}"):
+            data = step.transform(data)
+    return data
+
+
+def fit_transform(inputs_pipeline, data, y=None):
+    ''' inputs_pipeline.fit_transform(data), timing each step as stage "fit_preprocess.<step name>" when enabled. '''
+    if not enabled:
+        return inputs_pipeline.fit_transform(data, y)
+    for name, step in inputs_pipeline.steps:
+        with StageTimer(f"fit_preprocess.{name}"):
+            data = step.fit_transform(data, y)
+    return data
+
+
+def to_prometheus():
+    ''' All stage histograms in Prometheus text exposition format. '''
+    lines = []
+    for metric, key, help_text in [
+        ("pipeline_stage_seconds", "seconds", "Wall time of a pre-processing step or model call."),
+        ("pipeline_stage_allocated_bytes", "allocated_bytes", "Peak bytes allocated during a pre-processing step or model call."),
+    ]:
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} histogram"]
+        with lock:
+            for name, histograms in stages.items():
+                histogram = histograms[key]
+                if histogram.count == 0: continue
+                for bound, count in zip(histogram.bounds, histogram.counts):
+                    lines.append(f'{metric}_bucket{{stage="{name}",le="{bound:g}"}} {count}')
+                lines.append(f'{metric}_bucket{{stage="{name}",le="+Inf"}} {histogram.count}')
+                lines.append(f'{metric}_sum{{stage="{name}"}} {histogram.sum:g}')
+                lines.append(f'{metric}_count{{stage="{name}"}} {histogram.count}')
+    return "\n".join(lines) + "\n"
+
+
+def merge_prometheus(texts):
+    ''' Sum the samples of several Prometheus text expositions (e.g. one per worker process) by metric name and
+    labels. The counters and histograms add up across processes, and so do the gauges exposed here (queue depths). '''
+    families = {}
+    family = None
+    for text in texts:
+        for line in text.splitlines():
+            if not line: continue
+            if line.startswith("#"):
+                # "# HELP <name> ..." and "# TYPE <name> ..." start a metric family
+                family = families.setdefault(line.split()[2], { "comments": [], "samples": {} })
+                if line not in family["comments"]: family["comments"].append(line)
+                continue
+            key, value = line.rsplit(" ", 1)
+            family["samples"][key] = family["samples"].get(key, 0.0) + float(value)
+    lines = []
+    for family in families.values():
+        lines += family["comments"]
+        for key, value in family["samples"].items():
+            lines.append(f"{key} {int(value) if value.is_integer() else repr(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def summary():
+    ''' Table of calls, total/mean/max time, share of the total time and mean allocated MB per stage. '''
+    with lock:
+        rows = [(name, h["seconds"], h["allocated_bytes"]) for name, h in stages.items()]
+    total = sum(seconds.sum for _, seconds, _ in rows) or 1.0
+    lines = [f"{'stage':<40}{'calls':>8}{'total s':>10}{'mean ms':>10}{'max ms':>10}{'share':>8}{'alloc MB':>10}"]
+    for name, seconds, allocated in rows:
+        alloc = f"{allocated.sum / allocated.count / 2**20:>10.2f}" if allocated.count else f"{'-':>10}"
+        lines.append(f"{name:<40}{seconds.count:>8}{seconds.sum:>10.3f}{1000 * seconds.sum / seconds.count:>10.3f}"
+                     f"{1000 * seconds.max:>10.3f}{seconds.sum / total:>8.1%}{alloc}")
+    return "\n".join(lines)
@@ -0,0 +1,218 @@
+import numpy as np
+import copy
+
+# the helpers sklearn itself uses to recreate each tree's bootstrap sample for out-of-bag scoring
+from sklearn.ensemble._forest import _generate_sample_indices, _get_n_samples_bootstrap
+from sklearn.tree._tree import Tree, TREE_LEAF, TREE_UNDEFINED
+
+
+FLOAT16_MAX = float(np.finfo(np.float16).max)
+
+
+
+def get_oob_mask(forest, n_rows, rows):
+    ''' Boolean array of shape (n_trees, len(rows)), True where the row is out of bag for the tree.
+    Only valid for the data the forest was fitted on (in one fit, not grown or fitted on partitions). '''
+    n_samples_bootstrap = _get_n_samples_bootstrap(n_rows, forest.max_samples)
+    mask = np.ones((len(forest.estimators_), len(rows)), dtype=bool)
+    for i, tree in enumerate(forest.estimators_):
+        in_bag = np.zeros(n_rows, dtype=bool)
+        in_bag[_generate_sample_indices(tree.random_state, n_rows, n_samples_bootstrap)] = True
+        mask[i] = ~in_bag[rows]
+    return mask
+
+
+def predict_per_tree(estimators, X):
+    X = np.asarray(X, dtype=np.float32)
+    return np.stack([tree.predict(X) for tree in estimators])
+
+
+def get_oob_predictions(tree_predictions, oob_mask, tree_ids, fill_value):
+    ''' Mean out-of-bag prediction of the trees tree_ids for every row; rows that are in the bag of all of
+    them get fill_value (the mean target), so a subset of trees that covers fewer rows is penalised. '''
+    oob_sum = (tree_predictions[tree_ids] * oob_mask[tree_ids]).sum(axis=0)
+    oob_count = oob_mask[tree_ids].sum(axis=0)
+    return np.where(oob_count > 0, oob_sum / np.maximum(oob_count, 1), fill_value)
+
+
+def get_prune_order(tree_predictions, oob_mask, y):
+    ''' Order the trees by greedy forward selection: each step adds the tree that most reduces the squared
+    error of the out-of-bag prediction of the selected trees. The first k trees of the order are the
+    pruned forest of size k. '''
+    y = np.asarray(y, dtype=np.float64)
+    fill_value = y.mean()
+    masked = tree_predictions * oob_mask
+    oob_sum, oob_count = np.zeros(len(y)), np.zeros(len(y))
+    remaining, order = list(range(len(tree_predictions))), []
+    while remaining:
+        counts = oob_count + oob_mask[remaining]
+        preds = np.where(counts > 0, (oob_sum + masked[remaining]) / np.maximum(counts, 1), fill_value)
+        best = int(np.argmin(((preds - y) ** 2).sum(axis=1)))
+        tree_id = remaining.pop(best)
+        order.append(tree_id)
+        oob_sum += masked[tree_id]
+        oob_count += oob_mask[tree_id]
+    return np.array(order)
+
+
+def cap_tree_depth(estimator, max_depth):
+    ''' Copy of a fitted DecisionTreeRegressor with all nodes below max_depth removed. Nodes at max_depth
+    become leaves predicting their stored value (the mean target of their samples). '''
+    state = estimator.tree_.__getstate__()
+    nodes, values = state["nodes"], state["values"]
+    depth = get_node_depths(nodes)
+    if depth.max() <= max_depth:
+        return copy.deepcopy(estimator)
+
+    keep = depth <= max_depth
+    new_ids = np.cumsum(keep) - 1
+    new_nodes = nodes[keep].copy()
+    new_leaves = (depth[keep] == max_depth) | (new_nodes["left_child"] == TREE_LEAF)
+    for child in ["left_child", "right_child"]:
+        new_nodes[child] = np.where(new_leaves, TREE_LEAF, new_ids[np.maximum(new_nodes[child], 0)])
+    new_nodes["feature"][new_leaves] = TREE_UNDEFINED
+    new_nodes["threshold"][new_leaves] = TREE_UNDEFINED
+
+    tree = Tree(estimator.n_features_in_, np.ones(estimator.n_outputs_, dtype=np.intp), estimator.n_outputs_)
+    tree.__setstate__({ **state, "max_depth": max_depth, "node_count": len(new_nodes),
+                        "nodes": new_nodes, "values": values[keep].copy() })
+    new_estimator = copy.deepcopy(estimator)
+    new_estimator.tree_ = tree
+    new_estimator.max_depth = max_depth
+    return new_estimator
+
+
+def get_node_depths(nodes):
+    depth = np.zeros(len(nodes), dtype=np.int64)
+    level, frontier = 0, np.array([0])
+    while len(frontier):
+        depth[frontier] = level
+        children = np.concatenate([nodes["left_child"][frontier], nodes["right_child"][frontier]])
+        frontier = children[children != TREE_LEAF]
+        level += 1
+    return depth
+
+
+def get_quantization(estimators):
+    ''' 16-bit linear grid spanning the node values of all trees, and float16 thresholds if they all fit. '''
+    values = np.concatenate([tree.tree_.value.ravel() for tree in estimators])
+    thresholds = np.concatenate([tree.tree_.threshold for tree in estimators])
+    value_offset = float(values.min())
+    value_scale = max(float(values.max()) - value_offset, 1e-12) / np.iinfo(np.uint16).max
+    threshold_dtype = "float16" if np.abs(thresholds).max() < FLOAT16_MAX else "float32"
+    return { "value_offset": value_offset, "value_scale": value_scale, "threshold_dtype": threshold_dtype }
+
+
+def quantize_forest(estimators, quantization):
+    ''' Copies of the trees with node values rounded to the quantization grid and, for float16, thresholds
+    rounded to the nearest float16. The sklearn trees then predict exactly what the quantized flat forest does. '''
+    new_estimators = []
+    for estimator in estimators:
+        state = estimator.tree_.__getstate__()
+        nodes, values = state["nodes"].copy(), state["values"]
+        codes = np.rint((values - quantization["value_offset"]) / quantization["value_scale"])
+        values = quantization["value_offset"] + quantization["value_scale"] * codes
+        if quantization["threshold_dtype"] == "float16":
+            nodes["threshold"] = nodes["threshold"].astype(np.float16).astype(np.float64)
+        tree = Tree(estimator.n_features_in_, np.ones(estimator.n_outputs_, dtype=np.intp), estimator.n_outputs_)
+        tree.__setstate__({ **state, "nodes": nodes, "values": values })
+        new_estimator = copy.deepcopy(estimator)
+        new_estimator.tree_ = tree
+        new_estimators.append(new_estimator)
+    return new_estimators
+
+
+def get_flat_size(estimators, quantization=None):
+    ''' Size in bytes of the flat forest (model_flat/) of the given trees: per node an int16 feature,
+    two int32 children, and a float32 threshold and value, or their quantized versions. '''
+    node_bytes = 2 + 8 + 4 + 4
+    if quantization is not None:
+        node_bytes = 2 + 8 + (2 if quantization["threshold_dtype"] == "float16" else 4) + 2
+    return sum(tree.tree_.node_count for tree in estimators) * node_bytes
+
+
+def build_compacted_model(model, estimators, max_depth=None, quantization=None):
+    ''' New Regressor with the given (pruned, capped and/or quantized) trees of model.
+    The out-of-bag estimates of the original forest are dropped since they no longer apply, and the new
+    model's fit history says it was compacted. '''
+    compacted = copy.copy(model)
+    compacted.model = copy.copy(model.model)
+    forest = compacted.model
+    forest.estimators_ = list(estimators)
+    forest.set_params(n_estimators=len(estimators))
+    for attr in ["oob_score_", "oob_prediction_"]:
+        if hasattr(forest, attr): delattr(forest, attr)
+    if max_depth is not None:
+        forest.set_params(max_depth=max_depth)
+        compacted.max_depth = max_depth
+    compacted.n_estimators = len(estimators)
+    compacted.quantization = quantization
+    # its trees were chosen on the out-of-bag rows, so they cannot be scored (or compacted) on them again
+    compacted.fit_history = { "method": "compacted", "data": None }
+    compacted.flat_forest = None
+    if compacted.use_flat_forest:
+        compacted.enable_flat_forest()
+    return compacted
+
+
+def get_compaction_candidates(model, train_X, train_y, score_fn, tree_fractions, depth_caps, max_rows=10000, seed=42):
+    ''' Score every combination of tree count (as a fraction of the forest, keeping the trees in greedy
+    pruning order), depth cap (None for no cap) and quantization on out-of-bag predictions.
+    score_fn(y, predictions) returns a dict of scores. train_X/train_y must be the data the model was
+    fitted on, in one fit (a ValueError is raised otherwise: the out-of-bag rows of a grown or sharded forest
+    cannot be recreated). At most max_rows of its rows are used, half of them to choose the prune order and
+    the other half to score the candidates, so the scores are not biased by the selection.
+    The full forest (all trees, no depth cap, not quantized) is always scored, whatever tree_fractions and depth_caps.
+    Returns a list of dicts with the settings, the flat size in bytes and the scores, and the prune order. '''
+    if not model.is_single_fit_on(train_X, train_y):
+        fitted_as = {
+            None: "saved without its fit history", "fit": "fitted on other data",
+            "grown": "grown by incremental training", "sharded": "merged from sharded fits",
+            "compacted": "compacted already (compact the original forest instead)",
+        }.get((model.fit_history or {}).get("method"), "not fitted in one fit")
+        raise ValueError(f"Out-of-bag rows can only be recreated for a forest fitted in one fit on the training data, "
+                         f"but the model was {fitted_as}. Retrain it with train.py (without --shards) before compacting it.")
+    forest = model.model
+    n_rows = len(train_X)
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(n_rows, size=min(max_rows, n_rows), replace=False)
+    select_rows, rows = np.sort(rows[:len(rows) // 2]), np.sort(rows[len(rows) // 2:])
+    train_X = np.asarray(train_X, dtype=np.float32)
+    train_y = np.ravel(np.asarray(train_y, dtype=np.float64))
+
+    prune_order = get_prune_order(predict_per_tree(forest.estimators_, train_X[select_rows]),
+                                  get_oob_mask(forest, n_rows, select_rows), train_y[select_rows])
+    n_trees_list = sorted({ max(1, int(round(f * len(prune_order)))) for f in tree_fractions } | { len(prune_order) }, reverse=True)
+    depth_caps = [None] + [max_depth for max_depth in dict.fromkeys(depth_caps) if max_depth is not None]
+
+    X, y = train_X[rows], train_y[rows]
+    oob_mask = get_oob_mask(forest, n_rows, rows)
+    tree_predictions = predict_per_tree(forest.estimators_, X)
+    candidates = []
+    for max_depth in depth_caps:
+        capped = forest.estimators_ if max_depth is None else [cap_tree_depth(tree, max_depth) for tree in forest.estimators_]
+        for quantized in [False, True]:
+            quantization = get_quantization(capped) if quantized else None
+            estimators = quantize_forest(capped, quantization) if quantized else capped
+            predictions = predict_per_tree(estimators, X) if (quantized or max_depth is not None) else tree_predictions
+            for n_trees in n_trees_list:
+                tree_ids = prune_order[:n_trees]
+                oob_predictions = get_oob_predictions(predictions, oob_mask, tree_ids, y.mean())
+                candidates.append({
+                    "n_trees": n_trees, "max_depth": max_depth, "quantized": quantized,
+                    "flat_bytes": get_flat_size([estimators[i] for i in tree_ids], quantization),
+                    **score_fn(y, oob_predictions) })
+    return candidates, prune_order
+
+
+def compact_model(model, prune_order, n_trees, max_depth=None, quantized=False):
+    ''' Build the compacted Regressor for one of the candidates of get_compaction_candidates
+    (the value grid spans all capped trees, as it did when the candidate was scored). '''
+    estimators = model.model.estimators_
+    if max_depth is not None:
+        estimators = [cap_tree_depth(tree, max_depth) for tree in estimators]
+    quantization = get_quantization(estimators) if quantized else None
+    estimators = [estimators[i] for i in prune_order[:n_trees]]
+    if quantized:
+        estimators = quantize_forest(estimators, quantization)
+    return build_compacted_model(model, estimators, max_depth, quantization)
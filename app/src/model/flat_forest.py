@@ -0,0 +1,192 @@
+import numpy as np
+import json
+import os
+
+from app.src.utils import atomic_path
+
+
+array_names = ["feature", "threshold", "children", "value", "roots"]
+meta_fname = "flat_forest.json"
+
+# rows x trees node indices evaluated at once; bounds the size of the traversal temporaries
+MAX_CHUNK_ELEMENTS = 1 << 21
+
+
+
+class FlatForest():
+    ''' Array-backed copy of a fitted sklearn RandomForestRegressor (single output).
+    The nodes of all trees are stored in contiguous arrays indexed by a global node id:
+        - feature: split feature index (int16 when the number of features allows it)
+        - threshold: split threshold as float32, rounded down so that the float32 comparison
+            x <= threshold gives the same split as sklearn's comparison against the float64 threshold
+        - children: global ids of the (left, right) child nodes, shape (n_nodes, 2). Leaves point to 
+            themselves, so a leaf is a fixed point of the traversal.
+        - value: leaf (and internal node) values, or their uint16 codes on the grid
+            value_offset + code * value_scale for forests quantized by compaction.quantize_forest
+        - roots: global id of the root node of each tree
+    predict() walks all trees level by level, for all rows at once.
+    '''
+    def __init__(self, feature, threshold, children, value, roots, max_depth, n_features, value_offset=None, value_scale=None):
+        self.feature = feature
+        self.threshold = threshold
+        self.children = children
+        self.value = value
+        self.roots = roots
+        self.max_depth = int(max_depth)
+        self.n_features = int(n_features)
+        self.value_offset = value_offset
+        self.value_scale = value_scale
+
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+
+    @property
+    def n_nodes(self):
+        return len(self.feature)
+
+
+    @property
+    def left(self):
+        return self.children[:, 0]
+
+
+    @property
+    def right(self):
+        return self.children[:, 1]
+
+
+    @property
+    def is_quantized(self):
+        return self.value_scale is not None
+
+
+    @classmethod
+    def from_sklearn(cls, forest, value_dtype=np.float32, quantization=None):
+        ''' With quantization (see compaction.quantize_forest), the forest's values and thresholds must already
+        be on the quantization grid; values are then stored as uint16 codes (and thresholds as float16 if so quantized).
+        A ValueError is raised if a value is off the grid or outside its range (e.g. of a tree added after quantizing). '''
+        trees = [estimator.tree_ for estimator in forest.estimators_]
+        if trees[0].n_outputs != 1:
+            raise ValueError("FlatForest only supports single-output forests.")
+        n_nodes = sum(tree.node_count for tree in trees)
+        feature_dtype = np.int16 if forest.n_features_in_ < np.iinfo(np.int16).max else np.int32
+        # node ids are doubled to index the flattened children array
+        index_dtype = np.int32 if 2 * n_nodes < np.iinfo(np.int32).max else np.int64
+
+        feature = np.empty(n_nodes, dtype=feature_dtype)
+        threshold = np.empty(n_nodes, dtype=np.float32)
+        children = np.empty((n_nodes, 2), dtype=index_dtype)
+        value = np.empty(n_nodes, dtype=np.float64 if quantization is not None else value_dtype)
+        roots = np.empty(len(trees), dtype=index_dtype)
+
+        offset = 0
+        for i, tree in enumerate(trees):
+            nodes = np.arange(offset, offset + tree.node_count)
+            is_leaf = tree.children_left == -1
+            roots[i] = offset
+            feature[nodes] = np.where(is_leaf, 0, tree.feature)
+            threshold[nodes] = round_down_to_float32(tree.threshold)
+            children[nodes, 0] = np.where(is_leaf, nodes, tree.children_left + offset)
+            children[nodes, 1] = np.where(is_leaf, nodes, tree.children_right + offset)
+            value[nodes] = tree.value[:, 0, 0]
+            offset += tree.node_count
+
+        value_offset, value_scale = None, None
+        if quantization is not None:
+            value_offset, value_scale = quantization["value_offset"], quantization["value_scale"]
+            codes = np.rint((value - value_offset) / value_scale)
+            if codes.min() < 0 or codes.max() > np.iinfo(np.uint16).max:
+                raise ValueError("Node values are outside the quantization grid's range; quantize all trees of the forest.")
+            if np.abs(value_offset + value_scale * codes - value).max() > 1e-3 * value_scale:
+                raise ValueError("Node values are not on the quantization grid; quantize all trees of the forest.")
+            value = codes.astype(np.uint16)
+            if quantization["threshold_dtype"] == "float16":
+                threshold = threshold.astype(np.float16)
+
+        return cls(
+            feature=feature,
+            threshold=threshold,
+            children=children,
+            value=value,
+            roots=roots,
+            max_depth=max(tree.max_depth for tree in trees),
+            n_features=forest.n_features_in_,
+            value_offset=value_offset,
+            value_scale=value_scale,
+        )
+
+
+    def save(self, dir_path):
+        ''' Save as one uncompressed .npy file per array plus a small json file, so load() can memory-map the arrays.
+        Each file is replaced atomically, so processes that memory-mapped the old files keep reading those. '''
+        os.makedirs(dir_path, exist_ok=True)
+        for name in array_names:
+            with atomic_path(os.path.join(dir_path, name + ".npy")) as tmp_path:
+                np.save(tmp_path, getattr(self, name))
+        with atomic_path(os.path.join(dir_path, meta_fname)) as tmp_path, open(tmp_path, "w") as f:
+            json.dump({"max_depth": self.max_depth, "n_features": self.n_features,
+                       "value_offset": self.value_offset, "value_scale": self.value_scale}, f)
+
+
+    @classmethod
+    def load(cls, dir_path, mmap_mode='r'):
+        ''' Load a saved flat forest. With mmap_mode='r' the arrays are read-only memory maps of the files,
+        so loading is near-instant and all processes that load the same files share one page-cached copy. '''
+        with open(os.path.join(dir_path, meta_fname)) as f:
+            meta = json.load(f)
+        arrays = { name: np.load(os.path.join(dir_path, name + ".npy"), mmap_mode=mmap_mode) for name in array_names }
+        return cls(**arrays, **meta)
+
+
+    def apply(self, X):
+        ''' Return the global leaf id reached by each row in each tree, shape (n_rows, n_trees). '''
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self.n_features:
+            raise ValueError(f"Expected input of shape (n_rows, {self.n_features}), got {X.shape}.")
+        leaves = np.empty((X.shape[0], self.n_trees), dtype=self.roots.dtype)
+        chunk_size = max(1, MAX_CHUNK_ELEMENTS // self.n_trees)
+        for start in range(0, X.shape[0], chunk_size):
+            X_chunk = X[start:start + chunk_size]
+            leaves[start:start + chunk_size] = self._apply_chunk(X_chunk)
+        return leaves
+
+
+    def _apply_chunk(self, X):
+        # index into the flattened rows and children arrays: one gather per array and level
+        X_flat = X.ravel()
+        row_offsets = (np.arange(X.shape[0], dtype=np.intp) * X.shape[1])[:, None]
+        children_flat = self.children.ravel()
+        nodes = np.broadcast_to(self.roots, (X.shape[0], self.n_trees)).copy()
+        for _ in range(self.max_depth):
+            go_right = X_flat[row_offsets + self.feature[nodes]] > self.threshold[nodes]
+            nodes = children_flat[2 * nodes + go_right]
+        return nodes
+
+
+    def predict_per_tree(self, X):
+        ''' Return the prediction of every tree for every row, shape (n_rows, n_trees). '''
+        if self.is_quantized:
+            return self.value_offset + self.value_scale * self.value[self.apply(X)].astype(np.float64)
+        return self.value[self.apply(X)]
+
+
+    def predict(self, X):
+        if self.is_quantized:
+            # the mean of the codes is dequantized once per row instead of once per tree
+            return self.value_offset + self.value_scale * self.value[self.apply(X)].mean(axis=1, dtype=np.float64)
+        return self.predict_per_tree(X).mean(axis=1, dtype=np.float64)
+
+
+
+def round_down_to_float32(values):
+    ''' Cast float64 values to float32, rounding towards -inf instead of to nearest.
+    For a float32 x and a float64 t, x <= t holds exactly when x <= round_down_to_float32(t).
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    rounded = values.astype(np.float32)
+    too_high = rounded.astype(np.float64) > values
+    rounded[too_high] = np.nextafter(rounded[too_high], np.float32(-np.inf))
+    return rounded
@@ -0,0 +1,88 @@
+import numpy as np, pandas as pd
+import os, time, math, itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import app.src.model.regressor as regressor
+import app.src.utils as utils
+
+
+best_params_fname = "hyperparameters.json"
+trials_fname = "tuning_trials.csv"
+
+# training data, set once per worker process by init_worker
+train_X, train_y = None, None
+
+
+def init_worker(X, y):
+    global train_X, train_y
+    train_X, train_y = X, y
+
+
+def evaluate_candidate(params, n_estimators):
+    ''' Fit one candidate with n_estimators trees on a single core and return its out-of-bag RMSE and fit time. '''
+    start = time.perf_counter()
+    model = regressor.Regressor(**params, n_estimators=n_estimators, n_jobs=1)
+    model.fit(train_X, train_y)
+    return get_oob_rmse(model.model, train_y), time.perf_counter() - start
+
+
+def get_oob_rmse(forest, y):
+    y = np.ravel(np.asarray(y, dtype=np.float64))
+    return float(np.sqrt(np.mean((np.ravel(forest.oob_prediction_) - y) ** 2)))
+
+
+def get_candidates(search_space, n_features, num_candidates, seed=42):
+    ''' Sample up to num_candidates distinct configurations from the grid in search_space.
+    max_features_frac is turned into the number of features to consider at each split. '''
+    names = list(search_space)
+    candidates = []
+    for values in itertools.product(*[search_space[name] for name in names]):
+        params = dict(zip(names, values))
+        params["max_features"] = max(1, int(round(params.pop("max_features_frac") * n_features)))
+        if params not in candidates: candidates.append(params)
+    rng = np.random.default_rng(seed)
+    chosen = rng.choice(len(candidates), size=min(num_candidates, len(candidates)), replace=False)
+    return [candidates[i] for i in sorted(chosen)]
+
+
+def get_rungs(min_trees, max_trees, halving_factor):
+    ''' Tree counts of the successive-halving rounds, e.g. 25, 75, 225, 250 for min 25, max 250 and factor 3. '''
+    rungs, n_trees = [], min_trees
+    while n_trees < max_trees:
+        rungs.append(n_trees)
+        n_trees *= halving_factor
+    return rungs + [max_trees]
+
+
+def tune_hyperparameters(train_X, train_y, tuning_cfg, artifacts_path, n_workers=None):
+    ''' Successive halving on the number of trees, scored by out-of-bag RMSE (no refits for validation).
+    All candidates are fitted with the smallest tree count; the best 1/halving_factor of them move on to the
+    next, larger tree count, until one candidate is left or the max tree count is reached. Candidates of a
+    round are fitted in parallel in a process pool.
+    Writes the best configuration (with n_estimators = max_trees) and a log of all trials into artifacts_path
+    and returns the best configuration. '''
+    candidates = get_candidates(tuning_cfg["search_space"], train_X.shape[1], tuning_cfg["num_candidates"])
+    rungs = get_rungs(tuning_cfg["min_trees"], tuning_cfg["max_trees"], tuning_cfg["halving_factor"])
+    candidate_ids = list(range(len(candidates)))
+    trials = []
+
+    with ProcessPoolExecutor(max_workers=n_workers or os.cpu_count(), initializer=init_worker, initargs=(train_X, train_y)) as executor:
+        for rung, n_trees in enumerate(rungs):
+            results = list(executor.map(evaluate_candidate, [candidates[i] for i in candidate_ids], [n_trees] * len(candidate_ids)))
+            for i, (oob_rmse, seconds) in zip(candidate_ids, results):
+                trials.append({ "candidate": i, "rung": rung, "n_estimators": n_trees, **candidates[i],
+                                "oob_rmse": oob_rmse, "fit_seconds": seconds })
+            print(f"Rung {rung}: {len(candidate_ids)} candidate(s) with {n_trees} trees, best OOB RMSE {min(r[0] for r in results):.4f}")
+
+            ranked = [i for _, i in sorted(zip([r[0] for r in results], candidate_ids))]
+            candidate_ids = ranked[:max(1, math.ceil(len(ranked) / tuning_cfg["halving_factor"]))]
+            if len(ranked) == 1: break
+
+    best_id = candidate_ids[0]
+    last_trial = [t for t in trials if t["candidate"] == best_id][-1]
+    best_params = { **candidates[best_id], "n_estimators": tuning_cfg["max_trees"] }
+    utils.save_json(os.path.join(artifacts_path, best_params_fname),
+                    { "hyperparameters": best_params, "oob_rmse": last_trial["oob_rmse"], "evaluated_with_trees": last_trial["n_estimators"] })
+    utils.save_dataframe(pd.DataFrame(trials), artifacts_path, trials_fname)
+    print(f"Best hyper-parameters: {best_params} (OOB RMSE {last_trial['oob_rmse']:.4f})")
+    return best_params
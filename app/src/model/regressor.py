@@ -1,24 +1,52 @@
 #Import required libraries
 import numpy as np, pandas as pd
 import joblib
-import sys
+import sys, json
 import os, warnings
 warnings.filterwarnings('ignore') 
 
 from sklearn.ensemble import RandomForestRegressor
+from joblib import Parallel, delayed
+
+from app.src.model.flat_forest import FlatForest
+import app.src.instrumentation as instrumentation
+import app.src.utils as utils
 
 
 model_fname = "model.save"
+# uncompressed, memory-mappable copy of the fitted forest (see FlatForest.save)
+flat_model_dirname = "model_flat"
+flat_params_fname = "regressor.json"
 MODEL_NAME = "reg_base_random_forest_sklearn"
 
+# random_state of the forest; each grow seeds its new trees from it plus the number of trees grown before
+base_random_state = 42
+hyperparameter_names = ["n_estimators", "max_features", "max_samples", "max_depth", "min_samples_leaf"]
+# quantiles of the tree predictions reported by predict_with_uncertainty by default
+default_quantiles = [0.05, 0.95]
+
 
 
 class Regressor(): 
     
-    def __init__(self, n_estimators = 250, max_features = 3, max_samples = 0.7, **kwargs) -> None:
+    def __init__(self, n_estimators = 250, max_features = 3, max_samples = 0.7, max_depth = None, min_samples_leaf = 1, 
+                 n_jobs = -1, use_flat_forest = False, **kwargs) -> None:
         self.n_estimators = int(n_estimators)
         self.max_features = int(max_features)
         self.max_samples= np.float(max_samples)
+        self.max_depth = int(max_depth) if max_depth is not None else None
+        self.min_samples_leaf = int(min_samples_leaf)
+        self.n_jobs = n_jobs
+        # predict with the array-backed FlatForest instead of sklearn's tree objects
+        self.use_flat_forest = use_flat_forest
+        self.flat_forest = None
+        # value grid and threshold dtype of a forest quantized by compaction.quantize_forest
+        self.quantization = None
+        # how the forest was fitted: "fit" (one fit), "grown" or "sharded", with the signature of the data
+        # of that fit (see get_training_data_signature); None if not fitted or saved before this was recorded
+        self.fit_history = None
+        # number of trees fitted since the last fit, including trees since dropped by grow's sliding window
+        self.total_grown = 0
         
         self.model = self.build_model()
         
@@ -29,28 +57,132 @@ class Regressor():
             n_estimators= self.n_estimators, 
             max_features= self.max_features,
             max_samples= self.max_samples, 
-            random_state=42, 
+            max_depth= self.max_depth, 
+            min_samples_leaf= self.min_samples_leaf, 
+            random_state=base_random_state, 
             bootstrap= True, 
             oob_score= True, 
-            n_jobs=-1, 
+            n_jobs= self.n_jobs, 
             verbose=0
         )
         return model
     
     
     def fit(self, train_X, train_y):        
-                 
-    
+        '''Fit the forest. sklearn fits and predicts on float32 features: a C-contiguous float32 train_X 
+        (see pipeline.to_feature_matrix) is used as is, anything else is copied into one first.'''
         self.model.fit(
                 X = train_X,
                 y = train_y
             )
+        self.fit_history = { "method": "fit", "data": get_training_data_signature(train_X, train_y) }
+        self.total_grown = len(self.model.estimators_)
+        self.flat_forest = None
+        if self.use_flat_forest: 
+            self.enable_flat_forest(X_check=train_X)
+    
+    
+    def grow(self, train_X, train_y, n_new_trees, max_trees=None): 
+        '''Add n_new_trees trees fitted on (train_X, train_y) to the fitted forest (sklearn warm_start). 
+        If max_trees is given, the oldest trees are then dropped so at most max_trees remain (a sliding window). 
+        The out-of-bag estimates are removed since the new and old trees were fitted on different data. 
+        The new trees are seeded from base_random_state plus the number of trees grown so far, since sklearn would 
+        otherwise give them the seeds of earlier trees whenever the window keeps the forest at the same size. 
+        A quantized forest (see compaction.compact_model) cannot be grown, since the new trees would not be on its 
+        value grid: a ValueError is raised.'''
+        check_growable(self)
+        self.model.set_params(warm_start=True, oob_score=False, n_estimators=len(self.model.estimators_) + n_new_trees, 
+                              random_state=base_random_state + self.total_grown)
+        self.model.fit(X = train_X, y = train_y)
+        self.total_grown += n_new_trees
+        if max_trees is not None and len(self.model.estimators_) > max_trees: 
+            self.model.estimators_ = self.model.estimators_[-max_trees:]
+        self.model.set_params(warm_start=False, n_estimators=len(self.model.estimators_))
+        for attr in ["oob_score_", "oob_prediction_"]: 
+            if hasattr(self.model, attr): delattr(self.model, attr)
+        self.n_estimators = self.model.n_estimators
+        self.fit_history = { "method": "grown", "data": None }
+        self.flat_forest = None
+        if self.use_flat_forest: 
+            self.enable_flat_forest(X_check=train_X)
+    
+    
+    def is_single_fit_on(self, train_X, train_y): 
+        '''True if the forest was fitted in one fit (not grown or merged from shards) on exactly this data, 
+        the only case in which the out-of-bag rows of each tree can be recreated from its random_state.'''
+        return (self.fit_history is not None and self.fit_history["method"] == "fit" 
+                and self.fit_history["data"] == get_training_data_signature(train_X, train_y))
     
     
     def predict(self, X,): 
-        preds = self.model.predict(X)
+        '''Mean prediction of the trees; a C-contiguous float32 X is taken without a copy (see fit).'''
+        with instrumentation.stage("model.predict"): 
+            if self.flat_forest is not None: 
+                return self.flat_forest.predict(X)
+            preds = self.model.predict(X)
         return preds 
     
+    
+    def predict_per_tree(self, X): 
+        '''Predictions of every tree for every row, shape (n_rows, n_trees), from one evaluation of the forest: 
+        one vectorized traversal of all trees with the flat forest, else the trees run in parallel threads 
+        (as in sklearn's predict) into one preallocated array.'''
+        if self.flat_forest is not None: 
+            return self.flat_forest.predict_per_tree(X)
+        X = self.model._validate_X_predict(X)
+        estimators = self.model.estimators_
+        tree_predictions = np.empty((X.shape[0], len(estimators)), dtype=np.float64)
+        def predict_tree(i, tree): 
+            tree_predictions[:, i] = tree.predict(X, check_input=False)
+        Parallel(n_jobs=self.model.n_jobs, prefer="threads", require="sharedmem")(
+            delayed(predict_tree)(i, tree) for i, tree in enumerate(estimators))
+        return tree_predictions
+    
+    
+    def predict_with_uncertainty(self, X, quantiles=default_quantiles): 
+        '''Mean prediction plus the spread of the individual tree predictions, at about the cost of predict. 
+        Returns a dict with "prediction" (same as predict), "std" (standard deviation across trees) and 
+        "quantiles" (dict from each quantile in quantiles to that quantile of the tree predictions, per row). 
+        The spread across trees reflects how much the bootstrapped trees disagree; it is not a calibrated 
+        prediction interval (see the coverage reported by evaluate.py --intervals).'''
+        with instrumentation.stage("model.predict_with_uncertainty"): 
+            tree_predictions = self.predict_per_tree(X)
+            prediction = tree_predictions.mean(axis=1, dtype=np.float64)
+            std = tree_predictions.std(axis=1, dtype=np.float64)
+            tree_quantiles = np.quantile(tree_predictions, quantiles, axis=1) if len(quantiles) else []
+        return {
+            "prediction": prediction, 
+            "std": std, 
+            "quantiles": { q: values for q, values in zip(quantiles, tree_quantiles) }, 
+        }
+    
+    
+    def enable_flat_forest(self, X_check=None, n_check=1000, rtol=1e-5): 
+        '''Export the fitted forest to a FlatForest and use it for predict. 
+        The flat forest is checked against self.model.predict on X_check (or, if not given, on n_check 
+        random rows spanning the split thresholds of each feature) and a ValueError is raised on mismatch.'''
+        flat_forest = FlatForest.from_sklearn(self.model, quantization=self.quantization)
+        if X_check is None: 
+            X_check = get_random_rows_for_forest(flat_forest, n_check)
+        X_check = np.asarray(X_check, dtype=np.float32)
+        expected = self.model.predict(X_check)
+        if not np.allclose(flat_forest.predict(X_check), expected, rtol=rtol, atol=0): 
+            raise ValueError("Flat forest predictions do not match the sklearn forest.")
+        self.flat_forest = flat_forest
+        self.use_flat_forest = True
+    
+    
+    def set_n_jobs(self, n_jobs): 
+        '''Set the number of threads the sklearn forest uses to predict.'''
+        self.n_jobs = n_jobs
+        if self.model is not None: 
+            self.model.set_params(n_jobs=n_jobs)
+    
+    
+    def disable_flat_forest(self): 
+        self.flat_forest = None
+        self.use_flat_forest = False
+    
 
     def summary(self):
         self.model.get_params()
@@ -63,19 +195,68 @@ class Regressor():
 
     
     def save(self, model_path): 
-        joblib.dump(self, os.path.join(model_path, model_fname), compress=4)
+        with utils.atomic_path(os.path.join(model_path, model_fname)) as tmp_path: 
+            joblib.dump(self, tmp_path, **utils.joblib_dump_kwargs)
+        self.save_flat(model_path)
+    
+    
+    def save_flat(self, model_path): 
+        flat_forest = self.flat_forest if self.flat_forest is not None else FlatForest.from_sklearn(self.model, quantization=self.quantization)
+        flat_path = os.path.join(model_path, flat_model_dirname)
+        flat_forest.save(flat_path)
+        params = { key: getattr(self, key, None) for key in hyperparameter_names }
+        with utils.atomic_path(os.path.join(flat_path, flat_params_fname)) as tmp_path, open(tmp_path, "w") as f: 
+            json.dump(params, f)
 
     @classmethod
     def load(cls, model_path): 
         rf = joblib.load(os.path.join(model_path, model_fname))
+        if rf.use_flat_forest: 
+            rf.enable_flat_forest()
+        return rf
+    
+    
+    @classmethod
+    def load_flat(cls, model_path, mmap_mode='r'): 
+        '''Load only the flat forest saved by save_flat, memory-mapped read-only by default. 
+        The returned Regressor predicts with the flat forest; it has no sklearn model (self.model is None).'''
+        flat_path = os.path.join(model_path, flat_model_dirname)
+        with open(os.path.join(flat_path, flat_params_fname)) as f: 
+            params = json.load(f)
+        rf = cls.__new__(cls)
+        rf.__dict__.update(params)
+        rf.model = None
+        rf.quantization = None
+        rf.fit_history = None
+        rf.use_flat_forest = True
+        rf.flat_forest = FlatForest.load(flat_path, mmap_mode=mmap_mode)
         return rf
+    
+    
+    def __getstate__(self): 
+        # the flat forest is rebuilt from the sklearn model on load, so it is not saved
+        state = self.__dict__.copy()
+        state["flat_forest"] = None
+        return state
+    
+    
+    def __setstate__(self, state): 
+        # models saved before the flat forest existed do not have these attributes
+        state.setdefault("use_flat_forest", False)
+        state.setdefault("flat_forest", None)
+        state.setdefault("quantization", None)
+        state.setdefault("fit_history", None)
+        state.setdefault("total_grown", len(getattr(state.get("model"), "estimators_", [])))
+        self.__dict__.update(state)
 
 
 def save_model(model, model_path):    
     model.save(model_path) 
     
 
-def load_model(model_path): 
+def load_model(model_path, mmap=False): 
+    if mmap: 
+        return Regressor.load_flat(model_path)
     model = Regressor.load(model_path)     
     return model
 
@@ -87,3 +268,38 @@ def get_data_based_model_params(data):
         For example, number of layers or neurons in a neural network as a function of data shape.
     '''  
     return {"max_features": max(1, int(0.5 *data.shape[1]))}
+
+
+
+def check_growable(model): 
+    '''Raise a ValueError if model cannot be grown (see Regressor.grow).'''
+    if model.quantization is not None: 
+        raise ValueError("The model is quantized (compacted), so trees cannot be added to it. "
+                         "Grow the full forest (kept by compact.py) and compact it again, or retrain it.")
+    if model.model is None: 
+        raise ValueError("The model was loaded as a flat forest only, so trees cannot be added to it.")
+
+
+
+def get_training_data_signature(train_X, train_y): 
+    '''Number of rows and checksum of the features (as the float32 the trees see) and of the target.'''
+    return {
+        "n_rows": len(train_X), 
+        "checksum": utils.get_array_checksum(train_X, dtype=np.float32) + utils.get_array_checksum(np.ravel(np.asarray(train_y))), 
+    }
+
+
+
+def get_random_rows_for_forest(flat_forest, n_rows, seed=42): 
+    '''Random rows that reach all branches of the forest: each feature is drawn uniformly 
+    from a range slightly wider than the range of its split thresholds.'''
+    rng = np.random.default_rng(seed)
+    is_split = flat_forest.children[:, 0] != np.arange(flat_forest.n_nodes)
+    X = np.zeros((n_rows, flat_forest.n_features), dtype=np.float32)
+    for f in range(flat_forest.n_features): 
+        thresholds = flat_forest.threshold[is_split & (flat_forest.feature == f)]
+        if len(thresholds) == 0: continue
+        low, high = thresholds.min(), thresholds.max()
+        margin = max(1.0, high - low) * 0.1
+        X[:, f] = rng.uniform(low - margin, high + margin, size=n_rows)
+    return X
@@ -0,0 +1,121 @@
+import numpy as np
+import joblib
+import os, tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+# the helpers sklearn itself uses to recreate each tree's bootstrap sample for out-of-bag scoring
+from sklearn.ensemble._forest import _generate_sample_indices, _get_n_samples_bootstrap
+from sklearn.metrics import r2_score
+
+import app.src.model.regressor as regressor
+
+
+shard_modes = ["bootstrap", "partition"]
+train_X_fname = "train_X.npy"
+train_y_fname = "train_y.npy"
+sub_forest_fname = "sub_forest_{}.save"
+
+
+
+def get_shards(n_rows, n_workers, shard_mode, seed=42):
+    ''' Rows each worker fits its trees on: None (all rows) for every worker with "bootstrap", so workers only
+    differ in their seeds, or a disjoint random partition of the rows with "partition". '''
+    if shard_mode == "bootstrap":
+        return [None] * n_workers
+    if shard_mode == "partition":
+        return np.array_split(np.random.default_rng(seed).permutation(n_rows), n_workers)
+    raise ValueError(f"Unknown shard mode {shard_mode}. Use one of {shard_modes}.")
+
+
+def split_trees(n_estimators, n_workers):
+    ''' Number of trees per worker, e.g. 250 trees over 4 workers gives 63, 63, 62, 62. '''
+    return [len(trees) for trees in np.array_split(np.arange(n_estimators), n_workers)]
+
+
+def fit_sub_forest(work_dir, worker_id, n_trees, rows, params, seed):
+    ''' Fit n_trees trees on the given rows (all rows if None) of the training data saved in work_dir,
+    on a single core. The trees are saved to work_dir along with, for every row of the full training data,
+    the sum and count of the predictions of the trees that did not see that row (their out-of-bag rows).
+    Only reads and writes work_dir, so it can run on any machine that mounts it.
+    Returns the path of the saved sub-forest. '''
+    X = np.load(os.path.join(work_dir, train_X_fname), mmap_mode="r")
+    y = np.load(os.path.join(work_dir, train_y_fname), mmap_mode="r")
+    train_rows = np.arange(len(X)) if rows is None else np.sort(rows)
+
+    model = regressor.Regressor(**params, n_estimators=n_trees, n_jobs=1)
+    # out-of-bag scoring on the shard alone would be wrong for partitions; it is done below over all rows
+    model.model.set_params(random_state=seed, oob_score=False)
+    model.fit(X[train_rows], y[train_rows])
+
+    oob_sum = np.zeros(len(X), dtype=np.float64)
+    oob_count = np.zeros(len(X), dtype=np.int64)
+    n_samples_bootstrap = _get_n_samples_bootstrap(len(train_rows), model.model.max_samples)
+    for tree in model.model.estimators_:
+        in_bag = np.zeros(len(X), dtype=bool)
+        in_bag[train_rows[_generate_sample_indices(tree.random_state, len(train_rows), n_samples_bootstrap)]] = True
+        oob_rows = np.flatnonzero(~in_bag)
+        oob_sum[oob_rows] += tree.predict(np.asarray(X[oob_rows], dtype=np.float32))
+        oob_count[oob_rows] += 1
+
+    sub_forest_path = os.path.join(work_dir, sub_forest_fname.format(worker_id))
+    joblib.dump({ "estimators": model.model.estimators_, "n_features": X.shape[1],
+                  "oob_sum": oob_sum, "oob_count": oob_count }, sub_forest_path)
+    return sub_forest_path
+
+
+def merge_sub_forests(model, sub_forest_paths, train_y, feature_names=None):
+    ''' Put the trees of all sub-forests into model (an unfitted Regressor) and set its out-of-bag
+    prediction and score from the summed out-of-bag predictions of all trees, as if one forest had been fitted. '''
+    estimators, oob_sum, oob_count, n_features = [], 0, 0, None
+    for path in sub_forest_paths:
+        sub_forest = joblib.load(path)
+        estimators += sub_forest["estimators"]
+        oob_sum = oob_sum + sub_forest["oob_sum"]
+        oob_count = oob_count + sub_forest["oob_count"]
+        n_features = sub_forest["n_features"]
+
+    forest = model.model
+    forest.set_params(n_estimators=len(estimators))
+    forest.estimators_ = estimators
+    forest.n_features_in_ = n_features
+    forest.n_outputs_ = 1
+    if feature_names is not None:
+        forest.feature_names_in_ = np.asarray(feature_names, dtype=object)
+
+    # rows that were in the bag of every tree have no out-of-bag prediction (sklearn leaves them at 0 too)
+    y = np.ravel(np.asarray(train_y, dtype=np.float64))
+    has_oob = oob_count > 0
+    forest.oob_prediction_ = oob_sum / np.maximum(oob_count, 1)
+    forest.oob_score_ = r2_score(y[has_oob], forest.oob_prediction_[has_oob])
+    model.n_estimators = len(estimators)
+    model.fit_history = { "method": "sharded", "data": None }
+    model.total_grown = len(estimators)
+    model.flat_forest = None
+    if model.use_flat_forest:
+        model.enable_flat_forest()
+    return model
+
+
+def fit_sharded(train_X, train_y, n_workers, shard_mode="bootstrap", hyperparameters=None, work_dir=None, seed=42):
+    ''' Fit a Regressor by splitting its trees over n_workers processes and merging them.
+    Each worker fits its share of the trees, with its own seed, on all rows ("bootstrap") or on its own
+    partition of the rows ("partition"); the workers exchange data only through files in work_dir
+    (a temporary directory if not given), so a shared filesystem is all that separate machines would need.
+    The merged model gets the combined out-of-bag estimate over all trees. '''
+    params = { **regressor.get_data_based_model_params(train_X), **(hyperparameters or {}) }
+    model = regressor.Regressor(**params)
+    params["n_estimators"] = model.n_estimators
+    n_trees = split_trees(params.pop("n_estimators"), n_workers)
+    shards = get_shards(len(train_X), n_workers, shard_mode, seed)
+    feature_names = list(train_X.columns) if hasattr(train_X, "columns") else None
+
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp_dir:
+        np.save(os.path.join(tmp_dir, train_X_fname), np.asarray(train_X, dtype=np.float32))
+        np.save(os.path.join(tmp_dir, train_y_fname), np.ravel(np.asarray(train_y, dtype=np.float64)))
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [
+                executor.submit(fit_sub_forest, tmp_dir, i, n_trees[i], shards[i], params, seed + i)
+                for i in range(n_workers) if n_trees[i] > 0
+            ]
+            sub_forest_paths = [future.result() for future in futures]
+        return merge_sub_forests(model, sub_forest_paths, train_y, feature_names)
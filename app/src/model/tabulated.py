@@ -0,0 +1,212 @@
+import numpy as np
+import itertools
+import json
+import os
+
+from app.src.model.flat_forest import FlatForest
+from app.src.utils import atomic_path
+
+
+tabulated_model_dirname = "model_tabulated"
+array_names = ["table", "bounds"]
+meta_fname = "tabulated_model.json"
+
+
+
+class TabulatedModel():
+    ''' Exhaustive lookup table of a fitted forest over its whole valid input space: every combination of
+    the allowed categorical values times a single bounded numeric variable (e.g. Carat Weight in [0.75, 3.0]).
+    A forest is piecewise constant in the numeric variable, so for each combination its prediction is a step
+    function over the forest's split thresholds on that variable:
+        - bounds: the largest raw numeric value (float64) of each step but the last, in increasing order,
+          so the step of a value v is np.searchsorted(bounds, v) (a binary search)
+        - table: prediction for each (combination, step), shape (n_combinations, len(bounds) + 1)
+    Combinations are numbered in mixed radix over cat_vars (the last variable varies fastest), so a row of
+    category codes maps to its table row with one dot product, and raw values with one dict lookup.
+    Predictions equal Regressor.predict on the pre-processed inputs, up to the order of the float64 sums.
+    '''
+    def __init__(self, table, bounds, cat_vars, categories, num_var, num_range) -> None:
+        self.table = table
+        self.bounds = bounds
+        self.cat_vars = list(cat_vars)
+        self.categories = { var: list(categories[var]) for var in self.cat_vars }
+        self.num_var = num_var
+        self.num_range = tuple(num_range)
+        radix = [len(self.categories[var]) for var in self.cat_vars]
+        self.strides = np.array([int(np.prod(radix[i + 1:])) for i in range(len(radix))], dtype=np.intp)
+        self.combination_index = None
+
+
+    @property
+    def n_combinations(self):
+        return self.table.shape[0]
+
+
+    @property
+    def n_steps(self):
+        return self.table.shape[1]
+
+
+    @classmethod
+    def build(cls, model, compiled_pipeline, categories, num_var, num_range):
+        ''' Tabulate model (a fitted Regressor) over all combinations of categories (dict from categorical
+        variable to its allowed values) and num_var in num_range = (low, high), pre-processed by compiled_pipeline.
+        Raises a ValueError if the pipeline has other numeric variables, or if num_var affects more than its
+        own output column. '''
+        if compiled_pipeline.num_vars != [num_var]:
+            raise ValueError(f"Can only tabulate a single numeric variable {num_var}, the pipeline has {compiled_pipeline.num_vars}.")
+        low, high = float(num_range[0]), float(num_range[1])
+        if not (np.isfinite(low) and np.isfinite(high) and low <= high):
+            raise ValueError(f"Can only tabulate a finite range of {num_var}, got {num_range}.")
+        cat_vars = list(categories)
+        num_column = int(compiled_pipeline.num_index[0])
+
+        # pre-processed rows of all combinations, at the lowest and highest numeric value
+        combinations = list(itertools.product(*[categories[var] for var in cat_vars]))
+        records = [dict(zip(cat_vars, combination)) for combination in combinations]
+        X_low = compiled_pipeline.transform([{ **record, num_var: low } for record in records]).astype(np.float32)
+        X_high = compiled_pipeline.transform([{ **record, num_var: high } for record in records]).astype(np.float32)
+        other_columns = np.arange(compiled_pipeline.n_features) != num_column
+        if not np.array_equal(X_low[:, other_columns], X_high[:, other_columns]):
+            raise ValueError(f"Cannot tabulate: {num_var} affects more than its own feature column.")
+
+        forest = get_flat_forest(model)
+        # splits on the numeric column that cut the valid range; the others send the whole range one way
+        thresholds = forest.threshold.astype(np.float32)
+        is_split = forest.children[:, 0] != np.arange(forest.n_nodes)
+        split_values = np.unique(thresholds[is_split & (forest.feature == num_column)])
+        x_low, x_high = X_low[0, num_column], X_high[0, num_column]
+        split_values = split_values[(split_values >= x_low) & (split_values < x_high)]
+        to_feature = lambda values: transform_numeric(compiled_pipeline, num_var, values)
+        bounds = get_step_bounds(to_feature, split_values, low, high)
+
+        value_sums = sum_leaf_values(forest, X_low, num_column, split_values, x_high)
+        if forest.is_quantized:
+            table = forest.value_offset + forest.value_scale * (value_sums / forest.n_trees)
+        else:
+            table = value_sums / forest.n_trees
+        return cls(table, bounds, cat_vars, categories, num_var, (low, high))
+
+
+    def predict(self, records):
+        ''' Predictions for a list of validated records (dicts keyed by field name). '''
+        if self.combination_index is None:
+            combinations = itertools.product(*[self.categories[var] for var in self.cat_vars])
+            self.combination_index = { combination: i for i, combination in enumerate(combinations) }
+        try:
+            rows = np.array([self.combination_index[tuple(record[var] for var in self.cat_vars)] for record in records], dtype=np.intp)
+        except KeyError as e:
+            raise ValueError(f"Combination {e} is not in the table.")
+        values = np.array([record[self.num_var] for record in records], dtype=np.float64)
+        return self.lookup(rows, values)
+
+
+    def predict_encoded(self, batch):
+        ''' Predictions for an EncodedBatch (see serving/validation.py) coded with the same allowed values. '''
+        columns = []
+        for var in self.cat_vars:
+            if list(batch.categories[var]) != self.categories[var]:
+                raise ValueError(f"The allowed values of {var} differ from the tabulated ones.")
+            columns.append(batch.cat_vars.index(var))
+        rows = batch.cat_codes[:, columns].astype(np.intp) @ self.strides
+        return self.lookup(rows, batch.num_values[:, batch.num_vars.index(self.num_var)])
+
+
+    def lookup(self, rows, values):
+        low, high = self.num_range
+        if np.any(~((values >= low) & (values <= high))):
+            raise ValueError(f"{self.num_var} must be in [{low}, {high}].")
+        return self.table[rows, np.searchsorted(self.bounds, values)]
+
+
+    def save(self, dir_path, model_checksum=None):
+        ''' Save as uncompressed .npy files plus a json file; model_checksum ties the table to the saved model. '''
+        os.makedirs(dir_path, exist_ok=True)
+        for name in array_names:
+            with atomic_path(os.path.join(dir_path, name + ".npy")) as tmp_path:
+                np.save(tmp_path, getattr(self, name))
+        with atomic_path(os.path.join(dir_path, meta_fname)) as tmp_path, open(tmp_path, "w") as f:
+            json.dump({ "cat_vars": self.cat_vars, "categories": self.categories, "num_var": self.num_var,
+                        "num_range": list(self.num_range), "model_checksum": model_checksum }, f, indent=2)
+
+
+    @classmethod
+    def load(cls, dir_path, model_checksum=None, mmap_mode='r'):
+        ''' Load a saved table, or return None if there is none or it was built from a model with
+        another checksum (when model_checksum is given). '''
+        meta_path = os.path.join(dir_path, meta_fname)
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as f:
+            meta = json.load(f)
+        saved_checksum = meta.pop("model_checksum", None)
+        if model_checksum is not None and saved_checksum != model_checksum:
+            return None
+        arrays = { name: np.load(os.path.join(dir_path, name + ".npy"), mmap_mode=mmap_mode) for name in array_names }
+        return cls(**arrays, **meta)
+
+
+
+def get_flat_forest(model):
+    ''' The model's flat forest if it predicts with one, else a flat copy of its sklearn forest with float64
+    values, so the table sums the same values as the model's predict. '''
+    if model.flat_forest is not None:
+        return model.flat_forest
+    value_dtype = np.float32 if model.quantization is not None else np.float64
+    return FlatForest.from_sklearn(model.model, value_dtype=value_dtype, quantization=model.quantization)
+
+
+
+def transform_numeric(compiled_pipeline, num_var, values):
+    ''' Pre-processed (float32, as the trees compare them) feature values of raw values of num_var. '''
+    values = np.asarray(values, dtype=np.float64)
+    X = np.zeros((len(values), compiled_pipeline.n_features))
+    compiled_pipeline._transform_numeric(X, { num_var: values }, len(values))
+    return X[:, compiled_pipeline.num_index[0]].astype(np.float32)
+
+
+
+def get_step_bounds(to_feature, split_values, low, high):
+    ''' For each split value t, the largest raw value v in [low, high] with to_feature(v) <= t, by bisection
+    over float64 values (to_feature must be non-decreasing, and to_feature(low) <= t < to_feature(high)). '''
+    lower = np.full(len(split_values), low)
+    upper = np.full(len(split_values), high)
+    while True:
+        mid = lower + (upper - lower) / 2
+        active = (mid > lower) & (mid < upper)
+        if not active.any():
+            return lower
+        goes_left = to_feature(mid[active]) <= split_values[active]
+        lower[np.flatnonzero(active)[goes_left]] = mid[active][goes_left]
+        upper[np.flatnonzero(active)[~goes_left]] = mid[active][~goes_left]
+
+
+
+def sum_leaf_values(forest, X, num_column, split_values, x_high):
+    ''' Sum over the trees of the leaf value reached by every (row of X, step between split_values), with
+    X's num_column ignored (its values are at most x_high): each tree is walked once for all rows, carrying
+    the set of rows and the range of steps that reach each node. A split on num_column narrows the range of
+    steps, any other split the rows. '''
+    n_steps = len(split_values) + 1
+    value_sums = np.zeros((X.shape[0], n_steps), dtype=np.float64)
+    values = forest.value.astype(np.float64)
+    thresholds = forest.threshold.astype(np.float32)
+    for root in forest.roots:
+        stack = [(int(root), np.arange(X.shape[0]), 0, n_steps)]
+        while stack:
+            node, rows, start, stop = stack.pop()
+            left, right = forest.children[node]
+            if left == node:
+                value_sums[rows, start:stop] += values[node]
+                continue
+            feature, threshold = forest.feature[node], thresholds[node]
+            if feature == num_column:
+                # the step ending at split_values[i] goes left exactly when split_values[i] <= threshold
+                split = n_steps if threshold >= x_high else int(np.searchsorted(split_values, threshold, side="right"))
+                if start < min(stop, split): stack.append((int(left), rows, start, min(stop, split)))
+                if max(start, split) < stop: stack.append((int(right), rows, max(start, split), stop))
+            else:
+                goes_left = X[rows, feature] <= threshold
+                if goes_left.any(): stack.append((int(left), rows[goes_left], start, stop))
+                if not goes_left.all(): stack.append((int(right), rows[~goes_left], start, stop))
+    return value_sums
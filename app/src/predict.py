@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+'''
+Batch scoring for files of any size. The input is streamed in chunks (csv chunks or parquet row groups),
+each chunk is pre-processed and scored, and its predictions are appended to the output file right away,
+so peak memory depends on the chunk size (and number of workers), not on the file size.
+Run from app/src:
+    python predict.py --input inventory.csv --output predictions.csv --chunksize 100000 --workers 4
+'''
+import warnings, sys, time
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+warnings.filterwarnings('ignore')
+
+import pandas as pd
+
+sys.path.insert(0, './../../')
+
+import app.src.preprocessing.pipeline as pipeline
+from app.src.preprocessing.compiled import compile_pipeline
+import app.src.model.regressor as regressor
+import app.src.utils as utils
+
+
+schema_path = "./../data/data_config/"
+artifacts_path = "./../artifacts/"
+
+prediction_field = "prediction"
+
+# fitted artifacts, loaded once per process by load_artifacts
+inputs_pipeline, compiled_pipeline, model = None, None, None
+
+
+def load_artifacts(artifacts_path, mmap=False):
+    global inputs_pipeline, compiled_pipeline, model
+    inputs_pipeline = pipeline.load_preprocessor(artifacts_path)
+    try:
+        compiled_pipeline = compile_pipeline(inputs_pipeline)
+    except ValueError:
+        compiled_pipeline = None
+    model = regressor.load_model(artifacts_path, mmap=mmap)
+
+
+def score_chunk(chunk):
+    if compiled_pipeline is not None:
+        processed_inputs = compiled_pipeline.transform(chunk)
+    else:
+        processed_inputs = pipeline.to_feature_matrix(inputs_pipeline.transform(chunk))
+    return model.predict(processed_inputs)
+
+
+def read_chunks(input_path, chunksize):
+    if input_path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(input_path)
+        for batch in parquet_file.iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+    else:
+        for chunk in pd.read_csv(input_path, chunksize=chunksize):
+            yield chunk
+
+
+def iter_predictions(chunks, workers, mmap):
+    ''' Yield (chunk, predictions) in input order. With several workers, chunks are scored in a process pool
+    with at most 2 chunks per worker in flight, so reading never runs far ahead of scoring. '''
+    if workers <= 1:
+        load_artifacts(artifacts_path, mmap)
+        for chunk in chunks:
+            yield chunk, score_chunk(chunk)
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=load_artifacts, initargs=(artifacts_path, mmap)) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append((chunk, executor.submit(score_chunk, chunk)))
+            if len(pending) >= 2 * workers:
+                chunk, future = pending.popleft()
+                yield chunk, future.result()
+        while len(pending):
+            chunk, future = pending.popleft()
+            yield chunk, future.result()
+
+
+class PredictionWriter():
+    ''' Appends (id, prediction) rows to a csv or parquet file, one chunk at a time. '''
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.parquet_writer = None
+        self.first_chunk = True
+
+    def write(self, df):
+        if self.output_path.endswith(".parquet"):
+            import pyarrow as pa, pyarrow.parquet as pq
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self.parquet_writer is None:
+                self.parquet_writer = pq.ParquetWriter(self.output_path, table.schema)
+            self.parquet_writer.write_table(table)
+        else:
+            df.to_csv(self.output_path, mode="w" if self.first_chunk else "a", header=self.first_chunk, index=False)
+        self.first_chunk = False
+
+    def close(self):
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+
+
+
+def run_predictions(input_path, output_path, chunksize=100000, workers=1, mmap=False):
+    data_schema = utils.get_data_schema(schema_path)
+    id_field = data_schema["inputDatasets"]["regressionBaseMainInput"]["idField"]
+
+    start = time.perf_counter()
+    num_rows = 0
+    writer = PredictionWriter(output_path)
+    try:
+        for chunk, predictions in iter_predictions(read_chunks(input_path, chunksize), workers, mmap):
+            writer.write(pd.DataFrame({ id_field: chunk[id_field].to_numpy(), prediction_field: predictions }))
+            num_rows += len(chunk)
+    finally:
+        writer.close()
+    seconds = time.perf_counter() - start
+    print(f"Scored {num_rows} rows in {seconds:.2f} s ({num_rows / seconds:,.0f} rows/sec). Predictions saved to {output_path}")
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input", required=True, help="csv or parquet file to score")
+    parser.add_argument("--output", required=True, help="csv or parquet file to write the predictions to")
+    parser.add_argument("--chunksize", type=int, default=100000, help="rows per chunk")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes scoring chunks")
+    parser.add_argument("--mmap", action="store_true", help="memory-map the flat forest instead of loading model.save")
+    args = parser.parse_args()
+
+    run_predictions(args.input, args.output, args.chunksize, args.workers, args.mmap)
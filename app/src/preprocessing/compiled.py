@@ -0,0 +1,239 @@
+import numpy as np, pandas as pd
+
+from feature_engine.encoding import RareLabelEncoder
+from feature_engine.imputation import (
+    AddMissingIndicator,
+    CategoricalImputer,
+    MeanMedianImputer,
+)
+from feature_engine.wrappers import SklearnTransformerWrapper
+from sklearn.preprocessing import StandardScaler
+
+import app.src.preprocessing.preprocessors as preprocessors
+
+
+
+class CompiledPipeline():
+    ''' Flat NumPy version of a fitted inputs pipeline (see pipeline.get_inputs_pipeline).
+    All fitted state is read once into lookup tables and arrays:
+        - for each categorical variable, a table from raw category (as string) to its one-hot output column
+          (-1 when the category has no column), plus the column used for unseen/rare categories
+        - for the numerical variables, output columns, missing-indicator columns, imputation values,
+          scaler mean/scale arrays and clip bounds
+    transform() then maps raw records straight to a contiguous feature matrix with the same columns,
+    in the same order, as Pipeline.transform, without building any DataFrames. The matrix is float32 by
+    default, the dtype the trees compare in, so Regressor.predict takes it without a copy.
+    '''
+    def __init__(self, columns, cat_vars, cat_tables, cat_defaults,
+                 num_vars, num_index, na_index, fill_values, mean, scale, clip_min, clip_max):
+        self.columns = list(columns)
+        self.cat_vars = list(cat_vars)
+        self.cat_tables = cat_tables
+        self.cat_defaults = cat_defaults
+        self.num_vars = list(num_vars)
+        self.num_index = np.asarray(num_index, dtype=np.intp)
+        self.na_index = np.asarray(na_index, dtype=np.intp)
+        self.fill_values = np.asarray(fill_values, dtype=np.float64)
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.scale = np.asarray(scale, dtype=np.float64)
+        self.clip_min = np.asarray(clip_min, dtype=np.float64)
+        self.clip_max = np.asarray(clip_max, dtype=np.float64)
+        # (var, allowed values) -> code-to-column array, filled by get_code_table
+        self.code_tables = {}
+
+
+    @property
+    def n_features(self):
+        return len(self.columns)
+
+
+    def to_dict(self):
+        ''' json-serializable state; NaN fill values and infinite clip bounds are stored as None. '''
+        def finite_or_none(values):
+            return [float(v) if np.isfinite(v) else None for v in values]
+        return {
+            "columns": self.columns,
+            "cat_vars": self.cat_vars,
+            "cat_tables": { var: { cat: int(idx) for cat, idx in table.items() } for var, table in self.cat_tables.items() },
+            "cat_defaults": { var: int(idx) for var, idx in self.cat_defaults.items() },
+            "num_vars": self.num_vars,
+            "num_index": self.num_index.tolist(),
+            "na_index": self.na_index.tolist(),
+            "fill_values": finite_or_none(self.fill_values),
+            "mean": self.mean.tolist(),
+            "scale": self.scale.tolist(),
+            "clip_min": finite_or_none(self.clip_min),
+            "clip_max": finite_or_none(self.clip_max),
+        }
+
+
+    @classmethod
+    def from_dict(cls, state):
+        def with_default(values, default):
+            return [default if v is None else v for v in values]
+        return cls(**{
+            **state,
+            "fill_values": with_default(state["fill_values"], np.nan),
+            "clip_min": with_default(state["clip_min"], -np.inf),
+            "clip_max": with_default(state["clip_max"], np.inf),
+        })
+
+
+    def transform(self, data, dtype=np.float32):
+        ''' Transform raw inputs into a C-contiguous feature matrix of the given dtype.
+        data can be a list of records (dicts keyed by field name), a dict of column arrays or a DataFrame.
+        '''
+        n = len(data) if isinstance(data, list) else len(get_column(data, (self.cat_vars + self.num_vars)[0]))
+        X = np.zeros((n, self.n_features), dtype=dtype)
+        rows = np.arange(n)
+
+        for var in self.cat_vars:
+            col_idx = self._encode_categories(var, get_column(data, var))
+            found = col_idx >= 0
+            X[rows[found], col_idx[found]] = 1
+
+        self._transform_numeric(X, data, n)
+        return X
+
+
+    def _transform_numeric(self, X, data, n):
+        for i, var in enumerate(self.num_vars):
+            vals = np.array(get_column(data, var), dtype=np.float64)
+            missing = np.isnan(vals)
+            if self.na_index[i] >= 0:
+                X[:, self.na_index[i]] = missing
+            if not np.isnan(self.fill_values[i]):
+                vals[missing] = self.fill_values[i]
+            vals -= self.mean[i]
+            vals /= self.scale[i]
+            X[:, self.num_index[i]] = np.clip(vals, self.clip_min[i], self.clip_max[i])
+
+
+    def transform_encoded(self, batch, dtype=np.float32):
+        ''' Transform an EncodedBatch (see serving/validation.py), whose categorical values are already
+        codes into known lists of allowed values, so no strings are compared. '''
+        n = len(batch)
+        X = np.zeros((n, self.n_features), dtype=dtype)
+        rows = np.arange(n)
+        for var in self.cat_vars:
+            col_idx = self.get_code_table(var, batch.categories[var])[batch.cat_codes[:, batch.cat_vars.index(var)]]
+            found = col_idx >= 0
+            X[rows[found], col_idx[found]] = 1
+        num_data = { var: batch.num_values[:, j] for j, var in enumerate(batch.num_vars) }
+        self._transform_numeric(X, num_data, n)
+        return X
+
+
+    def get_code_table(self, var, categories):
+        ''' Array from the code of each allowed value of var (its position in categories) to its output column. '''
+        key = (var, tuple(categories))
+        if key not in self.code_tables:
+            table, default = self.cat_tables[var], self.cat_defaults[var]
+            self.code_tables[key] = np.array([table.get(str(cat), default) for cat in categories], dtype=np.intp)
+        return self.code_tables[key]
+
+
+    def _encode_categories(self, var, values):
+        # categories are compared as strings, same as the StringTypeCaster in the pipeline; the distinct values
+        # are found by hashing (no string array of all rows is built or sorted), and only those are cast
+        values = np.asarray(values, dtype=object)
+        codes, uniques = pd.factorize(values)
+        table, default = self.cat_tables[var], self.cat_defaults[var]
+        unique_idx = np.array([table.get(str(u), default) for u in uniques] + [default], dtype=np.intp)
+        col_idx = unique_idx[codes]
+        # nulls get code -1; they are cast one by one since None and NaN give different strings
+        missing = np.flatnonzero(codes < 0)
+        if len(missing):
+            col_idx[missing] = [table.get(str(v), default) for v in values[missing]]
+        return col_idx
+
+
+
+def get_column(data, var):
+    if isinstance(data, list):
+        return [record.get(var) for record in data]
+    return data[var]
+
+
+
+def compile_pipeline(inputs_pipeline):
+    ''' Read the fitted state of an inputs pipeline into a CompiledPipeline.
+    Only the step types assembled by pipeline.get_inputs_pipeline are supported; anything else raises a ValueError.
+    The numerical columns are laid out in the column_selector's order (the schema order).
+    '''
+    columns, cat_vars, num_vars = [], [], []
+    string_cast, rare_groups, replace_with, ohe_cats = set(), {}, {}, {}
+    na_vars, fill_values, scaler_params, clip_bounds = [], {}, {}, {}
+
+    for name, step in inputs_pipeline.steps:
+        if isinstance(step, preprocessors.ColumnSelector) and step.selector_type == 'keep':
+            columns = list(step.columns)
+        elif isinstance(step, preprocessors.ColumnSelector) and step.selector_type == 'drop':
+            columns = [col for col in columns if col not in step.columns]
+        elif isinstance(step, preprocessors.StringTypeCaster):
+            cat_vars = [var for var in columns if var in step.vars]
+            string_cast.update(cat_vars)
+        elif isinstance(step, preprocessors.FloatTypeCaster):
+            num_vars = [var for var in columns if var in step.vars]
+        elif isinstance(step, CategoricalImputer):
+            # categorical nulls are already cast to the strings 'nan'/'None' at this point, so the imputer never fires
+            if not set(step.variables_).issubset(string_cast):
+                raise ValueError(f"Cannot compile step {name}: categorical imputer before string type casting.")
+        elif isinstance(step, RareLabelEncoder):
+            for var in step.variables_:
+                rare_groups[var] = set(str(cat) for cat in step.encoder_dict_[var])
+                replace_with[var] = step.replace_with
+        elif isinstance(step, preprocessors.OneHotEncoderMultipleCols):
+            for col in step.ohe_columns:
+                ohe_cats[col] = list(step.top_cat_by_ohe_col[col])
+                columns = columns + [col + '_' + cat for cat in ohe_cats[col]]
+        elif isinstance(step, AddMissingIndicator):
+            na_vars = list(step.variables_)
+            columns = columns + [var + "_na" for var in na_vars]
+        elif isinstance(step, MeanMedianImputer):
+            fill_values.update(step.imputer_dict_)
+        elif isinstance(step, SklearnTransformerWrapper) and isinstance(step.transformer_, StandardScaler):
+            scaler = step.transformer_
+            for i, var in enumerate(step.variables_):
+                scaler_params[var] = (
+                    scaler.mean_[i] if scaler.mean_ is not None else 0.0,
+                    scaler.scale_[i] if scaler.scale_ is not None else 1.0
+                    )
+        elif isinstance(step, preprocessors.ValueClipper):
+            for var in step.fields_to_clip:
+                clip_bounds[var] = (
+                    step.min_val if step.min_val is not None else -np.inf,
+                    step.max_val if step.max_val is not None else np.inf
+                    )
+        else:
+            raise ValueError(f"Cannot compile pipeline step {name} of type {type(step).__name__}.")
+
+    col_index = { col: i for i, col in enumerate(columns) }
+    encoded_cols = set(num_vars) | set(var + "_na" for var in na_vars) | \
+        set(col + '_' + cat for col in ohe_cats for cat in ohe_cats[col])
+    if not set(columns).issubset(encoded_cols):
+        raise ValueError(f"Cannot compile pipeline: output columns {sorted(set(columns) - encoded_cols)} are not numeric.")
+
+    cat_tables, cat_defaults = {}, {}
+    for var in cat_vars:
+        ohe_pos = { cat: col_index[var + '_' + cat] for cat in ohe_cats.get(var, []) }
+        if var in rare_groups:
+            cat_tables[var] = { cat: ohe_pos.get(cat, -1) for cat in rare_groups[var] }
+            cat_defaults[var] = ohe_pos.get(replace_with[var], -1)
+        else:
+            cat_tables[var], cat_defaults[var] = ohe_pos, -1
+
+    return CompiledPipeline(
+        columns=columns,
+        cat_vars=cat_vars,
+        cat_tables=cat_tables,
+        cat_defaults=cat_defaults,
+        num_vars=num_vars,
+        num_index=[col_index[var] for var in num_vars],
+        na_index=[col_index.get(var + "_na", -1) if var in na_vars else -1 for var in num_vars],
+        fill_values=[fill_values.get(var, np.nan) for var in num_vars],
+        mean=[scaler_params.get(var, (0.0, 1.0))[0] for var in num_vars],
+        scale=[scaler_params.get(var, (0.0, 1.0))[1] for var in num_vars],
+        clip_min=[clip_bounds.get(var, (-np.inf, np.inf))[0] for var in num_vars],
+        clip_max=[clip_bounds.get(var, (-np.inf, np.inf))[1] for var in num_vars],
+    )
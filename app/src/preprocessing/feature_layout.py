@@ -0,0 +1,114 @@
+import numpy as np
+import json
+import os
+
+from app.src.preprocessing.compiled import CompiledPipeline, compile_pipeline
+from app.src.utils import get_file_checksum, atomic_path
+
+
+feature_layout_fname = "feature_layout.json"
+# bump when the layout format changes; layouts of other versions are ignored (and rebuilt by retraining)
+FEATURE_LAYOUT_VERSION = 1
+
+
+
+def profile_data(data, cat_vars, num_vars):
+    ''' Column statistics of the training data in one sweep per column type:
+        - null counts of all variables (one vectorized isnull over the frame)
+        - category counts of each categorical variable (as strings, the way the pipeline sees them)
+        - mean, std (ddof=0, as StandardScaler), min and max of the numeric variables (one pass over the float matrix)
+    Variables missing from data are left out. '''
+    cat_vars = [var for var in cat_vars if var in data.columns]
+    num_vars = [var for var in num_vars if var in data.columns]
+    null_counts = data[cat_vars + num_vars].isnull().sum()
+
+    profile = { "n_rows": int(len(data)), "categorical": {}, "numeric": {} }
+    for var in cat_vars:
+        counts = data[var].value_counts(dropna=True, sort=True)
+        profile["categorical"][var] = {
+            "null_count": int(null_counts[var]),
+            "counts": { str(cat): int(count) for cat, count in counts.items() },
+        }
+    if len(num_vars):
+        values = data[num_vars].to_numpy(dtype=np.float64)
+        stats = { "mean": np.nanmean(values, axis=0), "std": np.nanstd(values, axis=0),
+                  "min": np.nanmin(values, axis=0), "max": np.nanmax(values, axis=0) }
+        for j, var in enumerate(num_vars):
+            profile["numeric"][var] = { "null_count": int(null_counts[var]),
+                                        **{ name: float(stat[j]) for name, stat in stats.items() } }
+    return profile
+
+
+def merge_profiles(profiles):
+    ''' The profile of the concatenated data of several profiles of the same variables, as profile_data would
+    give it: counts are summed and the numeric moments pooled over the non-null values of each. '''
+    merged = { "n_rows": sum(profile["n_rows"] for profile in profiles), "categorical": {}, "numeric": {} }
+    for var in profiles[0]["categorical"]:
+        counts = {}
+        for profile in profiles:
+            for cat, count in profile["categorical"][var]["counts"].items():
+                counts[cat] = counts.get(cat, 0) + count
+        merged["categorical"][var] = {
+            "null_count": sum(profile["categorical"][var]["null_count"] for profile in profiles),
+            "counts": dict(sorted(counts.items(), key=lambda item: -item[1])),
+        }
+    for var in profiles[0]["numeric"]:
+        stats = [profile["numeric"][var] for profile in profiles]
+        n = np.array([profile["n_rows"] - s["null_count"] for profile, s in zip(profiles, stats)], dtype=np.float64)
+        seen = n > 0
+        mean, std = (np.array([s[name] for s in stats], dtype=np.float64)[seen] for name in ["mean", "std"])
+        n = n[seen]
+        pooled_mean = float((n * mean).sum() / n.sum()) if len(n) else float("nan")
+        pooled_var = float((n * (std ** 2 + (mean - pooled_mean) ** 2)).sum() / n.sum()) if len(n) else float("nan")
+        merged["numeric"][var] = {
+            "null_count": sum(s["null_count"] for s in stats),
+            "mean": pooled_mean,
+            "std": float(np.sqrt(pooled_var)),
+            "min": float(np.nanmin([s["min"] for s in stats])),
+            "max": float(np.nanmax([s["max"] for s in stats])),
+        }
+    return merged
+
+
+def get_null_counts(profile):
+    return { var: stats["null_count"] for column_type in ["categorical", "numeric"] for var, stats in profile[column_type].items() }
+
+
+def build_feature_layout(inputs_pipeline, preprocessor_checksum, data_profile=None):
+    ''' The output feature layout of a fitted inputs pipeline: column names and order, where each category
+    and numeric variable goes, and all fitted values needed to fill a feature matrix (as a CompiledPipeline),
+    plus the training data profile. Raises a ValueError if the pipeline cannot be compiled. '''
+    compiled_pipeline = compile_pipeline(inputs_pipeline)
+    return {
+        "version": FEATURE_LAYOUT_VERSION,
+        "preprocessor_checksum": preprocessor_checksum,
+        "columns": compiled_pipeline.columns,
+        "n_features": compiled_pipeline.n_features,
+        "compiled_pipeline": compiled_pipeline.to_dict(),
+        "profile": data_profile,
+    }
+
+
+def save_feature_layout(inputs_pipeline, file_path, preprocessor_path):
+    ''' Save the feature layout of inputs_pipeline next to its saved preprocessor (preprocessor_path),
+    with the training data profile stored on the pipeline by train.preprocess_data, if any. '''
+    layout = build_feature_layout(inputs_pipeline, get_file_checksum(preprocessor_path), getattr(inputs_pipeline, "data_profile_", None))
+    with atomic_path(os.path.join(file_path, feature_layout_fname)) as tmp_path, open(tmp_path, "w") as f:
+        json.dump(layout, f, indent=2)
+
+
+def load_feature_layout(file_path, preprocessor_path):
+    ''' The saved feature layout, or None if there is none, it has another version, or it was not saved
+    with the preprocessor currently at preprocessor_path. '''
+    layout_path = os.path.join(file_path, feature_layout_fname)
+    if not os.path.exists(layout_path):
+        return None
+    with open(layout_path) as f:
+        layout = json.load(f)
+    if layout.get("version") != FEATURE_LAYOUT_VERSION or layout.get("preprocessor_checksum") != get_file_checksum(preprocessor_path):
+        return None
+    return layout
+
+
+def load_compiled_pipeline(layout):
+    return CompiledPipeline.from_dict(layout["compiled_pipeline"])
\ No newline at end of file
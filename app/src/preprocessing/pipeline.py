@@ -9,9 +9,11 @@ from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import StandardScaler
 import sys, os
 import joblib
-import pandas as pd 
+import numpy as np, pandas as pd 
 
 import app.src.preprocessing.preprocessors as preprocessors
+import app.src.preprocessing.feature_layout as feature_layout
+import app.src.utils as utils
 
 
 
@@ -167,10 +169,54 @@ def get_inputs_pipeline(pp_params, model_cfg):
         
 
 def save_preprocessor(inputs_pipeline, file_path):
-    joblib.dump(inputs_pipeline, os.path.join(file_path, preprocessor_fname), protocol=3)    
+    with utils.atomic_path(os.path.join(file_path, preprocessor_fname)) as tmp_path: 
+        joblib.dump(inputs_pipeline, tmp_path, **utils.joblib_dump_kwargs)
+    # output columns and fitted values as json, so serving can fill feature matrices without the pickled pipeline
+    try: 
+        feature_layout.save_feature_layout(inputs_pipeline, file_path, os.path.join(file_path, preprocessor_fname))
+    except ValueError as e: 
+        print(f"Not saving a feature layout: {e}")
     
 
 def load_preprocessor(file_path):
     inputs_pipeline = joblib.load(os.path.join(file_path, preprocessor_fname))       
     return inputs_pipeline
+
+
+def load_feature_layout(file_path): 
+    '''The feature layout saved with the preprocessor in file_path, or None if missing or out of date.'''
+    return feature_layout.load_feature_layout(file_path, os.path.join(file_path, preprocessor_fname))
+
+
+
+def to_feature_matrix(processed_inputs, dtype=np.float32, out=None): 
+    '''The pipeline output (a DataFrame) as a C-contiguous matrix of dtype, in its column order: the layout the 
+    trees are fitted on and compared in, so Regressor.fit and Regressor.predict take a float32 one without 
+    another copy. Each column is written straight into the preallocated result (or into out, e.g. a slice of 
+    a larger matrix), so no float64 matrix of the mixed-dtype frame is built on the way. Arrays already in 
+    that layout are returned as is.'''
+    if out is None: 
+        if isinstance(processed_inputs, np.ndarray): 
+            return np.ascontiguousarray(processed_inputs, dtype=dtype)
+        out = np.empty(processed_inputs.shape, dtype=dtype)
+    if isinstance(processed_inputs, np.ndarray): 
+        out[:] = processed_inputs
+        return out
+    for j in range(processed_inputs.shape[1]): 
+        out[:, j] = processed_inputs.iloc[:, j].to_numpy()
+    return out
+
+
+
+def get_fitted_categories(inputs_pipeline): 
+    '''The categorical state learned by the pipeline: frequent (non-rare) categories per variable and the 
+    ordered one-hot encoded categories per variable. If two fitted pipelines return the same value, they 
+    produce the same feature columns and group categories the same way.'''
+    fitted_categories = {}
+    for name, step in inputs_pipeline.steps: 
+        if isinstance(step, RareLabelEncoder): 
+            fitted_categories[name] = { var: sorted(str(cat) for cat in cats) for var, cats in step.encoder_dict_.items() }
+        elif isinstance(step, preprocessors.OneHotEncoderMultipleCols): 
+            fitted_categories[name] = { var: list(cats) for var, cats in step.top_cat_by_ohe_col.items() }
+    return fitted_categories
     
\ No newline at end of file
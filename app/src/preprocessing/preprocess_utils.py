@@ -3,6 +3,8 @@ import joblib
 import pprint
 import sys, os
 
+from app.src.preprocessing.feature_layout import profile_data, get_null_counts
+
 
 def get_cat_and_num_vars_lists(data_schema):      
     cat_vars, num_vars = [], []
@@ -28,9 +30,9 @@ def verify_data_columns_in_schema(data, pp_params):
     return 
 
 
-def get_vars_with_nas(data, pp_params):     
-    vars_with_na = [var for var in data.columns 
-                    if data[var].isnull().sum() > 0] 
+def get_vars_with_nas(profile, pp_params):     
+    null_counts = get_null_counts(profile)
+    vars_with_na = [var for var, count in null_counts.items() if count > 0] 
     
     cat_na = [var for var in pp_params["cat_vars"] if var in vars_with_na]
     num_na = [var for var in pp_params["num_vars"] if var in vars_with_na]
@@ -39,23 +41,24 @@ def get_vars_with_nas(data, pp_params):
     return cat_na, num_na
 
 
-def get_cat_vars_with_missing_impute_for_na(data, pp_params, model_cfg): 
+def get_cat_vars_with_missing_impute_for_na(profile, pp_params, model_cfg): 
     threshold = model_cfg['max_perc_miss_for_most_freq_impute']
     with_string_missing = [ var for var in pp_params["cat_na"] 
-            if data[var].isnull().mean() >=  threshold]
+            if profile["categorical"][var]["null_count"] / profile["n_rows"] >=  threshold]
     return with_string_missing
 
 
 
-def get_cat_vars_with_frequent_cat_impute_for_na(data, pp_params, model_cfg): 
+def get_cat_vars_with_frequent_cat_impute_for_na(profile, pp_params, model_cfg): 
     threshold = model_cfg['max_perc_miss_for_most_freq_impute']
     with_freq_cat = [ var for var in pp_params["cat_na"] 
-            if data[var].isnull().mean() <  threshold]
+            if profile["categorical"][var]["null_count"] / profile["n_rows"] <  threshold]
     return with_freq_cat
 
 
 
-def get_preprocess_params(data, data_schema, model_cfg): 
+def get_preprocess_params(data, data_schema, model_cfg, profile=None): 
+    # data only needs all rows if no profile is given (e.g. the first rows, with a profile from streaming_fit)
     # initiate the pp_params dict
     pp_params = {}   
             
@@ -77,14 +80,17 @@ def get_preprocess_params(data, data_schema, model_cfg):
     # verify that the given data matches the input_schema
     verify_data_columns_in_schema(data, pp_params)    
     
+    # column statistics (null counts, category counts, numeric moments), computed once and saved with the preprocessor
+    pp_params["profile"] = profile if profile is not None else profile_data(data, cat_vars, num_vars)
+    
     # get list of categorical and numeric variables with missing values
-    cat_na, num_na = get_vars_with_nas(data, pp_params) 
+    cat_na, num_na = get_vars_with_nas(pp_params["profile"], pp_params) 
     pp_params["cat_na"], pp_params["num_na"] = cat_na, num_na     
     
     # get list of categorical variables where the perc of missing values exceeds threshold (see model_config.json)
     # for these variables, we will set the missing values to 'missing' in pre-processing pipeline
-    with_string_missing = get_cat_vars_with_missing_impute_for_na(data, pp_params, model_cfg)
-    with_freq_cat = get_cat_vars_with_frequent_cat_impute_for_na(data, pp_params, model_cfg)
+    with_string_missing = get_cat_vars_with_missing_impute_for_na(pp_params["profile"], pp_params, model_cfg)
+    with_freq_cat = get_cat_vars_with_frequent_cat_impute_for_na(pp_params["profile"], pp_params, model_cfg)
     pp_params["cat_na_impute_with_str_missing"], pp_params["cat_na_impute_with_freq"] = with_string_missing, with_freq_cat
     
     # pprint.pprint(pp_params)    
@@ -45,7 +45,7 @@ class TypeCaster(BaseEstimator, TransformerMixin):
         data = data.copy()
         applied_cols = [col for col in self.vars if col in data.columns] 
         for var in applied_cols: 
-            data[var] = data[var].apply(self.cast_type)
+            data[var] = data[var].astype(self.cast_type)
         return data
 
 
@@ -87,28 +87,35 @@ class OneHotEncoderMultipleCols(BaseEstimator, TransformerMixin):
     
     
     def transform(self, data): 
-        data.reset_index(inplace=True, drop=True)
-        df_list = [data]
-        cols_list = list(data.columns)
-        for col in self.ohe_columns:
-            if len(self.top_cat_by_ohe_col[col]) > 0:
-                if col in data.columns:                
-                    for cat in self.top_cat_by_ohe_col[col]:
-                        col_name = col + '_' + cat
-                        # data[col_name] = np.where(data[col] == cat, 1, 0)
-                        vals = np.where(data[col] == cat, 1, 0)
-                        df = pd.DataFrame(vals, columns=[col_name])
-                        df_list.append(df)
-                        
-                        cols_list.append(col_name)
-                else: 
-                    raise Exception(f'''
-                        Error: Fitted one-hot-encoded column {col}
-                        does not exist in dataframe given for transformation.
-                        This will result in a shape mismatch for train/prediction job. 
-                        ''')
-        transformed_data = pd.concat(df_list, axis=1, ignore_index=True) 
-        transformed_data.columns =  cols_list
+        ohe_cols = [col for col in self.ohe_columns if len(self.top_cat_by_ohe_col[col]) > 0]
+        for col in ohe_cols:
+            if col not in data.columns: 
+                raise Exception(f'''
+                    Error: Fitted one-hot-encoded column {col}
+                    does not exist in dataframe given for transformation.
+                    This will result in a shape mismatch for train/prediction job. 
+                    ''')
+        
+        # all one-hot columns go into one preallocated uint8 block (an eighth of int64, and cast exactly 
+        # into the float32 feature matrix); each category's position in the fitted top categories is its 
+        # column offset within the block of its source column 
+        num_ohe_cols = sum(len(self.top_cat_by_ohe_col[col]) for col in ohe_cols)
+        ohe_block = np.zeros((len(data), num_ohe_cols), dtype=np.uint8)
+        ohe_col_names = []
+        rows = np.arange(len(data))
+        offset = 0
+        for col in ohe_cols:
+            cats = self.top_cat_by_ohe_col[col]
+            codes = pd.Categorical(data[col], categories=cats).codes.astype(np.intp)
+            found = codes >= 0
+            ohe_block[rows[found], offset + codes[found]] = 1
+            ohe_col_names += [col + '_' + cat for cat in cats]
+            offset += len(cats)
+        
+        ohe_data = pd.DataFrame(ohe_block, columns=ohe_col_names, index=data.index)
+        transformed_data = pd.concat([data, ohe_data], axis=1)
+        if not transformed_data.index.equals(pd.RangeIndex(len(transformed_data))):
+            transformed_data.index = pd.RangeIndex(len(transformed_data))
         return transformed_data
 
 
@@ -119,12 +126,10 @@ class ValueClipper(BaseEstimator, TransformerMixin):
         self.min_val = min_val
         self.max_val = max_val
     
-    def fit(self, data): return self
+    def fit(self, data, y=None): return self
     
     def transform(self, data): 
-        for field in self.fields_to_clip:
-            if self.min_val is not None: 
-                data[field] = data[field].clip(lower=self.min_val)
-            if self.max_val is not None: 
-                data[field] = data[field].clip(upper=self.max_val)
-        return data
\ No newline at end of file
+        if self.min_val is None and self.max_val is None: return data
+        data = data.copy()
+        data[self.fields_to_clip] = np.clip(data[self.fields_to_clip].to_numpy(), self.min_val, self.max_val)
+        return data
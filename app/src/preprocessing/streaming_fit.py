@@ -0,0 +1,252 @@
+import numpy as np, pandas as pd
+
+from feature_engine.encoding import RareLabelEncoder
+from feature_engine.imputation import (
+    AddMissingIndicator,
+    CategoricalImputer,
+    MeanMedianImputer,
+)
+from feature_engine.wrappers import SklearnTransformerWrapper
+from sklearn.base import clone
+from sklearn.preprocessing import StandardScaler
+
+import app.src.preprocessing.pipeline as pipeline
+import app.src.preprocessing.preprocess_utils as pp_utils
+import app.src.preprocessing.preprocessors as preprocessors
+
+
+
+class StreamingStatistics():
+    ''' Column statistics of data seen one chunk at a time, enough to fit the inputs pipeline
+    (see fit_inputs_pipeline) and to give the same data profile as feature_layout.profile_data:
+        - row count and null count of each variable
+        - counts of each categorical value as the pipeline sees it (cast to string, so nulls count as 'nan'),
+          in order of first appearance, which is the order pandas' value_counts breaks ties in
+        - for the numeric variables, a StandardScaler partial_fit on the chunks (running mean and variance
+          of the non-null values, merged chunk by chunk), plus running min and max
+    Memory use is independent of the number of rows.
+    '''
+    def __init__(self, cat_vars, num_vars) -> None:
+        self.cat_vars = list(cat_vars)
+        self.num_vars = list(num_vars)
+        self.n_rows = 0
+        self.null_counts = { var: 0 for var in self.cat_vars + self.num_vars }
+        self.category_counts = { var: {} for var in self.cat_vars }
+        self.scaler = StandardScaler()
+        self.num_min = np.full(len(self.num_vars), np.inf)
+        self.num_max = np.full(len(self.num_vars), -np.inf)
+        # first rows of the data, passed through the pipeline steps as they are built
+        self.sample = None
+
+
+    def update(self, chunk):
+        if self.sample is None:
+            self.sample = chunk.head(100).copy()
+        self.n_rows += len(chunk)
+        for var, count in chunk[self.cat_vars + self.num_vars].isnull().sum().items():
+            self.null_counts[var] += int(count)
+        for var in self.cat_vars:
+            counts = self.category_counts[var]
+            for cat, count in chunk[var].astype(str).value_counts(sort=False).items():
+                counts[cat] = counts.get(cat, 0) + int(count)
+        if len(self.num_vars):
+            values = chunk[self.num_vars].to_numpy(dtype=np.float64)
+            if len(values):
+                self.scaler.partial_fit(values)
+            with np.errstate(invalid="ignore"):
+                self.num_min = np.fmin(self.num_min, np.nanmin(values, axis=0, initial=np.inf))
+                self.num_max = np.fmax(self.num_max, np.nanmax(values, axis=0, initial=-np.inf))
+
+
+    def get_non_null_counts(self):
+        counts = self.scaler.n_samples_seen_
+        return np.broadcast_to(counts, (len(self.num_vars),))
+
+
+    def get_profile(self):
+        ''' The data profile in the format of feature_layout.profile_data (category counts exclude nulls). '''
+        profile = { "n_rows": self.n_rows, "categorical": {}, "numeric": {} }
+        for var in self.cat_vars:
+            counts = dict(self.category_counts[var])
+            if self.null_counts[var]:
+                counts["nan"] -= self.null_counts[var]
+                if counts["nan"] == 0: del counts["nan"]
+            profile["categorical"][var] = {
+                "null_count": self.null_counts[var],
+                "counts": dict(sorted(counts.items(), key=lambda item: -item[1])),
+            }
+        for j, var in enumerate(self.num_vars):
+            profile["numeric"][var] = {
+                "null_count": self.null_counts[var],
+                "mean": float(self.scaler.mean_[j]),
+                "std": float(np.sqrt(self.scaler.var_[j])),
+                "min": float(self.num_min[j]),
+                "max": float(self.num_max[j]),
+            }
+        return profile
+
+
+
+def fit_inputs_pipeline(chunks, data_schema, model_cfg):
+    ''' Fit the inputs pipeline in one pass over chunks (DataFrames, e.g. from utils.iter_data_chunks) instead
+    of on one in-memory frame: the statistics of all chunks are accumulated, then each pipeline step gets
+    the fitted state its fit would have learned on the concatenated data. Returns the fitted pipeline and
+    the pre-processing parameters (see preprocess_utils.get_preprocess_params). '''
+    statistics = None
+    for chunk in chunks:
+        if statistics is None:
+            cat_vars, num_vars = pp_utils.get_cat_and_num_vars_lists(data_schema)
+            statistics = StreamingStatistics([var for var in cat_vars if var in chunk.columns],
+                                             [var for var in num_vars if var in chunk.columns])
+        statistics.update(chunk)
+    if statistics is None:
+        raise ValueError("No training data to fit the pre-processing on.")
+
+    pp_params = pp_utils.get_preprocess_params(statistics.sample, data_schema, model_cfg, profile=statistics.get_profile())
+    inputs_pipeline = pipeline.get_inputs_pipeline(pp_params, model_cfg)
+    set_fitted_state(inputs_pipeline, statistics, pp_params["target_attr_name"])
+    inputs_pipeline.data_profile_ = pp_params["profile"]
+    return inputs_pipeline, pp_params
+
+
+
+def set_fitted_state(inputs_pipeline, statistics, target_attr_name):
+    ''' Set the state each step of inputs_pipeline would learn in fit, from the statistics. The sample rows are
+    transformed step by step alongside, for the column counts some steps record. Raises a ValueError for
+    steps whose state cannot be derived from the statistics. '''
+    sample = statistics.sample.loc[:, statistics.sample.columns != target_attr_name]
+    n_rows = statistics.n_rows
+    rare_groups, replace_with = {}, {}
+    for name, step in inputs_pipeline.steps:
+        if isinstance(step, (preprocessors.ColumnSelector, preprocessors.TypeCaster, preprocessors.ValueClipper)):
+            step.fit(sample)
+        elif isinstance(step, CategoricalImputer):
+            step.variables_ = list(step.variables)
+            if step.imputation_method == "missing":
+                step.imputer_dict_ = { var: step.fill_value for var in step.variables_ }
+            else:
+                step.imputer_dict_ = { var: get_mode(statistics.category_counts[var], var) for var in step.variables_ }
+            step.n_features_in_ = sample.shape[1]
+        elif isinstance(step, RareLabelEncoder):
+            step.variables_ = list(step.variables)
+            step.encoder_dict_ = {}
+            for var in step.variables_:
+                step.encoder_dict_[var] = get_frequent_categories(step, statistics.category_counts[var], n_rows)
+                rare_groups[var], replace_with[var] = set(step.encoder_dict_[var]), step.replace_with
+            step.n_features_in_ = sample.shape[1]
+        elif isinstance(step, preprocessors.OneHotEncoderMultipleCols):
+            for col in step.ohe_columns:
+                if col not in sample.columns: continue
+                step.top_cat_by_ohe_col[col] = get_top_categories(
+                    step, statistics.category_counts[col], rare_groups.get(col), replace_with.get(col))
+        elif isinstance(step, AddMissingIndicator):
+            variables = step.variables or list(sample.columns)
+            step.variables_ = [var for var in variables if statistics.null_counts[var] > 0] if step.missing_only else list(variables)
+            step.n_features_in_ = sample.shape[1]
+        elif isinstance(step, MeanMedianImputer) and step.imputation_method == "mean":
+            step.variables_ = list(step.variables)
+            means = dict(zip(statistics.num_vars, statistics.scaler.mean_))
+            step.imputer_dict_ = { var: means[var] for var in step.variables_ }
+            step.n_features_in_ = sample.shape[1]
+        elif isinstance(step, SklearnTransformerWrapper) and isinstance(step.transformer, StandardScaler):
+            step.variables_ = list(step.variables)
+            step.transformer_ = get_fitted_scaler(step.transformer, statistics, step.variables_)
+            step.n_features_in_ = sample.shape[1]
+        else:
+            raise ValueError(f"Cannot fit step {name} ({type(step).__name__}) from streamed statistics.")
+        sample = step.transform(sample)
+
+
+
+def get_frequent_categories(step, counts, n_rows):
+    ''' The categories a RareLabelEncoder step keeps for a variable with the given value counts (dict from
+    category, as a string, to count) in n_rows rows. '''
+    counts = pd.Series(counts, dtype=np.int64)
+    if len(counts) > step.n_categories:
+        frequencies = counts.sort_values(ascending=False) / float(n_rows)
+        frequent = frequencies[frequencies >= step.tol].index
+        return frequent[: step.max_n_categories] if step.max_n_categories else frequent
+    return counts.index.to_numpy()
+
+
+
+def get_top_categories(step, counts, frequent=None, replace_with=None):
+    ''' The categories a OneHotEncoderMultipleCols step encodes for a column with the given value counts,
+    after rare-label grouping (values not in frequent, if given, count as replace_with). '''
+    # counts after rare-label grouping, in order of first appearance of the (grouped) value
+    grouped = {}
+    for cat, count in counts.items():
+        if frequent is not None and cat not in frequent:
+            cat = replace_with
+        grouped[cat] = grouped.get(cat, 0) + count
+    counts = pd.Series(grouped, dtype=np.int64).sort_values(ascending=False)
+    return list(counts.sort_values(ascending=False).head(step.max_num_categories).index)
+
+
+
+def get_fitted_categories_from_profile(inputs_pipeline, profile):
+    ''' The fitted categories (see pipeline.get_fitted_categories) the steps of the fitted inputs_pipeline would
+    learn on data with the given profile (see feature_layout.profile_data), from its category and null counts
+    alone: nothing is fitted or transformed. '''
+    # the pipeline casts the categories to strings first, so nulls are counted as 'nan' (see StreamingStatistics)
+    category_counts = { var: { **stats["counts"], **({ "nan": stats["null_count"] } if stats["null_count"] else {}) }
+                        for var, stats in profile["categorical"].items() }
+    fitted_categories, rare_groups, replace_with = {}, {}, {}
+    for name, step in inputs_pipeline.steps:
+        if isinstance(step, RareLabelEncoder):
+            frequent = { var: get_frequent_categories(step, category_counts[var], profile["n_rows"]) for var in step.variables_ }
+            fitted_categories[name] = { var: sorted(str(cat) for cat in cats) for var, cats in frequent.items() }
+            for var, cats in frequent.items():
+                rare_groups[var], replace_with[var] = set(cats), step.replace_with
+        elif isinstance(step, preprocessors.OneHotEncoderMultipleCols):
+            fitted_categories[name] = { col: get_top_categories(step, category_counts[col], rare_groups.get(col), replace_with.get(col))
+                                        for col in step.top_cat_by_ohe_col }
+    return fitted_categories
+
+
+
+def get_mode(category_counts, var):
+    ''' Most frequent value, as CategoricalImputer finds it with pandas' mode. '''
+    max_count = max(category_counts.values())
+    modes = [cat for cat, count in category_counts.items() if count == max_count]
+    if len(modes) > 1:
+        raise ValueError("Variable {} contains multiple frequent categories.".format(var))
+    return modes[0]
+
+
+
+def get_fitted_scaler(transformer, statistics, variables):
+    ''' The StandardScaler the pipeline fits after mean imputation: the imputed rows add the mean itself,
+    so the mean is that of the non-null values and the variance is their sum of squared deviations over all rows. '''
+    if not (transformer.with_mean and transformer.with_std):
+        raise ValueError("Only a StandardScaler with with_mean and with_std can be fitted from streamed statistics.")
+    idx = [statistics.num_vars.index(var) for var in variables]
+    non_null = statistics.get_non_null_counts()[idx]
+    scaler = clone(transformer)
+    scaler.mean_ = statistics.scaler.mean_[idx].copy()
+    scaler.var_ = statistics.scaler.var_[idx] * non_null / statistics.n_rows
+    scale = np.sqrt(scaler.var_)
+    # constant features are left unscaled, as in StandardScaler
+    scaler.scale_ = np.where(scale < 10 * np.finfo(scale.dtype).eps, 1.0, scale)
+    scaler.n_samples_seen_ = statistics.n_rows
+    scaler.n_features_in_ = len(variables)
+    scaler.feature_names_in_ = np.asarray(variables, dtype=object)
+    return scaler
+
+
+
+def transform_chunks(inputs_pipeline, chunks, n_rows, target_attr_name):
+    ''' Transform the chunks with the fitted pipeline into one preallocated float32 matrix (n_rows rows,
+    see pipeline.to_feature_matrix), and collect the target. Returns the processed inputs as that matrix
+    and the target as a DataFrame. '''
+    processed, targets, start = None, [], 0
+    for chunk in chunks:
+        transformed = inputs_pipeline.transform(chunk.loc[:, chunk.columns != target_attr_name])
+        if processed is None:
+            processed = np.empty((n_rows, transformed.shape[1]), dtype=np.float32)
+        pipeline.to_feature_matrix(transformed, out=processed[start:start + len(chunk)])
+        targets.append(chunk[target_attr_name].to_numpy())
+        start += len(chunk)
+    processed_inputs = processed[:start]
+    processed_target = pd.DataFrame({ target_attr_name: np.concatenate(targets) })
+    return processed_inputs, processed_target
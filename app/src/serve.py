@@ -1,27 +1,234 @@
 
 import uvicorn
-from fastapi import FastAPI
-import sys
+import argparse, os, asyncio, time
+from contextlib import contextmanager
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import PlainTextResponse, JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from pydantic import ValidationError
+import sys, io, json
 import pandas as pd
 import numpy as np
 
-from data_model import DataModel
+from data_model import DataModel, CATEGORY_LISTS
 
 
 sys.path.insert(0, './../../')
 
 import app.src.preprocessing.pipeline as pipeline
 import app.src.model.regressor as regressor
+import app.src.artifact_bundle as artifact_bundle
+from app.src.model.tabulated import TabulatedModel, tabulated_model_dirname
+import app.src.utils as utils
+import app.src.instrumentation as instrumentation
+from app.src.serving.micro_batcher import MicroBatcher
+from app.src.serving.prediction_cache import PredictionCache
+import app.src.serving.prefork as prefork
+from app.src.serving.prefork import PreforkServer
+from app.src.serving.validation import RecordValidator, EncodedBatch
+from app.src.serving.inference_executor import InferenceExecutor, Overloaded, DeadlineExceeded
 
 
 artifacts_path = "./../artifacts/"
+schema_path = "./../data/data_config/"
+
+serve_cfg = utils.get_serve_config()
+# opt-in per-stage timers, exposed on /metrics
+if serve_cfg["instrumentation"]["enabled"]:
+    instrumentation.enable(allocations=serve_cfg["instrumentation"]["track_allocations"])
 
 # Create app 
 app = FastAPI()
-# load preprocessors
-inputs_pipeline = pipeline.load_preprocessor(artifacts_path)
-# load model 
-model = regressor.load_model(artifacts_path)
+# the loaded artifact bundle (preprocessor, compiled pipeline, model, tabulated model; see artifact_bundle.py). 
+# It is loaded lazily and replaced as a whole by one assignment, and each request reads it once, so a request 
+# in flight finishes with the bundle it started with while new requests get the new one. 
+current_bundle = None
+# load of the bundle running in a worker thread, started at startup or by the first request
+bundle_loading = None
+# threads the forest predicts with, applied to every bundle loaded (None: the model's own setting)
+model_n_jobs = None
+bundle_cfg = serve_cfg["artifact_bundle"]
+
+
+def get_schema_hash(): 
+    '''Hash of the data schema the service validates against, or None if it is not available.'''
+    try: 
+        return artifact_bundle.get_schema_hash(utils.get_data_schema(schema_path))
+    except Exception: 
+        return None
+
+
+def build_bundle(): 
+    '''Load the artifact bundle from artifacts_path (verified against its manifest), ready to serve.'''
+    bundle = artifact_bundle.load_bundle(
+        artifacts_path, 
+        schema_hash=get_schema_hash(), 
+        verify=bundle_cfg["verify_checksums"], 
+        # pandas-free version of the fitted preprocessor, used for inference when the pipeline can be compiled
+        compiled_preprocessing=serve_cfg["compiled_preprocessing"], 
+        mmap_model=serve_cfg["mmap_model"], 
+        flat_forest=serve_cfg["flat_forest"]
+    )
+    if model_n_jobs is not None: 
+        bundle.model.set_n_jobs(model_n_jobs)
+    # lookup table of all valid inputs (saved by tabulate.py; built here if missing or out of date)
+    if serve_cfg["tabulated_model"] and bundle.compiled_pipeline is not None:
+        bundle.tabulated_model = load_tabulated_model(bundle.model, bundle.compiled_pipeline)
+    return bundle
+
+
+def load_artifacts(): 
+    '''Load the artifact bundle and swap it in (also called by the pre-fork master, before forking and to reload). 
+    Returns a function that swaps the previous bundle back in (None if there was none), which the master calls 
+    when the workers of a reload do not come up.'''
+    previous_bundle = current_bundle
+    swap_bundle(build_bundle())
+    if previous_bundle is not None: 
+        return lambda: swap_bundle(previous_bundle)
+
+
+def swap_bundle(bundle): 
+    global current_bundle
+    current_bundle = bundle
+    if prediction_cache is not None: 
+        prediction_cache.set_bundle(bundle)
+    print(f"Serving artifact bundle {bundle.version or '(no manifest)'}")
+
+
+def start_loading_bundle(): 
+    '''Start loading the bundle in a worker thread, unless a load is already running; returns the load's task.'''
+    global bundle_loading
+    if bundle_loading is None or bundle_loading.done(): 
+        bundle_loading = asyncio.ensure_future(run_in_threadpool(load_artifacts))
+        bundle_loading.add_done_callback(report_load_error)
+    return bundle_loading
+
+
+def report_load_error(task): 
+    if not task.cancelled() and task.exception() is not None: 
+        print(f"Loading the artifact bundle failed: {task.exception()}")
+
+
+async def get_bundle(): 
+    '''The current bundle, waiting for it to load on first use. A failed load answers 503 (and is retried by the next request).'''
+    if current_bundle is None: 
+        try: 
+            await asyncio.shield(start_loading_bundle())
+        except Exception as e: 
+            raise HTTPException(status_code=503, detail=f"Artifacts are not loaded: {e}")
+    return current_bundle
+
+
+async def watch_bundle(check_seconds): 
+    '''Swap in a new bundle when the manifest changes (and then stays unchanged for one more check). The new 
+    bundle loads in a worker thread while the current one keeps serving; if it fails to load or verify 
+    (e.g. files still being written), the current one is kept.'''
+    manifest_path = os.path.join(artifacts_path, artifact_bundle.manifest_fname)
+    signature = pending_signature = utils.get_file_signature(manifest_path)
+    while True: 
+        await asyncio.sleep(check_seconds)
+        new_signature = utils.get_file_signature(manifest_path)
+        if new_signature != signature and new_signature == pending_signature: 
+            signature = new_signature
+            try: 
+                bundle = await run_in_threadpool(build_bundle)
+            except Exception as e: 
+                print(f"Keeping the current artifact bundle: {e}")
+            else: 
+                swap_bundle(bundle)
+        pending_signature = new_signature
+
+
+def set_model_n_jobs(n_jobs): 
+    '''Set the forest's prediction threads, of the current bundle and of those loaded later.'''
+    global model_n_jobs
+    model_n_jobs = n_jobs
+    if current_bundle is not None: 
+        current_bundle.model.set_n_jobs(n_jobs)
+
+
+def load_tabulated_model(model, compiled_pipeline): 
+    model_checksum = utils.get_file_checksum(os.path.join(artifacts_path, regressor.model_fname))
+    tabulated = TabulatedModel.load(os.path.join(artifacts_path, tabulated_model_dirname), model_checksum=model_checksum)
+    if tabulated is not None: 
+        return tabulated
+    print("No up-to-date tabulated model saved (see tabulate.py), building it ...")
+    num_var, num_range = next(iter(RecordValidator.from_data_model(DataModel, CATEGORY_LISTS).num_ranges.items()))
+    try: 
+        return TabulatedModel.build(model, compiled_pipeline, CATEGORY_LISTS, num_var, num_range)
+    except ValueError as e: 
+        print(f"Not using a tabulated model: {e}")
+        return None
+
+
+# optional cache of predictions for repeated inputs
+prediction_cache = None
+cache_cfg = serve_cfg["prediction_cache"]
+if cache_cfg["enabled"]:
+    prediction_cache = PredictionCache(
+        max_size=cache_cfg["max_size"], 
+        ttl_seconds=cache_cfg["ttl_seconds"], 
+        round_decimals=cache_cfg["round_decimals"]
+    )
+# single-pass validation that encodes the categories for the compiled pipeline (pydantic's DataModel otherwise)
+validator = None
+if serve_cfg["fast_validation"]:
+    validator = RecordValidator.from_data_model(DataModel, CATEGORY_LISTS)
+# optional micro-batcher that merges concurrent /predict calls (see config/serve_config.json)
+batcher = None
+# optional bounded pool that runs all inference, with load shedding and per-request deadlines
+inference_executor = None
+# set once the app has started and cleared when it starts shutting down; reported by /ready
+ready = False
+# task that swaps in new bundles (see watch_bundle)
+bundle_watcher = None
+# task that publishes this worker's stats for the other pre-forked workers (see publish_stats)
+stats_publisher = None
+
+
+@app.on_event("startup")
+async def start_micro_batcher():
+    global batcher, inference_executor, ready, bundle_watcher, stats_publisher
+    # the artifacts load in the background; /ready answers 503 and predictions wait until they are loaded
+    if current_bundle is None: 
+        start_loading_bundle()
+    if bundle_cfg["reload_on_change"]: 
+        bundle_watcher = asyncio.ensure_future(watch_bundle(bundle_cfg["reload_check_seconds"]))
+    executor_cfg = serve_cfg["inference_executor"]
+    if executor_cfg["enabled"]:
+        inference_executor = InferenceExecutor(
+            workers=executor_cfg["workers"] or os.cpu_count() or 1, 
+            max_queue=executor_cfg["max_queue"], 
+            retry_after_seconds=executor_cfg["retry_after_seconds"]
+        )
+        # the executor's workers are the only parallelism: no joblib fan-out inside each call
+        set_model_n_jobs(executor_cfg["threads_per_worker"])
+    batching_cfg = serve_cfg["micro_batching"]
+    if batching_cfg["enabled"]:
+        batcher = MicroBatcher(
+            predict_items, 
+            max_wait_ms=batching_cfg["max_wait_ms"], 
+            max_batch_size=batching_cfg["max_batch_size"], 
+            executor=inference_executor
+        )
+        batcher.start()
+    if prefork.stats_dir is not None: 
+        stats_publisher = asyncio.ensure_future(publish_stats(serve_cfg["prefork"]["stats_publish_seconds"]))
+    ready = True
+
+
+@app.on_event("shutdown")
+async def stop_micro_batcher():
+    global ready
+    ready = False
+    if bundle_watcher is not None: 
+        bundle_watcher.cancel()
+    if stats_publisher is not None: 
+        stats_publisher.cancel()
+    if batcher is not None:
+        await batcher.stop()
+    if inference_executor is not None:
+        inference_executor.shutdown()
 
 
 @app.get("/ping")
@@ -32,12 +239,30 @@ def ping() -> dict:
     return { "message": "Random Forest prediction service is running!" }
 
 
+@app.get("/ready")
+def readiness() -> dict:
+    '''
+    Readiness check: 200 once the artifacts are loaded and the service accepts predictions, 503 before 
+    that and while shutting down (e.g. an old worker draining after a reload). /ping only checks liveness.
+    '''
+    if not ready or current_bundle is None: 
+        return JSONResponse(status_code=503, content={ "ready": False })
+    return { "ready": True, "pid": os.getpid(), "bundle_version": current_bundle.version }
+
+
 # Expose the prediction functionality, make a prediction from the passed
 # JSON data and return the predicted diamond value
-@app.post('/predict')
-def predict(input_: DataModel) -> dict:
+@app.post('/predict', openapi_extra={
+    "requestBody": { "required": True, "content": { "application/json": { "schema": DataModel.schema(by_alias=True) } } }
+})
+async def predict(request: Request, intervals: bool = False) -> dict:
     '''
     Returns predicted price of a diamond given input features. \n
+    With ?intervals=true the response also has an "intervals" object: the standard deviation ("std") and the 
+    quantiles (e.g. "q5", "q95"; see intervals in config/serve_config.json) of the predictions of the individual 
+    trees, computed in the same pass as the prediction. Such requests bypass micro-batching and the prediction cache. \n
+    With the inference executor enabled, an overloaded service answers 503 with a Retry-After header, and a 
+    request not answered within its deadline (timeout_ms, or the X-Request-Timeout-Ms header) gets a 504. \n
     Input is a json object with following keys and corresponding value types: \n 
     * Id: str field used to represent the unique id of the record. It is ignored by the prediction model.
     * Carat Weight: float in range 0.75 to 3.0
@@ -48,17 +273,343 @@ def predict(input_: DataModel) -> dict:
     * Symmetry: Optional str with categorical values: [ 'EX', 'G', 'ID', 'VG',  ]
     * Report: Optional str with categorical values: [ 'AGSL', 'GIA', ]
     '''
-        
-    df = pd.DataFrame.from_records([input_.dict(by_alias=True)])
-    # print(df)    
-    
-    processed_data =  inputs_pipeline.transform(df)    
-    prediction = model.predict(processed_data)[0]    
+    try: 
+        data = await request.json()
+    except ValueError as e: 
+        raise HTTPException(status_code=400, detail=f"Could not parse body: {e}")
+    if validator is not None: 
+        batch, _, errors = validator.validate([data])
+        if len(errors): 
+            return validation_error_response(errors[0])
+        # echo the validated values, not the request's json
+        data = validator.to_records(batch)[0]
+    else: 
+        try: 
+            data, batch = DataModel.parse_obj(data).dict(by_alias=True), None
+        except ValidationError as e: 
+            return validation_error_response(e.errors())
+    deadline = get_deadline(request)
+    bundle = await get_bundle()
+    with overload_responses(): 
+        if intervals: 
+            result = (await run_inference(score_records_with_intervals, bundle, [data], batch, deadline=deadline))[0]
+            return { "data": data, **result }
+        if batcher is not None: 
+            prediction = await with_deadline(batcher.submit((data, batch, bundle)), deadline)
+        else: 
+            prediction = (await run_inference(predict_records, bundle, [data], batch, deadline=deadline))[0]
     return {
-        "data": {**input_.dict(by_alias=True)}, 
+        "data": data, 
         "prediction": np.round(prediction, 4)
     }
 
 
+@app.post('/predict/batch')
+async def predict_batch(request: Request) -> dict:
+    '''
+    Returns predicted prices for a batch of diamonds. \n
+    The body can be a json list of records (same keys as /predict), a csv file with a header row 
+    (Content-Type: text/csv) or newline-delimited json (Content-Type: application/x-ndjson). \n
+    All valid records are pre-processed and scored together in one pass. Results are returned in 
+    input order; records that fail validation get an "errors" entry instead of a "prediction".
+    '''
+    body = await request.body()
+    records = parse_batch_body(body, request.headers.get("content-type", ""))
+    bundle = await get_bundle()
+    with overload_responses(): 
+        results = await run_inference(score_batch, bundle, records, deadline=get_deadline(request))
+    return { "predictions": results }
+
+
+@app.get("/stats")
+def stats() -> dict:
+    '''
+    Returns serving statistics: the version of the artifact bundle in use (null until it is loaded), 
+    micro-batching queue depth and batch sizes, inference executor queue depth, rejections and queue wait, 
+    and prediction cache hits/misses/evictions (each is null when the feature is disabled). 
+    With pre-forked workers, these are the answering worker's (worker_pid), and workers holds the stats of 
+    every worker by pid, as last published (at most prefork.stats_publish_seconds old).
+    '''
+    if prefork.stats_dir is None: 
+        return get_stats()
+    publish_snapshot()
+    workers = { pid: snapshot["stats"] for pid, snapshot in prefork.read_snapshots().items() }
+    return { "worker_pid": os.getpid(), **get_stats(), "workers": workers }
+
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics() -> str:
+    '''
+    Returns histograms of the time (and allocated bytes) of each pre-processing step and of the model, 
+    in Prometheus text format (empty unless instrumentation is enabled in config/serve_config.json), and the 
+    inference executor's queue depth, rejections and queue wait when it is enabled. 
+    With pre-forked workers, the samples are summed over all workers (as last published).
+    '''
+    if prefork.stats_dir is None: 
+        text = get_metrics()
+    else: 
+        publish_snapshot()
+        text = instrumentation.merge_prometheus(snapshot["metrics"] for snapshot in prefork.read_snapshots().values())
+    return PlainTextResponse(text, media_type="text/plain; version=0.0.4")
+
+
+def get_stats(): 
+    return { 
+        "artifact_bundle": current_bundle.info() if current_bundle is not None else None, 
+        "micro_batching": batcher.stats() if batcher is not None else None, 
+        "inference_executor": inference_executor.stats() if inference_executor is not None else None, 
+        "prediction_cache": prediction_cache.stats() if prediction_cache is not None else None, 
+    }
+
+
+def get_metrics(): 
+    text = instrumentation.to_prometheus()
+    if inference_executor is not None: 
+        text += inference_executor.to_prometheus()
+    return text
+
+
+def publish_snapshot(): 
+    prefork.publish_snapshot({ "stats": get_stats(), "metrics": get_metrics() })
+
+
+async def publish_stats(publish_seconds): 
+    '''Publish this worker's stats and metrics every publish_seconds, for /stats and /metrics of the other workers.'''
+    while True: 
+        publish_snapshot()
+        await asyncio.sleep(publish_seconds)
+
+
+
+def get_deadline(request): 
+    '''time.monotonic() deadline of a request (from timeout_ms, or the X-Request-Timeout-Ms header if it is 
+    shorter), or None without the inference executor. The header must be a positive, finite number (else 400).'''
+    if inference_executor is None: 
+        return None
+    timeout_ms = serve_cfg["inference_executor"]["timeout_ms"]
+    header = request.headers.get("x-request-timeout-ms")
+    if header is not None: 
+        try: 
+            requested_ms = float(header)
+        except ValueError: 
+            requested_ms = float("nan")
+        if not (np.isfinite(requested_ms) and requested_ms > 0): 
+            raise HTTPException(status_code=400, detail="X-Request-Timeout-Ms must be a positive number of milliseconds.")
+        timeout_ms = min(requested_ms, timeout_ms) if timeout_ms else requested_ms
+    return time.monotonic() + timeout_ms / 1000.0 if timeout_ms else None
+
+
+
+async def run_inference(fn, *args, deadline=None): 
+    '''Run fn(*args) on the inference executor if enabled, else on the default threadpool.'''
+    if inference_executor is None: 
+        return await run_in_threadpool(fn, *args)
+    return await inference_executor.submit(fn, *args, deadline=deadline)
+
+
+
+async def with_deadline(awaitable, deadline): 
+    if deadline is None: 
+        return await awaitable
+    try: 
+        return await asyncio.wait_for(awaitable, max(0.0, deadline - time.monotonic()))
+    except asyncio.TimeoutError: 
+        raise DeadlineExceeded("Deadline exceeded before the prediction was made.")
+
+
+
+@contextmanager
+def overload_responses(): 
+    '''Turn the inference executor's errors into 503 (queue full, with Retry-After) and 504 (deadline exceeded) responses.'''
+    try: 
+        yield
+    except Overloaded as e: 
+        raise HTTPException(status_code=503, detail=str(e), headers={ "Retry-After": str(inference_executor.retry_after_seconds) })
+    except DeadlineExceeded as e: 
+        raise HTTPException(status_code=504, detail=str(e))
+
+
+
+def validation_error_response(errors): 
+    '''422 response in the same format as FastAPI's request validation errors.'''
+    return JSONResponse(status_code=422, content={ "detail": [{ **error, "loc": ["body"] + list(error["loc"]) } for error in errors] })
+
+
+
+def predict_items(items): 
+    '''Predict the (record, EncodedBatch or None, bundle) items submitted to the micro-batcher by /predict. Each record 
+    is scored with the bundle its request got, so items submitted before and after a bundle swap are scored separately.'''
+    predictions = np.empty(len(items))
+    groups = {}
+    for i, (_, _, bundle) in enumerate(items): 
+        groups.setdefault(id(bundle), (bundle, []))[1].append(i)
+    for bundle, idx in groups.values(): 
+        batches = [items[i][1] for i in idx]
+        batch = EncodedBatch.concat(batches) if all(b is not None for b in batches) else None
+        predictions[idx] = predict_records(bundle, [items[i][0] for i in idx], batch)
+    return predictions
+
+
+
+def predict_records(bundle, records, batch=None): 
+    '''Predict a list of validated records (dicts keyed by field alias) with bundle, optionally with their EncodedBatch 
+    from the fast-path validator. Cached predictions are reused and the remaining records are scored together in one pass.'''
+    if prediction_cache is None: 
+        return score_records(bundle, records, batch)
+    if batch is not None: 
+        keys = prediction_cache.make_encoded_keys(batch)
+    else: 
+        keys = [prediction_cache.make_key(record) for record in records]
+    predictions = prediction_cache.get_many(keys, bundle)
+    missing = [i for i, prediction in enumerate(predictions) if prediction is None]
+    if len(missing): 
+        scored = score_records(bundle, [records[i] for i in missing], batch.take(missing) if batch is not None else None)
+        # predictions of a bundle swapped out meanwhile are dropped by the cache
+        prediction_cache.put_many([keys[i] for i in missing], scored, bundle)
+        for i, prediction in zip(missing, scored): 
+            predictions[i] = prediction
+    return np.array(predictions)
+
+
+
+def preprocess_records(bundle, records, batch=None): 
+    '''Pre-process a list of validated records in one pass (from their category codes if batch is given).'''
+    if bundle.compiled_pipeline is not None:
+        with instrumentation.stage("preprocess.compiled_pipeline"):
+            if batch is not None: 
+                return bundle.compiled_pipeline.transform_encoded(batch)
+            return bundle.compiled_pipeline.transform(records)
+    return pipeline.to_feature_matrix(instrumentation.transform(bundle.inputs_pipeline, pd.DataFrame.from_records(records)))
+
+
+
+def score_records(bundle, records, batch=None): 
+    '''Pre-process and score a list of validated records in one pass, or look them up in the tabulated model.'''
+    if bundle.tabulated_model is not None: 
+        with instrumentation.stage("model.tabulated_lookup"): 
+            return bundle.tabulated_model.predict_encoded(batch) if batch is not None else bundle.tabulated_model.predict(records)
+    return bundle.model.predict(preprocess_records(bundle, records, batch))
+
+
+
+def score_records_with_intervals(bundle, records, batch=None): 
+    '''score_records with the spread of the tree predictions: a "prediction" and "intervals" dict per record.'''
+    quantiles = serve_cfg["intervals"]["quantiles"]
+    outputs = bundle.model.predict_with_uncertainty(preprocess_records(bundle, records, batch), quantiles=quantiles)
+    return [
+        { 
+            "prediction": np.round(outputs["prediction"][i], 4), 
+            "intervals": { 
+                "std": np.round(outputs["std"][i], 4), 
+                **{ f"q{100 * q:g}": np.round(outputs["quantiles"][q][i], 4) for q in quantiles }, 
+            }, 
+        }
+        for i in range(len(records))
+    ]
+
+
+
+def parse_batch_body(body, content_type): 
+    '''Parse a batch request body into a list of raw records. Unparseable ndjson lines are kept as 
+    strings so they are reported as invalid records at their position in the batch.'''
+    content_type = content_type.split(";")[0].strip().lower()
+    try: 
+        if content_type == "text/csv": 
+            df = pd.read_csv(io.BytesIO(body), dtype=str, keep_default_na=False)
+            return df.to_dict(orient="records")
+        elif content_type in ("application/x-ndjson", "application/ndjson", "application/jsonlines"): 
+            records = []
+            for line in body.decode("utf-8").splitlines(): 
+                if not line.strip(): continue
+                try: 
+                    records.append(json.loads(line))
+                except ValueError: 
+                    records.append(line)
+            return records
+        else: 
+            records = json.loads(body)
+    except (ValueError, pd.errors.ParserError) as e: 
+        raise HTTPException(status_code=400, detail=f"Could not parse batch body: {e}")
+    if not isinstance(records, list): 
+        raise HTTPException(status_code=400, detail="Batch body must be a json list of records.")
+    return records
+
+
+
+def score_batch(bundle, records): 
+    '''Validate each record on its own, score all valid ones together with bundle and return results in input order.'''
+    if validator is not None: 
+        return score_batch_fast(bundle, records)
+    results = [None] * len(records)
+    valid_idx, valid_records = [], []
+    for i, record in enumerate(records): 
+        if not isinstance(record, dict): 
+            results[i] = { "Id": None, "errors": [{"loc": [], "msg": "record must be a json object"}] }
+            continue
+        try: 
+            valid_records.append(DataModel.parse_obj(record).dict(by_alias=True))
+            valid_idx.append(i)
+        except ValidationError as e: 
+            results[i] = { "Id": record.get("Id"), "errors": e.errors() }
+    
+    if len(valid_records): 
+        predictions = predict_records(bundle, valid_records)
+        for i, record, prediction in zip(valid_idx, valid_records, predictions): 
+            results[i] = { "Id": record["Id"], "prediction": np.round(prediction, 4) }
+    return results
+
+
+
+def score_batch_fast(bundle, records): 
+    '''score_batch with the single-pass validator: the valid records are scored from their category codes.'''
+    results = [None] * len(records)
+    batch, valid_idx, errors = validator.validate(records)
+    for i, record_errors in errors.items(): 
+        record_id = records[i].get("Id") if isinstance(records[i], dict) else None
+        results[i] = { "Id": record_id, "errors": record_errors }
+    if len(valid_idx): 
+        predictions = predict_records(bundle, [records[i] for i in valid_idx], batch)
+        for i, record_id, prediction in zip(valid_idx, batch.ids, predictions): 
+            results[i] = { "Id": record_id, "prediction": np.round(prediction, 4) }
+    return results
+
+
+def limit_worker_threads(): 
+    '''Cap the forest's joblib threads (and native thread pools) of a pre-forked worker, so that 
+    workers x threads does not exceed the number of cores.'''
+    from threadpoolctl import threadpool_limits
+    prefork_cfg = serve_cfg["prefork"]
+    threads = prefork_cfg["threads_per_worker"] or max(1, (os.cpu_count() or 1) // prefork_cfg["workers"])
+    set_model_n_jobs(threads)
+    threadpool_limits(threads)
+
+
 if __name__ == "__main__": 
-    uvicorn.run(app, host="0.0.0.0", port=80)             
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=80)
+    parser.add_argument("--workers", type=int, default=None, 
+                        help="worker processes forked after loading the artifacts (default: prefork.workers in serve_config.json)")
+    args = parser.parse_args()
+    
+    prefork_cfg = serve_cfg["prefork"]
+    if args.workers is not None: 
+        prefork_cfg["workers"] = args.workers
+    if prefork_cfg["workers"] <= 1: 
+        uvicorn.run(app, host=args.host, port=args.port)
+    else: 
+        # the master loads the bundle before forking (the workers share it) and reloads it on changes itself
+        load_artifacts()
+        bundle_cfg["reload_on_change"] = False
+        PreforkServer(
+            app, 
+            load_artifacts, 
+            host=args.host, 
+            port=args.port, 
+            workers=prefork_cfg["workers"], 
+            watch_path=os.path.join(artifacts_path, artifact_bundle.manifest_fname) if prefork_cfg["reload_on_change"] else None, 
+            reload_check_seconds=prefork_cfg["reload_check_seconds"], 
+            graceful_timeout=prefork_cfg["graceful_timeout_seconds"], 
+            setup_worker_fn=limit_worker_threads
+        ).run()             
\ No newline at end of file
@@ -0,0 +1,141 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import app.src.instrumentation as instrumentation
+from app.src.instrumentation import Histogram, SECONDS_BUCKETS
+
+
+
+class Overloaded(Exception):
+    ''' Raised by InferenceExecutor.submit when its queue is full. '''
+
+
+class DeadlineExceeded(Exception):
+    ''' Raised by InferenceExecutor.submit when the call's deadline passed before it finished. '''
+
+
+
+class InferenceExecutor():
+    ''' Runs inference calls on a dedicated pool of worker threads with a bounded queue.
+    - Admission: at most workers calls run and max_queue wait; further submits fail at once with Overloaded
+      (the service answers 503 with a Retry-After header) instead of queueing without limit.
+    - Deadlines: a call whose deadline (a time.monotonic() value) passes while it waits is dropped before it
+      runs, and the caller stops waiting at the deadline (a call already running is not interrupted).
+    - The time each call waits in the queue and runs is recorded into histograms (stats() and to_prometheus(),
+      and the "executor.queue_wait" stage of the instrumentation when it is enabled).
+    submit() must be called from the event loop.
+    '''
+    def __init__(self, workers, max_queue, retry_after_seconds=1) -> None:
+        self.workers = int(workers)
+        self.max_queue = int(max_queue)
+        self.retry_after_seconds = retry_after_seconds
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="inference")
+        # calls queued or running; incremented by submit, decremented when the call finishes or is cancelled
+        self.pending = 0
+        self.lock = threading.Lock()
+
+        self.num_submitted = 0
+        self.num_rejected = 0
+        self.num_deadline_exceeded = 0
+        self.num_failed = 0
+        self.max_queue_depth = 0
+        self.queue_wait = Histogram(SECONDS_BUCKETS)
+        self.run_time = Histogram(SECONDS_BUCKETS)
+
+
+    @property
+    def queue_depth(self):
+        return max(0, self.pending - self.workers)
+
+
+    async def submit(self, fn, *args, deadline=None):
+        ''' Run fn(*args) on the pool and return its result. Raises Overloaded if the queue is full and
+        DeadlineExceeded if the deadline passes first. '''
+        with self.lock:
+            if self.pending >= self.workers + self.max_queue:
+                self.num_rejected += 1
+                raise Overloaded(f"Inference queue is full ({self.max_queue} calls waiting).")
+            self.pending += 1
+            self.num_submitted += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        future = self.pool.submit(self._run, fn, args, time.monotonic(), deadline)
+        future.add_done_callback(self._done)
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except (asyncio.TimeoutError, DeadlineExceeded):
+            # a call still waiting is cancelled with the wrapping future; one already running finishes
+            with self.lock:
+                self.num_deadline_exceeded += 1
+            raise DeadlineExceeded("Deadline exceeded before the prediction was made.")
+        except Exception:
+            with self.lock:
+                self.num_failed += 1
+            raise
+
+
+    def _run(self, fn, args, enqueued, deadline):
+        started = time.monotonic()
+        with self.lock:
+            self.queue_wait.observe(started - enqueued)
+        instrumentation.observe("executor.queue_wait", started - enqueued)
+        if deadline is not None and started >= deadline:
+            raise DeadlineExceeded()
+        try:
+            return fn(*args)
+        finally:
+            with self.lock:
+                self.run_time.observe(time.monotonic() - started)
+
+
+    def _done(self, future):
+        with self.lock:
+            self.pending -= 1
+
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True, cancel_futures=True)
+
+
+    def stats(self):
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "queue_depth": self.queue_depth,
+                "max_queue_depth": self.max_queue_depth,
+                "running": min(self.pending, self.workers),
+                "num_submitted": self.num_submitted,
+                "num_rejected": self.num_rejected,
+                "num_deadline_exceeded": self.num_deadline_exceeded,
+                "num_failed": self.num_failed,
+                "mean_queue_wait_ms": 1000.0 * self.queue_wait.sum / self.queue_wait.count if self.queue_wait.count else 0.0,
+                "max_queue_wait_ms": 1000.0 * self.queue_wait.max,
+                "mean_run_time_ms": 1000.0 * self.run_time.sum / self.run_time.count if self.run_time.count else 0.0,
+            }
+
+
+    def to_prometheus(self):
+        ''' Queue depth, counters and queue wait / run time histograms in Prometheus text format. '''
+        lines = []
+        with self.lock:
+            for metric, metric_type, value, help_text in [
+                ("inference_queue_depth", "gauge", self.queue_depth, "Inference calls waiting for a worker."),
+                ("inference_running", "gauge", min(self.pending, self.workers), "Inference calls running."),
+                ("inference_rejected_total", "counter", self.num_rejected, "Inference calls rejected because the queue was full."),
+                ("inference_deadline_exceeded_total", "counter", self.num_deadline_exceeded, "Inference calls that missed their deadline."),
+            ]:
+                lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} {metric_type}", f"{metric} {value}"]
+            for metric, histogram, help_text in [
+                ("inference_queue_wait_seconds", self.queue_wait, "Time inference calls waited for a worker."),
+                ("inference_run_seconds", self.run_time, "Time inference calls ran on a worker."),
+            ]:
+                lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} histogram"]
+                for bound, count in zip(histogram.bounds, histogram.counts):
+                    lines.append(f'{metric}_bucket{{le="{bound:g}"}} {count}')
+                lines.append(f'{metric}_bucket{{le="+Inf"}} {histogram.count}')
+                lines.append(f"{metric}_sum {histogram.sum:g}")
+                lines.append(f"{metric}_count {histogram.count}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,115 @@
+import asyncio
+import time
+import numpy as np
+
+
+# upper bounds of the batch-size histogram buckets; the last bucket catches everything above
+BATCH_SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128, 256]
+
+
+class MicroBatcher():
+    ''' Merges concurrent single-record prediction requests into one scoring call.
+    Requests are held until either max_batch_size records are waiting or max_wait_ms has passed
+    since the first record of the batch arrived. The batch is then scored as one matrix by
+    score_fn (a function taking a list of records and returning one prediction per record) on a
+    worker thread, and each result is routed back to the caller that submitted the record.
+    With an executor (see inference_executor.py) the batches are scored on its workers, so a full
+    executor queue fails the batch's callers with its Overloaded error.
+    '''
+    def __init__(self, score_fn, max_wait_ms=2, max_batch_size=64, executor=None) -> None:
+        self.score_fn = score_fn
+        self.executor = executor
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_batch_size = int(max_batch_size)
+        self.queue = None
+        self.worker = None
+
+        self.num_batches = 0
+        self.num_records = 0
+        self.max_queue_depth = 0
+        self.batch_size_counts = [0] * (len(BATCH_SIZE_BUCKETS) + 1)
+        self.total_queue_wait = 0.0
+        self.total_score_time = 0.0
+
+
+    def start(self):
+        # the queue must be created inside the running event loop
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.get_event_loop().create_task(self._run())
+
+
+    async def stop(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+
+
+    async def submit(self, record):
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((record, future, time.perf_counter()))
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        return await future
+
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0: break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # skip records whose callers have gone away (e.g. client disconnected)
+            batch = [item for item in batch if not item[1].cancelled()]
+            if len(batch) == 0: continue
+
+            start = time.perf_counter()
+            self._record_batch(batch, start)
+            try:
+                records = [record for record, _, _ in batch]
+                if self.executor is not None:
+                    predictions = await self.executor.submit(self.score_fn, records)
+                else:
+                    predictions = await loop.run_in_executor(None, self.score_fn, records)
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done(): future.set_exception(e)
+            else:
+                for (_, future, _), prediction in zip(batch, predictions):
+                    if not future.done(): future.set_result(prediction)
+            self.total_score_time += time.perf_counter() - start
+
+
+    def _record_batch(self, batch, now):
+        self.num_batches += 1
+        self.num_records += len(batch)
+        self.batch_size_counts[int(np.searchsorted(BATCH_SIZE_BUCKETS, len(batch)))] += 1
+        self.total_queue_wait += sum(now - enqueued for _, _, enqueued in batch)
+
+
+    def stats(self):
+        bucket_labels = [str(b) for b in BATCH_SIZE_BUCKETS] + ["+Inf"]
+        return {
+            "max_wait_ms": self.max_wait * 1000.0,
+            "max_batch_size": self.max_batch_size,
+            "queue_depth": self.queue.qsize() if self.queue is not None else 0,
+            "max_queue_depth": self.max_queue_depth,
+            "num_batches": self.num_batches,
+            "num_records": self.num_records,
+            "mean_batch_size": self.num_records / self.num_batches if self.num_batches else 0.0,
+            "batch_size_histogram": dict(zip(bucket_labels, self.batch_size_counts)),
+            "mean_queue_wait_ms": 1000.0 * self.total_queue_wait / self.num_records if self.num_records else 0.0,
+            "mean_score_time_ms": 1000.0 * self.total_score_time / self.num_batches if self.num_batches else 0.0,
+        }
@@ -0,0 +1,111 @@
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+
+
+class PredictionCache():
+    ''' Bounded LRU cache of predictions keyed on the validated input fields.
+    - The id field is left out of the key, so the same diamond sent under different ids is a hit.
+    - round_decimals optionally rounds float fields (e.g. Carat Weight) in the key, so nearby values share an entry.
+    - Entries older than ttl_seconds (if given) count as misses.
+    - Entries belong to the bundle set with set_bundle (the one being served): setting another bundle clears
+      them, and lookups and inserts for any other bundle (e.g. of a request still in flight after a swap) are
+      misses and dropped. The check and the insert happen under the lock set_bundle clears under, so a
+      prediction of a swapped-out model is never stored. This is the only invalidation: files written to the
+      artifacts folder do not matter until their bundle is swapped in.
+    All methods are thread-safe.
+    '''
+    def __init__(self, max_size=100000, ttl_seconds=None, round_decimals=None, id_field="Id") -> None:
+        self.max_size = int(max_size)
+        self.ttl_seconds = ttl_seconds
+        self.round_decimals = round_decimals
+        self.id_field = id_field
+
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.bundle = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+
+    def make_key(self, record):
+        key = []
+        for field, value in sorted(record.items()):
+            if field == self.id_field: continue
+            if self.round_decimals is not None and isinstance(value, float):
+                value = round(value, self.round_decimals)
+            key.append((field, value))
+        return tuple(key)
+
+
+    def make_encoded_keys(self, batch):
+        ''' Keys for the rows of an EncodedBatch (see serving/validation.py): its category codes and numeric values. '''
+        num_values = batch.num_values if self.round_decimals is None else np.round(batch.num_values, self.round_decimals)
+        return list(zip(map(tuple, batch.cat_codes.tolist()), map(tuple, num_values.tolist())))
+
+
+    def set_bundle(self, bundle):
+        ''' Make the cache hold the predictions of bundle, clearing those of any other. '''
+        with self.lock:
+            if bundle is self.bundle: return
+            if len(self.entries):
+                self.invalidations += 1
+            self.entries.clear()
+            self.bundle = bundle
+
+
+    def get_many(self, keys, bundle):
+        ''' Return the cached prediction of bundle for each key, or None for misses. '''
+        now = time.monotonic()
+        results = []
+        with self.lock:
+            if bundle is not self.bundle:
+                self.misses += len(keys)
+                return [None] * len(keys)
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is not None and self.ttl_seconds is not None and now - entry[1] > self.ttl_seconds:
+                    del self.entries[key]
+                    self.expirations += 1
+                    entry = None
+                if entry is None:
+                    self.misses += 1
+                    results.append(None)
+                else:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    results.append(entry[0])
+        return results
+
+
+    def put_many(self, keys, predictions, bundle):
+        ''' Cache the predictions of bundle, unless another bundle has been set meanwhile. '''
+        now = time.monotonic()
+        with self.lock:
+            if bundle is not self.bundle: return
+            for key, prediction in zip(keys, predictions):
+                self.entries[key] = (prediction, now)
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
@@ -0,0 +1,268 @@
+import gc
+import json
+import os
+import re
+import select
+import shutil
+import signal
+import socket
+import tempfile
+import time
+
+import uvicorn
+
+import app.src.utils as utils
+
+
+# folder the workers publish their stats snapshots to (see publish_snapshot); set in each worker, None otherwise
+stats_dir = None
+snapshot_fname_pattern = re.compile(r"^(\d+)\.json$")
+
+
+class WorkerServer(uvicorn.Server):
+    ''' uvicorn server that writes a byte to ready_fd once it is listening, to tell the master it is up. '''
+    def __init__(self, config, ready_fd) -> None:
+        super().__init__(config)
+        self.ready_fd = ready_fd
+
+
+    async def startup(self, sockets=None):
+        await super().startup(sockets=sockets)
+        os.write(self.ready_fd, b"1")
+        os.close(self.ready_fd)
+
+
+
+class PreforkServer():
+    ''' Serves app from several worker processes forked from a master process that has already loaded the
+    artifacts (load_fn), so the workers start instantly and share the master's memory pages copy-on-write.
+    All workers accept connections on one listening socket opened by the master.
+    - Workers that die are restarted.
+    - When the file watch_path (the bundle's manifest) changes (and then stays unchanged for one more check), or on SIGHUP,
+      the master reloads the artifacts and rolls the workers: a new set is forked, and once it is up the
+      old workers are sent SIGTERM, which makes uvicorn stop accepting and finish in-flight requests.
+      If reloading fails, or not all new workers are up within graceful_timeout, the new workers are stopped
+      and the old workers keep serving; if load_fn returned a function, it is called to restore the
+      previously loaded artifacts, so old workers restarted later serve the same artifacts.
+    - SIGTERM or SIGINT stops all workers gracefully (SIGKILL after graceful_timeout seconds).
+    setup_worker_fn, if given, runs in each worker right after the fork (e.g. to cap thread pools).
+    Each process only counts its own requests, so the master creates a folder (stats_dir) where workers publish
+    snapshots of their stats (publish_snapshot) and any worker can read all of them (read_snapshots). The
+    snapshot of a worker is removed once it exits, so the totals drop by its counts.
+    '''
+    def __init__(self, app, load_fn, host, port, workers, watch_path=None, reload_check_seconds=5.0,
+                 graceful_timeout=30.0, setup_worker_fn=None, log_level="info") -> None:
+        self.app = app
+        self.load_fn = load_fn
+        self.host = host
+        self.port = port
+        self.num_workers = int(workers)
+        self.watch_path = watch_path
+        self.reload_check_seconds = reload_check_seconds
+        self.graceful_timeout = graceful_timeout
+        self.setup_worker_fn = setup_worker_fn
+        self.log_level = log_level
+
+        self.sock = None
+        self.stats_dir = None
+        # pid -> generation; workers of older generations are not restarted when they exit
+        self.workers = {}
+        self.generation = 0
+        self.should_exit = False
+        self.should_reload = False
+
+
+    def run(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.host, self.port))
+        self.sock.listen(2048)
+        self.sock.set_inheritable(True)
+        self.stats_dir = tempfile.mkdtemp(prefix="prefork-stats-")
+
+        signal.signal(signal.SIGTERM, self.handle_exit)
+        signal.signal(signal.SIGINT, self.handle_exit)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+
+        freeze_heap()
+        self.start_workers()
+        print(f"Master {os.getpid()} serving on http://{self.host}:{self.port} with {self.num_workers} workers")
+
+        signature = pending_signature = self.get_signature()
+        last_check = time.monotonic()
+        while not self.should_exit:
+            time.sleep(0.2)
+            self.reap_workers()
+            if self.watch_path is not None and time.monotonic() - last_check >= self.reload_check_seconds:
+                last_check = time.monotonic()
+                new_signature = self.get_signature()
+                # only reload once the files stopped changing, so half-written artifacts are not loaded
+                if new_signature != signature and new_signature == pending_signature:
+                    self.should_reload = True
+                pending_signature = new_signature
+            if self.should_reload:
+                self.should_reload = False
+                signature = pending_signature = self.get_signature()
+                self.reload()
+        self.stop_workers(list(self.workers))
+        self.sock.close()
+        shutil.rmtree(self.stats_dir, ignore_errors=True)
+
+
+    def handle_exit(self, signum, frame):
+        self.should_exit = True
+
+
+    def handle_reload(self, signum, frame):
+        self.should_reload = True
+
+
+    def get_signature(self):
+        return utils.get_file_signature(self.watch_path) if self.watch_path is not None else None
+
+
+    def start_workers(self, count=None):
+        ''' Fork count (default: all) workers of the current generation and wait until they are listening.
+        Returns the pids of the workers that signalled they are ready within graceful_timeout. '''
+        pending = dict(self.spawn_worker() for _ in range(count or self.num_workers))
+        ready = []
+        deadline = time.monotonic() + self.graceful_timeout
+        while pending and time.monotonic() < deadline:
+            readable, _, _ = select.select(list(pending), [], [], max(0.0, deadline - time.monotonic()))
+            for fd in readable:
+                # a worker that exits before it is listening closes the pipe without writing
+                if os.read(fd, 1):
+                    ready.append(pending[fd])
+                os.close(fd)
+                del pending[fd]
+        for fd in pending:
+            os.close(fd)
+        return ready
+
+
+    def spawn_worker(self):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            try:
+                self.run_worker(write_fd)
+            finally:
+                os._exit(0)
+        os.close(write_fd)
+        self.workers[pid] = self.generation
+        return read_fd, pid
+
+
+    def run_worker(self, ready_fd):
+        global stats_dir
+        stats_dir = self.stats_dir
+        # the master's handlers must not run in the workers; uvicorn installs its own for SIGTERM/SIGINT
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        if self.setup_worker_fn is not None:
+            self.setup_worker_fn()
+        config = uvicorn.Config(self.app, host=self.host, port=self.port, log_level=self.log_level)
+        WorkerServer(config, ready_fd).run(sockets=[self.sock])
+
+
+    def reap_workers(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            generation = self.workers.pop(pid, None)
+            self.remove_snapshot(pid)
+            if generation == self.generation and not self.should_exit:
+                print(f"Worker {pid} exited with status {status}; restarting it")
+                self.start_workers(count=1)
+
+
+    def reload(self):
+        print("Reloading artifacts ...")
+        gc.unfreeze()
+        try:
+            restore_fn = self.load_fn()
+        except Exception as e:
+            print(f"Reloading artifacts failed, keeping the current workers: {e}")
+            return
+        finally:
+            freeze_heap()
+        old_workers = list(self.workers)
+        self.generation += 1
+        ready = self.start_workers()
+        new_workers = [pid for pid, generation in self.workers.items() if generation == self.generation]
+        if sorted(ready) != sorted(new_workers):
+            print(f"Only {len(ready)} of {len(new_workers)} new workers came up; stopping them and keeping the current workers")
+            self.generation -= 1
+            self.stop_workers(new_workers)
+            if callable(restore_fn):
+                restore_fn()
+            return
+        self.stop_workers(old_workers)
+        print(f"Reloaded artifacts; workers are now {sorted(self.workers)}")
+
+
+    def stop_workers(self, pids):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + self.graceful_timeout
+        remaining = set(pids)
+        while remaining and time.monotonic() < deadline:
+            for pid in list(remaining):
+                try:
+                    if os.waitpid(pid, os.WNOHANG)[0] == 0: continue
+                except ChildProcessError:
+                    pass
+                remaining.discard(pid)
+                self.workers.pop(pid, None)
+                self.remove_snapshot(pid)
+            time.sleep(0.05)
+        for pid in remaining:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            self.workers.pop(pid, None)
+            self.remove_snapshot(pid)
+
+
+    def remove_snapshot(self, pid):
+        try:
+            os.remove(os.path.join(self.stats_dir, f"{pid}.json"))
+        except FileNotFoundError:
+            pass
+
+
+
+def freeze_heap():
+    ''' Move all objects to the permanent generation, so the workers' garbage collector does not write to
+    (and thereby copy) the pages holding the master's objects, such as the loaded model. '''
+    gc.collect()
+    gc.freeze()
+
+
+
+def publish_snapshot(snapshot):
+    ''' Write this worker's snapshot (a jsonable dict) to stats_dir, replacing its previous one. '''
+    utils.save_json(os.path.join(stats_dir, f"{os.getpid()}.json"), snapshot)
+
+
+def read_snapshots():
+    ''' The last published snapshot of each running worker, by pid. '''
+    snapshots = {}
+    for fname in sorted(os.listdir(stats_dir)):
+        match = snapshot_fname_pattern.match(fname)
+        if match is None: continue
+        # a worker that exits in between has its snapshot removed
+        try:
+            with open(os.path.join(stats_dir, fname)) as f:
+                snapshots[int(match.group(1))] = json.load(f)
+        except FileNotFoundError:
+            continue
+    return snapshots
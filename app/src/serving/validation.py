@@ -0,0 +1,169 @@
+import numpy as np
+
+
+
+class EncodedBatch():
+    ''' Validated records as arrays, ready for CompiledPipeline.transform_encoded:
+        - ids: the record ids, as strings
+        - cat_codes: (n_rows, n_cat_vars) index of each categorical value in its list of allowed values
+        - num_values: (n_rows, n_num_vars) numeric values as float64
+    categories holds the allowed values of each categorical variable, in code order.
+    '''
+    def __init__(self, ids, cat_codes, num_values, cat_vars, num_vars, categories) -> None:
+        self.ids = ids
+        self.cat_codes = cat_codes
+        self.num_values = num_values
+        self.cat_vars = cat_vars
+        self.num_vars = num_vars
+        self.categories = categories
+
+
+    def __len__(self):
+        return len(self.ids)
+
+
+    def take(self, idx):
+        return EncodedBatch([self.ids[i] for i in idx], self.cat_codes[idx], self.num_values[idx],
+                            self.cat_vars, self.num_vars, self.categories)
+
+
+    @classmethod
+    def concat(cls, batches):
+        first = batches[0]
+        return cls([id_ for batch in batches for id_ in batch.ids],
+                   np.concatenate([batch.cat_codes for batch in batches]),
+                   np.concatenate([batch.num_values for batch in batches]),
+                   first.cat_vars, first.num_vars, first.categories)
+
+
+
+class RecordValidator():
+    ''' Single-pass validator for prediction records (dicts keyed by field alias), equivalent to
+    DataModel.parse_obj but without building model objects:
+        - categorical fields are looked up in a dict from allowed value to code, which validates and
+          encodes them in one step
+        - numeric fields are converted with float() and checked against their (min, max) range
+        - the id is converted to a string
+    Errors use the same loc/msg/type format as pydantic.
+    '''
+    def __init__(self, categories, num_ranges, id_field="Id", field_order=None) -> None:
+        self.cat_vars = list(categories)
+        self.num_vars = list(num_ranges)
+        self.categories = { var: list(values) for var, values in categories.items() }
+        self.code_tables = { var: { value: code for code, value in enumerate(values) } for var, values in categories.items() }
+        self.num_ranges = num_ranges
+        self.id_field = id_field
+        # key order of the records returned by to_records
+        fields = [id_field] + self.num_vars + self.cat_vars
+        self.field_order = [field for field in field_order if field in fields] if field_order is not None else fields
+        # same message as data_model.validate_v_in_list
+        self.category_errors = { var: { "loc": [var], "msg": f"Variable {var} must have one of these values:  {values}", "type": "value_error" }
+                                 for var, values in self.categories.items() }
+
+
+    @classmethod
+    def from_data_model(cls, data_model, categories):
+        ''' Build the validator for a pydantic model: its numeric fields (with their ge/le bounds) and the
+        fields in categories (a dict from field alias to allowed values), keyed and ordered by field alias. '''
+        num_ranges, model_categories = {}, {}
+        for field in data_model.__fields__.values():
+            if field.alias in categories:
+                model_categories[field.alias] = categories[field.alias]
+            elif isinstance(field.type_, type) and issubclass(field.type_, (float, int)):
+                num_ranges[field.alias] = (field.field_info.ge, field.field_info.le)
+        return cls(model_categories, num_ranges, field_order=[field.alias for field in data_model.__fields__.values()])
+
+
+    def validate(self, records):
+        ''' Validate and encode a list of records.
+        Returns the EncodedBatch of the valid records, their positions in records, and a dict from the
+        position of each invalid record to its list of errors. '''
+        n_rows = len(records)
+        ids, valid_idx, errors = [], [], {}
+        cat_codes = np.empty((n_rows, len(self.cat_vars)), dtype=np.int16)
+        num_values = np.empty((n_rows, len(self.num_vars)), dtype=np.float64)
+        row = 0
+        for i, record in enumerate(records):
+            if not isinstance(record, dict):
+                errors[i] = [{ "loc": [], "msg": "record must be a json object" }]
+                continue
+            record_errors = []
+            record_id = self._validate_id(record, record_errors)
+            for j, var in enumerate(self.cat_vars):
+                value = record.get(var)
+                try:
+                    code = self.code_tables[var].get(value)
+                except TypeError:
+                    code = None
+                if code is None:
+                    record_errors.append(self.category_errors[var] if value is not None else none_error(var, record))
+                else:
+                    cat_codes[row, j] = code
+            for j, var in enumerate(self.num_vars):
+                value = self._validate_number(var, record, record_errors)
+                if value is not None:
+                    num_values[row, j] = value
+            if len(record_errors):
+                errors[i] = record_errors
+                continue
+            ids.append(record_id)
+            valid_idx.append(i)
+            row += 1
+
+        batch = EncodedBatch(ids, cat_codes[:row], num_values[:row], self.cat_vars, self.num_vars, self.categories)
+        return batch, valid_idx, errors
+
+
+    def to_records(self, batch):
+        ''' The validated records of batch as dicts keyed by field alias, in the data model's field order and with
+        the values DataModel.dict(by_alias=True) gives: the id as a string, numbers as floats and each category
+        as its allowed value. Fields that are not validated are not included. '''
+        columns = { self.id_field: batch.ids }
+        for j, var in enumerate(batch.cat_vars):
+            values = batch.categories[var]
+            columns[var] = [values[code] for code in batch.cat_codes[:, j]]
+        for j, var in enumerate(batch.num_vars):
+            columns[var] = batch.num_values[:, j].tolist()
+        return [dict(zip(self.field_order, row)) for row in zip(*(columns[field] for field in self.field_order))]
+
+
+    def _validate_id(self, record, record_errors):
+        value = record.get(self.id_field)
+        if isinstance(value, str):
+            return value
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return str(value)
+        if value is None:
+            record_errors.append(none_error(self.id_field, record))
+        else:
+            record_errors.append({ "loc": [self.id_field], "msg": "str type expected", "type": "type_error.str" })
+        return None
+
+
+    def _validate_number(self, var, record, record_errors):
+        if record.get(var) is None:
+            record_errors.append(none_error(var, record))
+            return None
+        try:
+            value = float(record[var])
+        except (TypeError, ValueError):
+            record_errors.append({ "loc": [var], "msg": "value is not a valid float", "type": "type_error.float" })
+            return None
+        low, high = self.num_ranges[var]
+        if low is not None and not value >= low:
+            record_errors.append({ "loc": [var], "msg": f"ensure this value is greater than or equal to {low}",
+                                   "type": "value_error.number.not_ge", "ctx": { "limit_value": low } })
+            return None
+        if high is not None and not value <= high:
+            record_errors.append({ "loc": [var], "msg": f"ensure this value is less than or equal to {high}",
+                                   "type": "value_error.number.not_le", "ctx": { "limit_value": high } })
+            return None
+        return value
+
+
+
+def none_error(var, record):
+    ''' Error for a missing field, or a field sent as null. '''
+    if var not in record:
+        return { "loc": [var], "msg": "field required", "type": "value_error.missing" }
+    return { "loc": [var], "msg": "none is not an allowed value", "type": "type_error.none.not_allowed" }
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+'''
+Tabulates the saved forest over its whole valid input space (see model/tabulated.py): every combination
+of the allowed categorical values in data_model.py times the forest's steps in the numeric variable
+(Carat Weight). The table is checked against Regressor.predict on the test data and on random valid
+inputs, and saved to the artifacts folder, where serve.py uses it when tabulated_model is set in
+config/serve_config.json.
+Run from app/src (after training, and again after any change to the model):
+    python tabulate.py
+'''
+import os, warnings, sys, time
+warnings.filterwarnings('ignore')
+
+import argparse
+import numpy as np
+
+sys.path.insert(0, './../../')
+
+import app.src.preprocessing.pipeline as pipeline
+import app.src.model.regressor as regressor
+import app.src.utils as utils
+from app.src.preprocessing.compiled import compile_pipeline
+from app.src.model.tabulated import TabulatedModel, tabulated_model_dirname
+from app.src.serving.validation import RecordValidator
+from data_model import DataModel, CATEGORY_LISTS
+
+
+test_data_path = "./../data/processed_data/testing/"
+schema_path = "./../data/data_config/"
+artifacts_path = "./../artifacts/"
+
+
+def run_tabulation(n_random=100_000, seed=42):
+    inputs_pipeline = pipeline.load_preprocessor(artifacts_path)
+    compiled_pipeline = compile_pipeline(inputs_pipeline)
+    model = regressor.load_model(artifacts_path)
+    validator = RecordValidator.from_data_model(DataModel, CATEGORY_LISTS)
+    num_var, num_range = next(iter(validator.num_ranges.items()))
+
+    print("Tabulating model ...")
+    start = time.perf_counter()
+    tabulated = TabulatedModel.build(model, compiled_pipeline, CATEGORY_LISTS, num_var, num_range)
+    print(f"{tabulated.n_combinations} combinations x {tabulated.n_steps} steps of {num_var} "
+          f"({tabulated.table.nbytes / 2**20:.1f} MB) in {time.perf_counter() - start:.1f} s")
+
+    # test data (in range, with all categories allowed) and random valid inputs, including the step bounds
+    data_schema = utils.get_data_schema(schema_path)
+    test_records = utils.get_data(test_data_path, data_schema).to_dict(orient="records")
+    rng = np.random.default_rng(seed)
+    values = np.concatenate([rng.uniform(*num_range, size=n_random), tabulated.bounds, np.nextafter(tabulated.bounds, np.inf), num_range])
+    values = np.clip(values, *num_range)
+    random_records = [{ **{ var: cats[rng.integers(len(cats))] for var, cats in CATEGORY_LISTS.items() }, num_var: float(v) } for v in values]
+    for name, records in [("test data", test_records), ("random inputs", random_records)]:
+        batch, valid_idx, _ = validator.validate([{ "Id": "0", **record } for record in records])
+        records = [records[i] for i in valid_idx]
+        expected = model.predict(compiled_pipeline.transform(records))
+        max_diff = np.abs(tabulated.predict_encoded(batch) - expected).max()
+        print(f"Max difference to Regressor.predict on {len(records)} {name}: {max_diff:.3g}")
+        if not max_diff <= 1e-9 * np.abs(expected).max():
+            raise ValueError(f"Tabulated predictions differ from the model's on {name}.")
+
+    X_one = compiled_pipeline.transform(random_records[:1])
+    batch_one, _, _ = validator.validate([{ "Id": "0", **random_records[0] }])
+    for name, fn in [("Regressor.predict", lambda: model.predict(X_one)), ("tabulated lookup", lambda: tabulated.predict_encoded(batch_one))]:
+        start = time.perf_counter()
+        for _ in range(200): fn()
+        print(f"{name}: {(time.perf_counter() - start) / 200 * 1e6:.1f} us per 1-row call")
+
+    model_checksum = utils.get_file_checksum(os.path.join(artifacts_path, regressor.model_fname))
+    tabulated.save(os.path.join(artifacts_path, tabulated_model_dirname), model_checksum=model_checksum)
+    print("Saved tabulated model.")
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n-random", type=int, default=100_000, help="random valid inputs to check the table on")
+    args = parser.parse_args()
+    run_tabulation(n_random=args.n_random)
@@ -0,0 +1,37 @@
+import os
+import pytest
+
+import app.src.utils as utils
+
+
+src_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+train_data_path = os.path.join(src_path, "..", "data", "processed_data", "training")
+test_data_path = os.path.join(src_path, "..", "data", "processed_data", "testing")
+schema_path = os.path.join(src_path, "..", "data", "data_config")
+
+
+@pytest.fixture(scope="session")
+def data_schema():
+    return utils.get_data_schema(schema_path)
+
+
+@pytest.fixture(scope="session")
+def train_data(data_schema):
+    return utils.get_data(train_data_path, data_schema)
+
+
+@pytest.fixture(scope="session")
+def test_data(data_schema):
+    return utils.get_data(test_data_path, data_schema)
+
+
+@pytest.fixture(scope="session")
+def target_field(data_schema):
+    return data_schema["inputDatasets"]["regressionBaseMainInput"]["targetField"]
+
+
+@pytest.fixture(scope="session")
+def fitted_pipeline(train_data, data_schema):
+    ''' The inputs pipeline fitted on the training data as train.py fits it. '''
+    import app.src.train as train
+    return train.preprocess_data(train_data, data_schema)[2]
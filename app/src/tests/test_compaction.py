@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+import app.src.model.regressor as regressor
+import app.src.model.compaction as compaction
+from app.src.model.flat_forest import FlatForest
+
+
+@pytest.fixture(scope="module")
+def fitted_data():
+    rng = np.random.default_rng(0)
+    X = rng.random((500, 5)).astype(np.float32)
+    y = 1000 * X[:, 0] + 500 * X[:, 1] ** 2 + 100 * rng.random(500)
+    model = regressor.Regressor(n_estimators=20, max_features=3, n_jobs=1)
+    model.fit(X, y)
+    return model, X, y
+
+
+def test_quantized_model_saves_and_loads(fitted_data, tmp_path):
+    model, X, y = fitted_data
+    compacted = compaction.compact_model(model, np.arange(20), 10, max_depth=6, quantized=True)
+    regressor.save_model(compacted, str(tmp_path))
+    loaded = regressor.load_model(str(tmp_path), mmap=True)
+    assert np.allclose(loaded.predict(X), compacted.model.predict(X), rtol=1e-5, atol=0)
+
+
+def test_compacted_model_is_not_compacted_again(fitted_data):
+    model, X, y = fitted_data
+    compacted = compaction.compact_model(model, np.arange(20), 10)
+    assert compacted.fit_history["method"] == "compacted" and not compacted.is_single_fit_on(X, y)
+    with pytest.raises(ValueError, match="compacted already"):
+        compaction.get_compaction_candidates(compacted, X, y, lambda y, p: {}, [1.0], [None])
+
+
+def test_flat_forest_rejects_values_off_the_grid(fitted_data):
+    model, X, y = fitted_data
+    compacted = compaction.compact_model(model, np.arange(20), 10, quantized=True)
+    forest = compacted.model
+    forest.estimators_ = forest.estimators_ + model.model.estimators_[:1]
+    with pytest.raises(ValueError, match="quantization grid"):
+        FlatForest.from_sklearn(forest, quantization=compacted.quantization)
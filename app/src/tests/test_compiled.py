@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+import app.src.preprocessing.pipeline as pipeline
+from app.src.preprocessing.compiled import compile_pipeline
+
+
+@pytest.fixture(scope="module")
+def compiled_pipeline(fitted_pipeline):
+    return compile_pipeline(fitted_pipeline)
+
+
+@pytest.fixture(scope="module")
+def test_inputs(test_data, target_field):
+    return test_data.drop(columns=[target_field])
+
+
+@pytest.fixture(scope="module")
+def test_inputs_with_nulls(test_inputs, compiled_pipeline):
+    ''' The test inputs with None, NaN and unseen values in every categorical column and NaNs in the numeric ones. '''
+    data = test_inputs.copy()
+    for i, var in enumerate(compiled_pipeline.cat_vars):
+        data[var] = data[var].astype(object)
+        data.loc[data.index[i::7], var] = None
+        data.loc[data.index[i + 3::11], var] = np.nan
+        data.loc[data.index[i + 5::13], var] = "unseen"
+    for i, var in enumerate(compiled_pipeline.num_vars):
+        data.loc[data.index[i::5], var] = np.nan
+    return data
+
+
+def expected_features(inputs_pipeline, data, dtype):
+    return inputs_pipeline.transform(data).to_numpy(dtype)
+
+
+def test_float64_matches_pipeline(fitted_pipeline, compiled_pipeline, test_inputs):
+    X = compiled_pipeline.transform(test_inputs, dtype=np.float64)
+    assert X.dtype == np.float64
+    assert np.array_equal(X, expected_features(fitted_pipeline, test_inputs, np.float64))
+
+
+def test_float32_matches_feature_matrix(fitted_pipeline, compiled_pipeline, test_inputs):
+    X = compiled_pipeline.transform(test_inputs)
+    assert X.dtype == np.float32 and X.flags.c_contiguous
+    assert np.array_equal(X, pipeline.to_feature_matrix(fitted_pipeline.transform(test_inputs)))
+    assert np.array_equal(X, compiled_pipeline.transform(test_inputs, dtype=np.float64).astype(np.float32))
+
+
+def test_records_input(compiled_pipeline, test_inputs):
+    records = test_inputs.to_dict(orient="records")
+    for dtype in [np.float64, np.float32]:
+        assert np.array_equal(compiled_pipeline.transform(records, dtype=dtype), compiled_pipeline.transform(test_inputs, dtype=dtype))
+
+
+def test_null_and_unseen_categories(fitted_pipeline, compiled_pipeline, test_inputs_with_nulls):
+    # numeric columns without missing values in the training data have no imputer, so NaN stays NaN in both
+    data = test_inputs_with_nulls
+    expected = expected_features(fitted_pipeline, data, np.float64)
+    assert np.array_equal(compiled_pipeline.transform(data, dtype=np.float64), expected, equal_nan=True)
+    assert np.array_equal(compiled_pipeline.transform(data), pipeline.to_feature_matrix(fitted_pipeline.transform(data)), equal_nan=True)
+    records = data.to_dict(orient="records")
+    assert np.array_equal(compiled_pipeline.transform(records, dtype=np.float64), expected, equal_nan=True)
@@ -0,0 +1,21 @@
+from app.src.serving.prediction_cache import PredictionCache
+
+
+def test_predictions_of_a_swapped_out_bundle_are_not_cached():
+    cache = PredictionCache()
+    old_bundle, new_bundle = object(), object()
+    keys = [("a",), ("b",)]
+    cache.set_bundle(old_bundle)
+    cache.put_many(keys, [1.0, 2.0], old_bundle)
+    assert cache.get_many(keys, old_bundle) == [1.0, 2.0]
+
+    # a request scored with the old bundle finishes after the swap
+    cache.set_bundle(new_bundle)
+    cache.put_many(keys, [1.0, 2.0], old_bundle)
+    assert cache.get_many(keys, new_bundle) == [None, None]
+    assert cache.get_many(keys, old_bundle) == [None, None]
+
+    cache.put_many(keys, [3.0, 4.0], new_bundle)
+    assert cache.get_many(keys, new_bundle) == [3.0, 4.0]
+    assert cache.get_many(keys, old_bundle) == [None, None]
+    assert cache.stats()["invalidations"] == 1
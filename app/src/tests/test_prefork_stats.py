@@ -0,0 +1,48 @@
+import app.src.instrumentation as instrumentation
+import app.src.serving.prefork as prefork
+
+
+def test_metrics_of_workers_are_summed():
+    worker_1 = "\n".join([
+        "# HELP inference_queue_depth Inference calls waiting for a worker.", 
+        "# TYPE inference_queue_depth gauge", 
+        "inference_queue_depth 2", 
+        "# HELP pipeline_stage_seconds Wall time.", 
+        "# TYPE pipeline_stage_seconds histogram", 
+        'pipeline_stage_seconds_sum{stage="model.predict"} 0.5', 
+        'pipeline_stage_seconds_count{stage="model.predict"} 3', 
+    ]) + "\n"
+    # the second worker has not run the model yet, but has a stage the first one has not
+    worker_2 = "\n".join([
+        "# HELP inference_queue_depth Inference calls waiting for a worker.", 
+        "# TYPE inference_queue_depth gauge", 
+        "inference_queue_depth 1", 
+        "# HELP pipeline_stage_seconds Wall time.", 
+        "# TYPE pipeline_stage_seconds histogram", 
+        'pipeline_stage_seconds_sum{stage="preprocess.encoder"} 0.25', 
+        'pipeline_stage_seconds_count{stage="preprocess.encoder"} 1', 
+    ]) + "\n"
+    merged = instrumentation.merge_prometheus([worker_1, worker_2]).splitlines()
+    assert merged == [
+        "# HELP inference_queue_depth Inference calls waiting for a worker.", 
+        "# TYPE inference_queue_depth gauge", 
+        "inference_queue_depth 3", 
+        "# HELP pipeline_stage_seconds Wall time.", 
+        "# TYPE pipeline_stage_seconds histogram", 
+        'pipeline_stage_seconds_sum{stage="model.predict"} 0.5', 
+        'pipeline_stage_seconds_count{stage="model.predict"} 3', 
+        'pipeline_stage_seconds_sum{stage="preprocess.encoder"} 0.25', 
+        'pipeline_stage_seconds_count{stage="preprocess.encoder"} 1', 
+    ]
+    assert instrumentation.merge_prometheus([worker_1, worker_1]).splitlines()[2] == "inference_queue_depth 4"
+
+
+def test_snapshots_are_read_by_worker(tmp_path, monkeypatch):
+    monkeypatch.setattr(prefork, "stats_dir", str(tmp_path))
+    prefork.publish_snapshot({ "stats": { "hits": 1 } })
+    prefork.publish_snapshot({ "stats": { "hits": 2 } })
+    (tmp_path / "12345.json").write_text('{"stats": {"hits": 5}}')
+    snapshots = prefork.read_snapshots()
+    assert snapshots[12345] == { "stats": { "hits": 5 } }
+    assert snapshots[prefork.os.getpid()] == { "stats": { "hits": 2 } }
+    assert len(snapshots) == 2
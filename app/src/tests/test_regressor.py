@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+import app.src.model.regressor as regressor
+import app.src.model.compaction as compaction
+
+
+def test_grow_gives_new_trees_new_seeds():
+    rng = np.random.default_rng(0)
+    X = rng.random((300, 5)).astype(np.float32)
+    y = X.sum(axis=1)
+    model = regressor.Regressor(n_estimators=20, max_features=3, n_jobs=1)
+    model.fit(X, y)
+    seeds = [tree.random_state for tree in model.model.estimators_]
+    for _ in range(5):
+        # the sliding window keeps the forest at 20 trees, so sklearn alone would reuse the same seeds
+        model.grow(X, y, 10, max_trees=20)
+        seeds += [tree.random_state for tree in model.model.estimators_[-10:]]
+    assert len(model.model.estimators_) == 20 and model.total_grown == 70
+    assert len(set(seeds)) == len(seeds)
+
+
+def test_grow_compacted_model(tmp_path):
+    rng = np.random.default_rng(0)
+    X = rng.random((500, 5)).astype(np.float32)
+    y = 1000 * X[:, 0] + 500 * X[:, 1] ** 2
+    model = regressor.Regressor(n_estimators=20, max_features=3, n_jobs=1)
+    model.fit(X, y)
+
+    quantized = compaction.compact_model(model, np.arange(20), 10, max_depth=6, quantized=True)
+    with pytest.raises(ValueError, match="quantized"):
+        quantized.grow(X, y, 5)
+    assert len(quantized.model.estimators_) == 10
+
+    pruned = compaction.compact_model(model, np.arange(20), 10, max_depth=6)
+    pruned.grow(X, y, 5)
+    regressor.save_model(pruned, str(tmp_path))
+    loaded = regressor.load_model(str(tmp_path), mmap=True)
+    assert len(pruned.model.estimators_) == 15
+    assert np.allclose(loaded.predict(X), pruned.model.predict(X), rtol=1e-5, atol=0)
@@ -0,0 +1,73 @@
+import os
+import numpy as np, pandas as pd
+import pytest
+
+import app.src.train as train
+import app.src.utils as utils
+import app.src.preprocessing.pipeline as pipeline
+import app.src.preprocessing.streaming_fit as streaming_fit
+import app.src.preprocessing.preprocess_utils as pp_utils
+import app.src.preprocessing.feature_layout as feature_layout
+
+
+def add_nulls(data, target_field, seed=42):
+    ''' Copy of data with about 5% nulls in every input column except the id. '''
+    data = data.copy()
+    rng = np.random.default_rng(seed)
+    for col in data.columns:
+        if col in ("Id", target_field): continue
+        data.loc[rng.random(len(data)) < 0.05, col] = None
+    return data
+
+
+@pytest.fixture(scope="module", params=[False, True], ids=["no_nulls", "nulls"])
+def train_files(request, train_data, target_field, data_schema, tmp_path_factory):
+    ''' The training data (with or without injected nulls) saved as csv, and its in-memory pre-processing. '''
+    data = add_nulls(train_data, target_field) if request.param else train_data
+    data_path = tmp_path_factory.mktemp("train_data")
+    data.to_csv(os.path.join(data_path, "train.csv"), index=False)
+    # read back, so both fits see the same values and dtypes
+    data = utils.get_data(str(data_path), data_schema)
+    assert data.drop(columns=["Id", target_field]).isna().any().all() == request.param
+    processed_inputs, processed_target, inputs_pipeline = train.preprocess_data(data, data_schema)
+    return str(data_path), processed_inputs, processed_target, inputs_pipeline
+
+
+@pytest.mark.parametrize("chunk_size", [500, 777, 5000])
+def test_streaming_fit_matches_in_memory_fit(train_files, chunk_size, data_schema):
+    data_path, processed_inputs, processed_target, inputs_pipeline = train_files
+    read_chunks = lambda: utils.iter_data_chunks(data_path, data_schema, chunk_size=chunk_size)
+    streamed_pipeline, pp_params = streaming_fit.fit_inputs_pipeline(read_chunks(), data_schema, utils.get_model_config())
+    assert pipeline.get_fitted_categories(streamed_pipeline) == pipeline.get_fitted_categories(inputs_pipeline)
+
+    n_rows = streamed_pipeline.data_profile_["n_rows"]
+    assert n_rows == len(processed_inputs)
+    streamed_inputs, streamed_target = streaming_fit.transform_chunks(streamed_pipeline, read_chunks(), n_rows, pp_params["target_attr_name"])
+    assert streamed_inputs.dtype == processed_inputs.dtype and streamed_inputs.flags.c_contiguous
+    assert np.array_equal(streamed_inputs, processed_inputs)
+    assert np.array_equal(streamed_target.to_numpy(), processed_target.to_numpy())
+
+
+@pytest.mark.parametrize("change", ["none", "rare_category", "frequent_category", "nulls"])
+def test_fitted_categories_from_merged_profiles(change, train_data, test_data, target_field, data_schema):
+    ''' The categories the pipeline would learn on the training data plus new data, from the saved profile and a
+    profile of the new data only, are those a refit on both learns. '''
+    new_data = test_data.copy()
+    new_data["Cut"] = new_data["Cut"].astype(object)
+    if change == "rare_category":
+        new_data.loc[new_data.index[:30], "Cut"] = "Brand-New"
+    elif change == "frequent_category":
+        new_data.loc[new_data.index[:400], "Cut"] = "Brand-New"
+    elif change == "nulls":
+        new_data = add_nulls(new_data, target_field)
+    _, _, inputs_pipeline = train.preprocess_data(train_data, data_schema)
+    _, _, refitted_pipeline = train.preprocess_data(pd.concat([train_data, new_data], ignore_index=True), data_schema)
+
+    cat_vars, num_vars = pp_utils.get_cat_and_num_vars_lists(data_schema)
+    merged = feature_layout.merge_profiles([inputs_pipeline.data_profile_, feature_layout.profile_data(new_data, cat_vars, num_vars)])
+    assert merged["n_rows"] == refitted_pipeline.data_profile_["n_rows"]
+    assert merged["categorical"] == refitted_pipeline.data_profile_["categorical"]
+    for var, stats in refitted_pipeline.data_profile_["numeric"].items():
+        assert merged["numeric"][var] == pytest.approx(stats, rel=1e-9)
+    assert (streaming_fit.get_fitted_categories_from_profile(inputs_pipeline, merged)
+            == pipeline.get_fitted_categories(refitted_pipeline))
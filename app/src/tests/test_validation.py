@@ -0,0 +1,18 @@
+from app.src.data_model import DataModel, CATEGORY_LISTS
+from app.src.serving.validation import RecordValidator
+
+
+def test_to_records_matches_data_model(test_data, target_field):
+    records = test_data.drop(columns=[target_field]).to_dict(orient="records")
+    # ids as numbers, numbers as strings and unknown keys are accepted, and not echoed back as sent
+    for record in records[:10]:
+        record["Id"] = int(record["Id"])
+        record["Carat Weight"] = str(record["Carat Weight"])
+        record["unknown"] = 1
+    validator = RecordValidator.from_data_model(DataModel, CATEGORY_LISTS)
+    batch, valid_idx, errors = validator.validate(records)
+    assert not errors and len(valid_idx) == len(records)
+    decoded = validator.to_records(batch)
+    expected = [DataModel.parse_obj(record).dict(by_alias=True) for record in records]
+    assert decoded == expected
+    assert all(list(record) == list(expected_record) for record, expected_record in zip(decoded, expected))
@@ -1,43 +1,87 @@
 #!/usr/bin/env python
 
-import os, warnings, sys
+import os, warnings, sys, time
 warnings.filterwarnings('ignore') 
 
 import pprint
+import argparse
+import pandas as pd
 
 sys.path.insert(0, './../../')
 
 import app.src.preprocessing.pipeline as pipeline
 import app.src.preprocessing.preprocess_utils as pp_utils
+import app.src.preprocessing.streaming_fit as streaming_fit
+from app.src.preprocessing.feature_layout import profile_data, merge_profiles
 import app.src.utils as utils
+import app.src.instrumentation as instrumentation
 import app.src.model.regressor as regressor
+import app.src.model.hyperparameter_tuning as tuning
+import app.src.model.sharded_training as sharded_training
+import app.src.artifact_bundle as artifact_bundle
 
 train_data_path = "./../data/processed_data/training/"
 schema_path = "./../data/data_config/"
 model_path = "./../artifacts/"
 
+training_summary_fname = "training_summary.json"
+
 
 # get model configuration parameters 
 model_cfg = utils.get_model_config()
 
-def run_training():  
+def run_training(data_format=None, tune=False, tune_workers=None, shards=None, shard_mode="bootstrap", 
+                 streaming_chunk_size=None):  
     
     # set random seeds
     utils.set_seeds()
     
-    # read train_data
-    train_data = utils.get_data(train_data_path)
-    
     # get data schema
     data_schema = utils.get_data_schema(schema_path)
-        
+    
+    if streaming_chunk_size is not None: 
+        # fit the preprocessor in one chunked pass over the files, then transform them chunk by chunk
+        print("Pre-processing data in chunks...")
+        read_chunks = lambda: utils.iter_data_chunks(train_data_path, data_schema, chunk_size=streaming_chunk_size, file_format=data_format)
+        inputs_pipeline, pp_params = streaming_fit.fit_inputs_pipeline(read_chunks(), data_schema, model_cfg)
+        num_rows = inputs_pipeline.data_profile_["n_rows"]
+        processed_inputs, processed_target = streaming_fit.transform_chunks(inputs_pipeline, read_chunks(), num_rows, pp_params["target_attr_name"])
+        print("Processed train X/y data shape", processed_inputs.shape, processed_target.shape)
+        train_and_save(processed_inputs, processed_target, inputs_pipeline, num_rows, data_schema=data_schema, 
+                       tune=tune, tune_workers=tune_workers, shards=shards, shard_mode=shard_mode)
+        return
+    
+    # read train_data
+    train_data = utils.get_data(train_data_path, data_schema, verbose=True, file_format=data_format)
+    
+    fit_and_save(train_data, data_schema, tune=tune, tune_workers=tune_workers, shards=shards, shard_mode=shard_mode)
+    
+
+
+def fit_and_save(train_data, data_schema, tune=False, tune_workers=None, shards=None, shard_mode="bootstrap"): 
     # preprocess data
     print("Pre-processing data...")
     processed_inputs, processed_target, inputs_pipeline = preprocess_data(train_data, data_schema)    
-                 
+    train_and_save(processed_inputs, processed_target, inputs_pipeline, len(train_data), data_schema=data_schema, 
+                   tune=tune, tune_workers=tune_workers, shards=shards, shard_mode=shard_mode)
+
+
+
+def train_and_save(processed_inputs, processed_target, inputs_pipeline, num_rows, data_schema=None, tune=False, 
+                   tune_workers=None, shards=None, shard_mode="bootstrap"): 
+    # optionally search for the best hyper-parameters (scored on out-of-bag error)
+    hyperparameters = {}
+    if tune: 
+        print('Tuning hyper-parameters ...')
+        hyperparameters = tuning.tune_hyperparameters(
+            processed_inputs, processed_target, model_cfg["hyperparameter_tuning"], model_path, n_workers=tune_workers)
+    
     # Create and train model     
     print('Training model ...')  
-    model= train_model(train_X=processed_inputs, train_y = processed_target)         
+    start = time.perf_counter()
+    model= train_model(train_X=processed_inputs, train_y = processed_target, hyperparameters=hyperparameters, 
+                       shards=shards, shard_mode=shard_mode)         
+    fit_seconds = time.perf_counter() - start
     
     # save preprocessors
     pipeline.save_preprocessor(inputs_pipeline, model_path)
@@ -45,17 +89,100 @@ def run_training():
     # save model
     regressor.save_model(model=model, model_path=model_path)
     
-    print('Done training and saving model ...')  
+    # record the cost of a full fit, to compare incremental retraining against
+    utils.save_json(os.path.join(model_path, training_summary_fname), 
+                    { "fit_seconds": fit_seconds, "num_rows": num_rows, "n_estimators": model.n_estimators })
+    
+    # written last: it marks the saved files as one complete bundle (see artifact_bundle.py)
+    manifest = artifact_bundle.write_manifest(model_path, data_schema)
+    
+    print(f"Done training and saving model (bundle {manifest['bundle_version']}) ...")  
+
+
+
+def run_incremental_training(new_data_path, data_format=None, max_trees=None): 
+    '''
+    Retrain by growing the saved forest on new data instead of refitting everything. 
+    The saved preprocessor is kept as is, which is only valid if the new data does not change the fitted 
+    categories, rare-label groups or missing-value handling. This is checked from counts alone: the profile of 
+    the data the preprocessor has seen (saved with it) is merged with a profile of the new data, and the 
+    categories the pipeline would learn from the merged counts are compared with its fitted ones. If anything 
+    changed, a full fit on the training data plus the new data is done instead. 
+    Otherwise, new trees are fitted on the new data only, in proportion to its share of all rows, 
+    and appended to the forest; with max_trees, the oldest trees are dropped to keep a sliding window. 
+    The saved profile then covers the new data too. Move the new data files into the training data folder 
+    afterwards so the next full retrain includes them. 
+    A quantized (compacted) model cannot be grown; a ValueError is raised before anything is read or saved. 
+    '''
+    start = time.perf_counter()
+    utils.set_seeds()
+    model = regressor.load_model(model_path)
+    regressor.check_growable(model)
+    data_schema = utils.get_data_schema(schema_path)
+    new_data = utils.get_data(new_data_path, data_schema, verbose=True, file_format=data_format)
+    
+    print("Checking fitted categories ...")
+    inputs_pipeline = pipeline.load_preprocessor(model_path)
+    cat_vars, num_vars = pp_utils.get_cat_and_num_vars_lists(data_schema)
+    train_profile = getattr(inputs_pipeline, "data_profile_", None)
+    if train_profile is None: 
+        # preprocessors saved before the profile was: count the training data
+        train_profile = profile_data(utils.get_data(train_data_path, data_schema, file_format=data_format), cat_vars, num_vars)
+    all_profile = merge_profiles([train_profile, profile_data(new_data, cat_vars, num_vars)])
+    if (streaming_fit.get_fitted_categories_from_profile(inputs_pipeline, all_profile) != pipeline.get_fitted_categories(inputs_pipeline) 
+            or get_missing_value_handling(all_profile, data_schema) != get_missing_value_handling(train_profile, data_schema)): 
+        print("New data changes the fitted categories, rare-label groups or missing-value handling. Running a full fit instead ...")
+        train_data = utils.get_data(train_data_path, data_schema, verbose=True, file_format=data_format)
+        fit_and_save(pd.concat([train_data, new_data], ignore_index=True), data_schema)
+        return
+    check_seconds = time.perf_counter() - start
+    
+    target_field = data_schema["inputDatasets"]["regressionBaseMainInput"]["targetField"]
+    new_inputs = pipeline.to_feature_matrix(inputs_pipeline.transform(new_data.loc[:, new_data.columns != target_field]))
+    new_target = new_data[[target_field]]
+    
+    n_new_trees = max(1, int(round(model.n_estimators * len(new_data) / all_profile["n_rows"])))
+    print(f"Growing {n_new_trees} tree(s) on {len(new_data)} new rows ...")
+    grow_start = time.perf_counter()
+    model.grow(new_inputs, new_target, n_new_trees, max_trees=max_trees)
+    grow_seconds = time.perf_counter() - grow_start
+    # the saved profile covers all the data the model has been trained on, for the next check
+    inputs_pipeline.data_profile_ = all_profile
+    pipeline.save_preprocessor(inputs_pipeline, model_path)
+    regressor.save_model(model=model, model_path=model_path)
+    artifact_bundle.write_manifest(model_path, data_schema)
+    total_seconds = time.perf_counter() - start
+    
+    print(f"Incremental training took {total_seconds:.2f} s end to end ({check_seconds:.2f} s to load and check the data, "
+          f"{grow_seconds:.2f} s to grow). Model now has {model.n_estimators} trees.")
+    summary_path = os.path.join(model_path, training_summary_fname)
+    if os.path.exists(summary_path): 
+        # a full fit scales roughly linearly with the number of rows; its pre-processing and saving are not included
+        summary = utils.get_json_file(summary_path, "training summary")
+        full_fit_seconds = summary["fit_seconds"] * all_profile["n_rows"] / summary["num_rows"]
+        print(f"A full retrain would take ~{full_fit_seconds:.2f} s for the model fit alone "
+              f"({100 * (1 - total_seconds / full_fit_seconds):.0f}% saved end to end).")
     
 
 
+def get_missing_value_handling(profile, data_schema): 
+    '''The variables with missing values, and the categorical ones imputed with 'missing', as the pre-processing fit 
+    would choose them for data with the given profile (see preprocess_utils.get_preprocess_params).'''
+    pp_params = dict(zip(["cat_vars", "num_vars"], pp_utils.get_cat_and_num_vars_lists(data_schema)))
+    pp_params["cat_na"], pp_params["num_na"] = pp_utils.get_vars_with_nas(profile, pp_params)
+    return pp_params["cat_na"], pp_params["num_na"], pp_utils.get_cat_vars_with_missing_impute_for_na(profile, pp_params, model_cfg)
+
+
 def preprocess_data(train_data, data_schema):
     # print('Preprocessing train_data of shape...', train_data.shape)
     pp_params = pp_utils.get_preprocess_params(train_data, data_schema, model_cfg)   
     
     inputs_pipeline = pipeline.get_inputs_pipeline(pp_params, model_cfg)
     inputs = train_data.loc[:, train_data.columns != pp_params["target_attr_name"]]
-    processed_inputs = inputs_pipeline.fit_transform(inputs)
+    # float32 matrix in the pipeline's column order, which the model is fitted on without another copy
+    processed_inputs = pipeline.to_feature_matrix(instrumentation.fit_transform(inputs_pipeline, inputs))
+    # kept with the fitted pipeline and saved in its feature layout (see preprocessing/feature_layout.py)
+    inputs_pipeline.data_profile_ = pp_params["profile"]
     
     # we are not doing any transformation on the targets, but we could have (e.g. standard scaling)
     processed_target = train_data[[pp_params["target_attr_name"]]]
@@ -64,13 +191,17 @@ def preprocess_data(train_data, data_schema):
     return processed_inputs, processed_target, inputs_pipeline
 
 
-def train_model(train_X, train_y):                 
+def train_model(train_X, train_y, hyperparameters=None, shards=None, shard_mode="bootstrap"):                 
+    # split the trees over several worker processes and merge them
+    if shards is not None and shards > 1: 
+        return sharded_training.fit_sharded(train_X, train_y, shards, shard_mode=shard_mode, hyperparameters=hyperparameters)
     # get model hyper-parameters that are dependent on the data shape 
     data_based_params = regressor.get_data_based_model_params(train_X)        
-    # Create and train model   
-    model = regressor.Regressor(**data_based_params)  
+    # Create and train model (tuned hyper-parameters, if given, take precedence) 
+    model = regressor.Regressor(**{**data_based_params, **(hyperparameters or {})})  
     # model.summary()  
-    model.fit( train_X=train_X, train_y=train_y )  
+    with instrumentation.stage("model.fit"): 
+        model.fit( train_X=train_X, train_y=train_y )  
     
     return model
 
@@ -81,4 +212,35 @@ def train_model(train_X, train_y):
 
 if __name__ == "__main__": 
     
-    run_training()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-format", choices=["csv", "parquet", "feather"], default=None, 
+                        help="only read training files of this format (default: all supported files)")
+    parser.add_argument("--tune", action="store_true", 
+                        help="search hyper-parameters with successive halving on out-of-bag error before training")
+    parser.add_argument("--tune-workers", type=int, default=None, help="processes used for tuning (default: all cpus)")
+    parser.add_argument("--shards", type=int, default=None, 
+                        help="fit the trees in this many worker processes and merge them into one forest")
+    parser.add_argument("--shard-mode", choices=sharded_training.shard_modes, default="bootstrap", 
+                        help="with --shards, fit each worker on all rows (bootstrap) or on its own partition of the rows")
+    parser.add_argument("--profile", action="store_true", 
+                        help="time each pre-processing step and the model (with allocations) and print a summary")
+    parser.add_argument("--streaming-fit", action="store_true", 
+                        help="fit the pre-processing in one pass over the training files read in chunks, without loading them at once")
+    parser.add_argument("--chunk-size", type=int, default=100_000, help="rows per chunk with --streaming-fit")
+    parser.add_argument("--incremental", metavar="NEW_DATA_PATH", default=None, 
+                        help="grow the saved model with trees fitted on the new data in this folder instead of a full fit")
+    parser.add_argument("--max-trees", type=int, default=None, 
+                        help="with --incremental, drop the oldest trees to keep at most this many")
+    args = parser.parse_args()
+    
+    if args.profile: 
+        instrumentation.enable(allocations=True)
+    if args.incremental is not None: 
+        run_incremental_training(args.incremental, data_format=args.data_format, max_trees=args.max_trees)
+    else: 
+        run_training(data_format=args.data_format, tune=args.tune, tune_workers=args.tune_workers, 
+                     shards=args.shards, shard_mode=args.shard_mode, 
+                     streaming_chunk_size=args.chunk_size if args.streaming_fit else None)
+    if args.profile: 
+        print("Instrumentation summary:")
+        print(instrumentation.summary())
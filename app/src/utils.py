@@ -1,7 +1,9 @@
 
 import numpy as np, pandas as pd, random
-import sys, os
-import json
+import sys, os, time
+import json, hashlib
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 
 def set_seeds(seed_value=42):
@@ -13,16 +15,124 @@ def set_seeds(seed_value=42):
         print(f"Invalid seed value: {seed_value}. Cannot set seeds.")
 
 
-def get_data(data_path):     
-    all_files = os.listdir(data_path) 
-    csv_files = list(filter(lambda f: f.endswith('.csv'), all_files))    
-    input_files = [ os.path.join(data_path, file) for file in csv_files ]
+# supported data file formats by file extension
+data_file_formats = { ".csv": "csv", ".parquet": "parquet", ".feather": "feather", ".arrow": "feather" }
+
+
+def get_data(data_path, data_schema=None, project=True, n_jobs=None, verbose=False, file_format=None):     
+    """Read and concatenate all data files in a directory: csv, parquet and feather/arrow ipc files, chosen by
+    extension, or only files of one format if file_format is given. Files are read concurrently in a thread pool
+    (n_jobs threads; defaults to one per file, up to the number of cpus) and the result has a clean RangeIndex.
+    If a data schema is given, column dtypes are pinned from it (see get_schema_dtypes) and, with project=True,
+    only the schema's id, target and predictor columns are read. verbose prints read throughput."""
+    all_files = sorted(os.listdir(data_path))
+    data_files = list(filter(lambda f: get_file_format(f) is not None, all_files))    
+    if file_format is not None: 
+        data_files = [ file for file in data_files if get_file_format(file) == file_format ]
+    input_files = [ os.path.join(data_path, file) for file in data_files ]
     if len(input_files) == 0: raise ValueError(f'There are no data files in {data_path}.')
-    raw_data = [ pd.read_csv(file) for file in input_files ]
-    data = pd.concat(raw_data)
+    
+    dtypes = get_schema_dtypes(data_schema) if data_schema is not None else None
+    columns = list(dtypes) if dtypes is not None and project else None
+    
+    start = time.perf_counter()
+    n_jobs = n_jobs or min(len(input_files), os.cpu_count() or 1)
+    if n_jobs > 1: 
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor: 
+            raw_data = list(executor.map(lambda file: read_data_file(file, dtypes, columns), input_files))
+    else: 
+        raw_data = [ read_data_file(file, dtypes, columns) for file in input_files ]
+    data = pd.concat(raw_data, ignore_index=True)
+    if data_schema is not None: 
+        # files with different category sets concatenate to object columns, so re-pin those
+        unpinned = [ col for col, dtype in dtypes.items() 
+                    if dtype == "category" and col in data.columns and data[col].dtype == object ]
+        if len(unpinned): data[unpinned] = data[unpinned].astype("category")
+    
+    if verbose: 
+        seconds = time.perf_counter() - start
+        num_mb = sum(os.path.getsize(file) for file in input_files) / 1e6
+        print(f"Read {len(input_files)} file(s), {len(data)} rows, {num_mb:.1f} MB in {seconds:.3f} s "
+              f"({num_mb / seconds:.1f} MB/s, {len(data) / seconds:,.0f} rows/s) using {n_jobs} thread(s)")
     return data
 
 
+def iter_data_chunks(data_path, data_schema=None, chunk_size=100_000, project=True, file_format=None): 
+    """Read all data files in a directory (see get_data) one chunk of at most chunk_size rows at a time, 
+    so data larger than memory can be processed: csv files in chunks, parquet files by record batches and 
+    feather/arrow files memory-mapped, batch by batch. Chunks come in file order, with the same dtypes and 
+    columns get_data would give."""
+    data_files = sorted(f for f in os.listdir(data_path) if get_file_format(f) is not None)
+    if file_format is not None: 
+        data_files = [ file for file in data_files if get_file_format(file) == file_format ]
+    if len(data_files) == 0: raise ValueError(f'There are no data files in {data_path}.')
+    dtypes = get_schema_dtypes(data_schema) if data_schema is not None else None
+    columns = list(dtypes) if dtypes is not None and project else None
+    
+    for file in data_files: 
+        file_path = os.path.join(data_path, file)
+        file_format = get_file_format(file)
+        if file_format == "csv": 
+            usecols = (lambda col: col in columns) if columns is not None else None
+            yield from pd.read_csv(file_path, dtype=dtypes, usecols=usecols, chunksize=chunk_size)
+            continue
+        if file_format == "parquet": 
+            import pyarrow.parquet as pq
+            parquet_file = pq.ParquetFile(file_path)
+            read_columns = [ col for col in parquet_file.schema_arrow.names if col in columns ] if columns is not None else None
+            batches = parquet_file.iter_batches(batch_size=chunk_size, columns=read_columns)
+        else: 
+            import pyarrow.feather as feather
+            table = feather.read_table(file_path, memory_map=True)
+            if columns is not None: 
+                table = table.select([ col for col in table.column_names if col in columns ])
+            batches = table.to_batches(max_chunksize=chunk_size)
+        for batch in batches: 
+            chunk = batch.to_pandas()
+            if dtypes is not None: 
+                chunk = chunk.astype({ col: dtype for col, dtype in dtypes.items() if col in chunk.columns }, copy=False)
+            yield chunk
+
+
+def get_file_format(file_name): 
+    return data_file_formats.get(os.path.splitext(file_name)[1].lower())
+
+
+def read_data_file(file_path, dtypes=None, columns=None): 
+    """Read one csv, parquet or feather file. Only the given columns that exist in the file are read 
+    (all columns if None), and columns listed in dtypes are cast to those dtypes."""
+    file_format = get_file_format(file_path)
+    if file_format == "csv": 
+        usecols = (lambda col: col in columns) if columns is not None else None
+        return pd.read_csv(file_path, dtype=dtypes, usecols=usecols)
+    
+    if file_format == "parquet": 
+        import pyarrow.parquet as pq
+        file_columns = pq.read_schema(file_path).names
+        read_columns = [ col for col in file_columns if col in columns ] if columns is not None else None
+        data = pd.read_parquet(file_path, columns=read_columns)
+    elif file_format == "feather": 
+        import pyarrow.feather as feather
+        table = feather.read_table(file_path, memory_map=True)
+        read_columns = [ col for col in table.column_names if col in columns ] if columns is not None else None
+        data = (table.select(read_columns) if read_columns is not None else table).to_pandas()
+    else: 
+        raise ValueError(f"Unsupported data file format: {file_path}")
+    if dtypes is not None: 
+        data = data.astype({ col: dtype for col, dtype in dtypes.items() if col in data.columns }, copy=False)
+    return data
+
+
+def get_schema_dtypes(data_schema): 
+    """Column dtypes from the data schema: id as str, target and numeric predictors as float32 and 
+    categorical predictors as category."""
+    schema = data_schema["inputDatasets"]["regressionBaseMainInput"]
+    dtypes = { schema["idField"]: str, schema["targetField"]: np.float32 }
+    for field in schema["predictorFields"]: 
+        dtypes[field["fieldName"]] = "category" if field["dataType"] == "CATEGORICAL" else np.float32
+    return dtypes
+
+
 def get_data_schema(data_schema_path): 
     try: 
         json_files = list(filter(lambda f: f.endswith('.json'), os.listdir(data_schema_path) )) 
@@ -49,12 +159,80 @@ def get_model_config():
     return get_json_file(model_cfg_path, "model config")
 
 
+def get_serve_config():
+    serve_cfg_path = os.path.join(os.path.dirname(__file__), 'config', 'serve_config.json')
+    return get_json_file(serve_cfg_path, "serve config")
+
+
 
     
 
+def get_dir_signature(dir_path): 
+    """Signature of all files under a directory (relative path, size and modification time of each file). 
+    It changes whenever a file is added, removed or rewritten."""
+    signature = []
+    for root, _, files in os.walk(dir_path): 
+        for file in files: 
+            stat = os.stat(os.path.join(root, file))
+            signature.append((os.path.relpath(os.path.join(root, file), dir_path), stat.st_size, stat.st_mtime_ns))
+    return tuple(sorted(signature))
+
+
+def get_file_signature(file_path): 
+    """Size and modification time of a file, or None if it does not exist."""
+    try: 
+        stat = os.stat(file_path)
+    except FileNotFoundError: 
+        return None
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def get_file_checksum(file_path): 
+    """sha256 of the file's contents, used to tie derived artifacts to the file they were built from."""
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f: 
+        for block in iter(lambda: f.read(2**20), b""): 
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def get_json_checksum(data): 
+    """sha256 of a jsonable structure, independent of the order of its keys."""
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def get_array_checksum(*arrays, dtype=np.float64):
+    """sha256 of the values of the arrays (DataFrames, Series or ndarrays), read as C-contiguous arrays of dtype."""
+    sha256 = hashlib.sha256()
+    for array in arrays:
+        array = np.ascontiguousarray(array, dtype=dtype)
+        sha256.update(str(array.shape).encode("utf-8"))
+        sha256.update(array.data)
+    return sha256.hexdigest()
+
+
+# settings of every joblib.dump of an artifact (preprocessor and model alike)
+joblib_dump_kwargs = { "compress": 4, "protocol": 4 }
+
+
+@contextmanager
+def atomic_path(file_path): 
+    """Temporary path (in the same folder, with the same extension) to write the new contents of file_path to. 
+    It replaces file_path with os.replace once the block exits without error, so readers see either the old or 
+    the new file, never a partly written one, and memory maps of the old file stay valid."""
+    root, ext = os.path.splitext(file_path)
+    tmp_path = f"{root}.tmp{os.getpid()}{ext}"
+    try: 
+        yield tmp_path
+        os.replace(tmp_path, file_path)
+    finally: 
+        if os.path.exists(tmp_path): 
+            os.remove(tmp_path)
+
+
 def save_json(file_path_and_name, data):
     """Save json to a path (directory + filename)"""
-    with open(file_path_and_name, 'w') as f:
+    with atomic_path(file_path_and_name) as tmp_path, open(tmp_path, 'w') as f:
         json.dump( data,  f, 
                   default=lambda o: o.__dict__,
                   sort_keys=True, 
@@ -74,5 +252,13 @@ def print_json(result):
     
 
 def save_dataframe(df, save_path, file_name): 
-    df.to_csv(os.path.join(save_path, file_name), index=False)
+    """Save a dataframe as csv, parquet or feather, chosen by the file name's extension."""
+    file_path = os.path.join(save_path, file_name)
+    file_format = get_file_format(file_name)
+    if file_format == "parquet": 
+        df.to_parquet(file_path, index=False)
+    elif file_format == "feather": 
+        df.reset_index(drop=True).to_feather(file_path)
+    else: 
+        df.to_csv(file_path, index=False)
     
\ No newline at end of file